@@ -16,4 +16,4 @@ from level1 import Cal1
 from level2 import Cal2
 from vfm import VFM
 
-__all__ = ['level1', 'level2', 'vfm']
\ No newline at end of file
+__all__ = ['level1', 'level2', 'vfm', 'vdata']
\ No newline at end of file
@@ -5,21 +5,107 @@
 # Use Cal1 and Cal2 classes instead
 
 # need pyhdf for hdf4
-from pyhdf.SD import SD, SDC
+from pyhdf.SD import SD, SDC, HDF4Error
+import os
 import warnings
 import datetime
+from collections import OrderedDict
 import numpy as np
+from scipy import sparse
+from vdata import _hdf_magic
 
 
-class _Cal:
+class _ReadCache(object):
+    """
+    Memoizes arrays read from a file, keyed by (SDS name, navg, idx, zslice, missing).
+    Least recently used arrays are dropped when the cache grows
+    beyond max_bytes.
+    Cached arrays are read-only, since they are shared between calls.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def get(self, key):
+        """
+        returns the array stored under key, or None
+        """
+        try:
+            data = self._arrays.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # move it to the most recently used end
+        self._arrays[key] = data
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        stores data under key if it fits in the cache, and returns it
+        """
+        if not isinstance(data, np.ndarray) or data.nbytes > self.max_bytes:
+            return data
+        if key in self._arrays:
+            self.nbytes -= self._arrays.pop(key).nbytes
+        while self._arrays and (self.nbytes + data.nbytes > self.max_bytes):
+            _, dropped = self._arrays.popitem(last=False)
+            self.nbytes -= dropped.nbytes
+        data.flags.writeable = False
+        self._arrays[key] = data
+        self.nbytes += data.nbytes
+        return data
+
+    def clear(self):
+        self._arrays.clear()
+        self.nbytes = 0
+
+
+# time variables need float64, they are never converted to another dtype
+_time_variables = ('Profile_Time', 'Profile_UTC_Time')
+
+
+def _check_hdf(filename):
+    """
+    raises HDF4Error if filename is not a readable HDF4 file.
+    Only reads the first bytes of the file.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            magic = f.read(4)
+    except (IOError, OSError):
+        raise HDF4Error('SD: no such file ' + filename)
+    if magic != _hdf_magic:
+        raise HDF4Error('SD: not an HDF4 file ' + filename)
+
+
+class _Cal(object):
     """
     Trying to open a non-existing CALIOP file gives an exception
+    The HDF file is only opened when data is first read from it,
+    and can be used as a context manager:
+        with Cal1(filename) as c:
+            atb = c.atb()
+    cache_size = if given, arrays read from the file are kept in memory
+    up to this number of bytes, so reading the same variable twice
+    only touches the file once. Arrays returned from the cache are read-only.
+    dtype = floating point type of the arrays returned, e.g. 'float32'.
+    By default, floating point variables keep their type in the file
+    (float32 for most CALIOP variables), and averaged integer variables are float64.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache_size=None, dtype=None):
         warnings.simplefilter('ignore', DeprecationWarning)
 
-        self.hdf = SD(filename, SDC.READ)
+        _check_hdf(filename)
+        self._hdf = None
         self.filename = filename
         # time of orbit start
         self.orbit = filename[-15:-4]
@@ -32,23 +118,105 @@ class _Cal:
         self.seconds = int(filename[-8:-6])
         # date tag + orbit start
         self.id = filename[-25:-4]
+        # product and version, e.g. CAL_LID_L1-ValStage1-V3-30
+        self.product = os.path.basename(filename)[:-26]
         self.date = datetime.datetime(self.year, self.month, self.day,
                                       self.hour, self.minutes, self.seconds)
+        self.cache = None
+        if cache_size:
+            self.cache = _ReadCache(cache_size)
+        self.dtype = None if dtype is None else np.dtype(dtype)
 
     def __repr__(self):
         return self.filename
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def hdf(self):
+        """
+        HDF4 file handle, opened on first access
+        """
+        if self._hdf is None:
+            self._hdf = SD(self.filename, SDC.READ)
+        return self._hdf
+
     def close(self):
-        self.hdf.end()
-        self.hdf = None
+        if self._hdf is not None:
+            self._hdf.end()
+            self._hdf = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    def sds_shape(self, var):
+        """
+        Returns the shape of a variable in the file, without reading it.
+        """
+        hdfvar = self.hdf.select(var)
+        shape = tuple(int(n) for n in np.atleast_1d(hdfvar.info()[2]))
+        hdfvar.endaccess()
+        return shape
+
+    def nprof(self):
+        """
+        Returns the number of profiles in the file, without reading data.
+        """
+        return self.sds_shape('Profile_Time')[0]
+
+    def cache_info(self):
+        """
+        returns a dict with the read cache statistics:
+        hits, misses, number of cached arrays, bytes used and byte budget
+        """
+        if self.cache is None:
+            return None
+        return dict(hits=self.cache.hits, misses=self.cache.misses, arrays=len(self.cache),
+                    nbytes=self.cache.nbytes, max_bytes=self.cache.max_bytes)
 
     # IO
 
+    def _float_dtype(self, data):
+        # floating point type of arrays computed from data
+        return _float_dtype(data.dtype, self.dtype)
+
+    def _as_dtype(self, data, var=None):
+        # converts floating point data to the requested dtype, except times
+        if self.dtype is None or data.dtype.kind != 'f' or var in _time_variables:
+            return data
+        return data.astype(self.dtype, copy=False)
+
+    def _cache_key(self, var, navg=1, idx=None, zslice=None, missing=None):
+        # missing changes how fill values are averaged, so it is part of the key
+        if idx is not None:
+            idx = tuple(idx)
+        if zslice is not None:
+            zslice = (zslice.start, zslice.stop)
+        return var, navg, idx, zslice, missing
+
+    def _cache_get(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(key)
+
+    def _cache_put(self, key, data):
+        if self.cache is None:
+            return data
+        return self.cache.put(key, data)
+
     def _read_var(self, var, idx=None):
         """
         read a variable (1D or 2D) in HDF file
         """
     
+        key = self._cache_key(var, idx=idx)
+        data = self._cache_get(key)
+        if data is not None:
+            return data
+
         hdfvar = self.hdf.select(var)
         if idx is None:
             data = hdfvar[:]
@@ -58,13 +226,216 @@ class _Cal:
             else:
                 data = hdfvar[idx[0]:idx[1], :]
         hdfvar.endaccess()
-        return data
+        return self._cache_put(key, self._as_dtype(data, var))
 
 
 
 # Useful maths
 
-def _vector_average(v0, navg, missing=None, valid=None):
+# values below this threshold are fill values in CALIOP files (usually -9999.)
+_fill_threshold = -999.
+
+# number of points processed at once by _block_average
+_chunk_size = 2 ** 16
+
+
+def _float_dtype(dtype0, dtype=None):
+    """
+    floating point type of results computed from data of type dtype0:
+    dtype if given, dtype0 if it is a floating point type, float64 otherwise.
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    dtype0 = np.dtype(dtype0)
+    if dtype0.kind == 'f':
+        return dtype0
+    return np.dtype('float64')
+
+
+def _block_view(a0, navg):
+    """
+    b = _block_view(a0, navg)
+    returns a view of a0 cut in blocks of navg profiles along the first axis,
+    shape [n, navg-1, ...] with n = floor(nprof / navg).
+    Like the historical loop-based averaging, the last profile of each block
+    is left out, and trailing profiles that do not fill a block are dropped.
+    """
+    n = np.size(a0, 0) // navg
+    blocks = a0[:n * navg].reshape((n, navg) + a0.shape[1:])
+    return blocks[:, :navg - 1]
+
+
+def _triangle_weights(navg):
+    """
+    w = _triangle_weights(navg)
+    triangle-shaped weights peaking at the center of a navg-profile block,
+    e.g. [1, 2, 3, 2, 1] for navg=5. navg must be odd.
+    """
+    half = navg // 2
+    return np.r_[np.arange(1, half + 2), np.arange(half, 0, -1)].astype('float64')
+
+
+def _block_stats(blocks, ok, w=None, std=False):
+    """
+    averages (or std) of blocks [n, m, ...] along axis 1,
+    considering only points where ok is True, with optional weights w.
+    returns the statistic and the sum of weights.
+    """
+
+    if w is None:
+        # counting on uint8 views of booleans is much faster than summing them
+        wsum = np.sum(ok.view(np.uint8), axis=1, dtype=np.min_scalar_type(ok.shape[1]))
+        x = blocks * ok
+    else:
+        w = ok * w
+        wsum = np.sum(w, axis=1)
+        x = blocks * w
+    # sums are always accumulated in float64, whatever the type of blocks
+    s = np.sum(x, axis=1, dtype='float64')
+    if np.isnan(s).any():
+        # NaN * 0 is NaN, we need to remove them explicitely
+        x = np.where(ok, x, 0.)
+        s = np.sum(x, axis=1, dtype='float64')
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = s / wsum
+        if std:
+            x = np.where(ok, blocks - a[:, np.newaxis], 0.)
+            x *= x
+            if w is not None:
+                x *= w
+            a = np.sqrt(np.sum(x, axis=1) / wsum)
+    return a, wsum
+
+
+def _block_average(a0, navg, valid=None, missing=None, weights=None, std=False, dtype='float64'):
+    """
+    a = _block_average(a0, navg, valid=None, missing=None, weights=None, std=False, dtype='float64')
+    averages (or computes the standard deviation of) a0 over blocks of navg
+    profiles along its first axis, using reshapes and reductions instead of
+    a loop over blocks.
+    a0 can be a vector [nprof] or an array [nprof, nz].
+    valid = vector [nprof], profiles where valid == 0 are ignored
+    missing = value to ignore on top of fill values (< -999) and NaNs
+    weights = weights for the profiles in a block, shape [navg]
+    std = if True, returns the (weighted) standard deviation instead of the mean
+    points with no valid data are set to -9999., or NaN if missing is given.
+    dtype = type of the output, sums are computed in float64 anyway.
+    output shape [nprof/navg, ...]
+    """
+
+    blocks = _block_view(a0, navg)
+    n = blocks.shape[0]
+    # extra dimensions to broadcast per-profile values on blocks
+    newdims = (1,) * (a0.ndim - 1)
+
+    if valid is not None:
+        valid = _block_view(np.asarray(valid), navg) != 0
+        valid = valid.reshape(valid.shape + newdims)
+    if weights is not None:
+        weights = np.asarray(weights, dtype='float64')[:navg - 1]
+        weights = weights.reshape((1, navg - 1) + newdims)
+
+    a = np.empty(blocks.shape[:1] + blocks.shape[2:], dtype=dtype)
+    fill = -9999. if missing is None else np.nan
+
+    # work on groups of blocks small enough to stay in cache,
+    # this avoids allocating temporaries the size of a0
+    nblocks = max(1, _chunk_size // max(1, blocks[0].size))
+    for i0 in range(0, n, nblocks):
+        i1 = min(n, i0 + nblocks)
+        b = blocks[i0:i1]
+        # NaNs fail the comparison, so they are excluded with fill values
+        ok = b > _fill_threshold
+        if missing is not None:
+            ok &= (b != missing)
+        if valid is not None:
+            ok &= valid[i0:i1]
+        ai, wsum = _block_stats(b, ok, w=weights, std=std)
+        ai[wsum == 0] = fill
+        a[i0:i1] = ai
+
+    return a
+
+
+# fields of the feature classification flags: name, first bit, number of bits
+# cf https://eosweb.larc.nasa.gov/sites/default/files/project/calipso/quality_summaries/CALIOP_L2VFMProducts_3.01.pdf
+_fcf_fields = (('type', 0, 3), ('type_qa', 3, 2), ('phase', 5, 2), ('phase_qa', 7, 2),
+               ('subtype', 9, 3), ('subtype_qa', 12, 1), ('horizontal_averaging', 13, 3))
+
+
+def _decode_fcf(f, fields=None):
+    """
+    flags = _decode_fcf(f, fields=None)
+    decodes the fields of feature classification flags f (16-bit integers)
+    with one shift and one mask on a stacked array.
+    fields = names of the fields to decode (see _fcf_fields), all of them if None
+    returns a dict of uint8 arrays with the shape of f
+    """
+    f = np.asarray(f, dtype='uint16')
+    selected = [field for field in _fcf_fields if fields is None or field[0] in fields]
+    shifts = np.array([field[1] for field in selected], dtype='uint16')
+    masks = np.array([(1 << field[2]) - 1 for field in selected], dtype='uint16')
+    newdims = (len(selected),) + (1,) * f.ndim
+    decoded = ((f >> shifts.reshape(newdims)) & masks.reshape(newdims)).astype('uint8')
+    return dict((field[0], decoded[i]) for i, field in enumerate(selected))
+
+
+def _block_first(v0, navg):
+    """
+    v = _block_first(v0, navg)
+    keeps the first profile of each block of navg profiles.
+    """
+    n = np.size(v0, 0) // navg
+    return v0[:n * navg:navg]
+
+
+def _block_count(valid, navg):
+    """
+    n = _block_count(valid, navg)
+    number of valid profiles in each block of navg profiles.
+    """
+    return np.sum(_block_view(np.asarray(valid) != 0, navg), axis=1)
+
+
+def _masked_mean(a, ok, axis=None):
+    """
+    m = _masked_mean(a, ok, axis=None)
+    mean of a where ok is True, NaN where there is no such point.
+    much faster than numpy.ma.mean.
+    """
+    n = np.sum(ok, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(np.where(ok, a, 0.), axis=axis, dtype='float64') / n
+
+
+def _window_mean(v, ok, nhalf, centered=False):
+    """
+    m = _window_mean(v, ok, nhalf, centered=False)
+    moving average of vector v over points where ok is True,
+    using running sums instead of one mean per window.
+    the window for point i is [i-nhalf:i+nhalf] if centered,
+    [i-nhalf:i+nhalf[ otherwise, both clipped to the vector.
+    like it always did, the non-centered window never includes the last point.
+    windows without any valid point give NaN.
+    """
+    n = np.size(v)
+    csum = np.r_[0., np.cumsum(np.where(ok, v, 0.), dtype='float64')]
+    ccount = np.r_[0, np.cumsum(ok)]
+    i = np.arange(n)
+    lo = np.maximum(0, i - nhalf)
+    if centered:
+        hi = np.minimum(n, i + nhalf + 1)
+    else:
+        hi = np.minimum(n - 1, i + nhalf)
+    count = ccount[hi] - ccount[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m = (csum[hi] - csum[lo]) / count
+    m[count <= 0] = np.nan
+    return m
+
+
+def _vector_average(v0, navg, missing=None, valid=None, dtype='float64'):
     """
     v = _vector_average (v0, navg)
     moyenne le vector v0 tous les navg points.
@@ -76,59 +447,25 @@ def _vector_average(v0, navg, missing=None, valid=None):
     if navg == 1:
         return v0
 
-    n = np.floor(1. * np.size(v0, 0) / navg)
-    v = np.zeros(n)
-    if valid is None:
-        valid = np.ones_like(v0)
-
-    for i in np.arange(n):
-        n0 = i * navg
-        vslice = v0[n0:n0 + navg - 1]
-        validslice = valid[n0:n0 + navg - 1]
-        if missing is None:
-            idx = (validslice != 0) & (vslice > -999.)
-            if idx.sum() == 0:
-                v[i] = -9999.
-            else:
-                v[i] = vslice[idx].mean()
-        else:
-            idx = (vslice != missing) & (validslice != 0) & (vslice > -999.)
-            if idx.sum() == 0:
-                v[i] = None
-            else:
-                v[i] = vslice[idx].mean()
-    return v
+    return _block_average(v0, navg, valid=valid, missing=missing, dtype=dtype)
 
 
-def _array_std(a0, navg, valid=None):
+def _array_std(a0, navg, valid=None, dtype='float64'):
     a0 = a0.squeeze()
     assert a0.ndim == 2, 'in _array_std, a0 should be a 2d array'
     if navg == 1:
         return np.zeros_like(a0)
-    n = np.size(a0, 0) / navg
-    a = np.zeros([n, np.size(a0, 1)])
-
-    if valid is None:
-        valid = np.ones(np.size(a0, 0))
-
-    for i in np.arange(n):
-        n0 = i * navg
-        aslice = a0[n0:n0 + navg - 1, :]
-        validslice = valid[n0:n0 + navg - 1]
-        idx = (validslice > 0)
-        if idx.sum() == 0:
-            a[i, :] = -9999.
-        else:
-            a[i, :] = np.std(aslice[idx, :], axis=0)
-    return a
+
+    return _block_average(a0, navg, valid=valid, std=True, dtype=dtype)
 
 
-def _array_average(a0, navg, weighted=False, valid=None, missing=None):
+def _array_average(a0, navg, weighted=False, valid=None, missing=None, dtype='float64'):
     """
     a = _array_average (a0, navg, weighted=False)
     moyenne le tableau a0 le long des x tous les navg profils.
-    missing = valeur a ignorer (genre -9999), ou None  
-    precising a missing value might slow things down...      
+    missing = valeur a ignorer (genre -9999), ou None
+    weighted = ponderation triangulaire centree sur le bloc (navg impair)
+    dtype = type du tableau moyenne, les sommes sont toujours en float64
     """
 
     a0 = a0.squeeze()
@@ -142,56 +479,74 @@ def _array_average(a0, navg, weighted=False, valid=None, missing=None):
         print("_array_average: navg is even, turning weights off")
 
     # create triangle-shaped weights
-    if weighted:
-        w = np.zeros(navg)
-        w[:navg / 2. + 1] = np.r_[1:navg / 2. + 1]
-        w[navg / 2. + 1:] = np.r_[int(navg / 2.):0:-1]
-    else:
-        w = None
+    w = _triangle_weights(navg) if weighted else None
 
-    # create averaged array a with number of averaged profiles n
-    n = np.floor(1. * np.size(a0, 0) / navg)
-    a = np.zeros([n, np.size(a0, 1)])
-    if valid is None:
-        # si on n'a pas d'info sur les profils valides, on suppose qu'ils le sont tous
-        valid = np.ones(np.size(a0, 0))
+    return _block_average(a0, navg, valid=valid, missing=missing, weights=w, dtype=dtype)
 
-    for i in np.arange(n):
-        n0 = i * navg
-        aslice = a0[n0:n0 + navg - 1, :]
-        validslice = valid[n0:n0 + navg - 1]
 
-        if missing is None:
+class _Remap(object):
+    """
+    Linear interpolation operator from levels y0 to levels y, shared by all
+    profiles. Each target level is a weighted sum of two source levels,
+    stored as a sparse matrix [ny, ny0] with two non-zero weights per row.
+    Like np.interp, values outside y0 are those of the closest level.
+    """
 
-            idx = (validslice != 0)  # & (np.all(aslice > -999., axis=1))
+    def __init__(self, y0, y):
+        y0 = np.asarray(y0, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        # sort source levels (CALIOP altitudes go downwards)
+        order = np.argsort(y0, kind='mergesort')
+        ys = y0[order]
+        j = np.clip(np.searchsorted(ys, y, side='right') - 1, 0, ys.size - 2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            w1 = (y - ys[j]) / (ys[j + 1] - ys[j])
+        w1 = np.clip(np.nan_to_num(w1), 0., 1.)
+        rows = np.r_[np.arange(y.size), np.arange(y.size)]
+        cols = np.r_[order[j], order[j + 1]]
+        self.matrix = sparse.csr_matrix((np.r_[1. - w1, w1], (rows, cols)), shape=(y.size, y0.size))
+        # copies of the matrix in other floating point types
+        self._matrices = {self.matrix.dtype: self.matrix}
+
+    def __call__(self, z0):
+        """
+        z = remap(z0)
+        interpolates profiles z0 [nprof, ny0] on the target levels, shape [nprof, ny]
+        all profiles are interpolated with a single sparse matrix product.
+        z has the floating point type of z0 (float64 for integers).
+        """
+        dtype = _float_dtype(z0.dtype)
+        if dtype not in self._matrices:
+            self._matrices[dtype] = self.matrix.astype(dtype)
+        return self._matrices[dtype].dot(z0.T).T
 
-            if idx.sum() == 0:
-                # no valid profiles in the slice according to valid profiles data
-                a[i, :] = -9999.
-            else:
-                aslice = aslice[idx, :]
-                # there might be invalid points somewhere in those profiles
-                # find number of valid points along the vertical
-                npts = np.sum(aslice > -999., axis=0)
-                # sum only the valid points along the vertical
-                aslice[aslice < -999.] = 0
-                asliceavg = np.sum(aslice, axis=0) / npts
-                # mark averaged points with no valid raw points as invalid
-                asliceavg[npts == 0] = -9999.
-                a[i, :] = asliceavg
-        else:
-            aslice = np.ma.masked_where(missing == aslice, aslice)
-            a[i, :] = np.ma.mean(aslice, axis=0, weights=w)
-    return a
+
+# remapping operators, by (source levels, target levels)
+_remap_operators = dict()
+
+
+def _remap_operator(y0, y):
+    """
+    returns the _Remap operator from levels y0 to levels y, built once
+    per pair of level vectors (e.g. met_alt to pre- or post-tilt lidar_alt)
+    """
+    key = (np.asarray(y0, dtype='float64').tobytes(), np.asarray(y, dtype='float64').tobytes())
+    if key not in _remap_operators:
+        _remap_operators[key] = _Remap(y0, y)
+    return _remap_operators[key]
 
 
 def _remap_y(z0, y0, y):
     """ z = remap (z0, y0, y)
             interpole les donnees du tableau z0 sur un nouveau y.
             utile pour regridder les donnees meteo genre temp
+            z0 peut etre une liste de tableaux, interpoles en une seule fois.
     """
 
-    z = np.zeros([np.size(z0, 0), np.size(y)])
-    for i in np.arange(np.size(z, 0)):
-        z[i, :] = np.interp(y, np.flipud(y0), np.flipud(z0[i, :]))
-    return z
+    remap = _remap_operator(y0, y)
+    if isinstance(z0, (list, tuple)):
+        # stack all variables to apply the operator once
+        nprof = [np.size(z, 0) for z in z0]
+        z = remap(np.concatenate(z0, axis=0))
+        return np.split(z, np.cumsum(nprof)[:-1], axis=0)
+    return remap(z0)
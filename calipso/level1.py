@@ -10,15 +10,16 @@ LMD/CNRS
 
 import os
 import numpy as np
-import numpy.ma as ma
 import datetime
-from calipso_hdf import _Cal, _vector_average, _array_std, _array_average, _remap_y
-import netCDF4
+from calipso_hdf import _Cal, _block_average, _block_first, _block_count, _remap_y
+from calipso_hdf import _masked_mean, _window_mean
+from vdata import read_vdata
+from timeutils import tai93_to_datetime64
 
 
 static_path = os.path.dirname(__file__) + '/staticdata/'
 
-# this is a hack while reading vdata segfaults pyhdf
+# static altitude vectors, used when the file metadata can't be read
 # altitude vector before November 2007
 lidar_alt_pretilt = np.loadtxt(static_path + 'lidaralt_pre2007.asc')
 # altitude vector after November 2007
@@ -29,12 +30,36 @@ lidar_alt = lidar_alt_posttilt
 # FIXME : need to verify if the same thing is needed for met_alt
 met_alt = np.loadtxt(static_path + 'metalt.asc')
 
+# date of the tilt of the CALIOP lidar, changing the altitude vector
+tilt_date = datetime.datetime(2007, 12, 1)
+
+# altitude vectors read from file metadata, by (product version, pre-tilt)
+_metadata_altitudes = dict()
+
 # maximum molecular atb for normalization
 atb_max = {'ZN': 1e-4, 'ZD': 1}
 
 # maximum integrated atb for calibration in the 26-28 km range
 iatb_bounds = {'ZN': [1e-5, 8e-5], 'ZD': [-8e-3, 8e-3]}
 
+# reading methods returning [nprof, nz] arrays on lidar altitudes, accepting alt_range
+_alt_range_variables = ('atb', 'perp', 'atb1064', 'pressure_on_lidar_alt', 'mol_on_lidar_alt',
+                        'temperature_on_lidar_alt', 'rh_on_lidar_alt')
+
+
+def _calibration_coef(atb_profile, goodatb, mol_profile, navgh, centered=False):
+    """
+    molecular calibration coefficient, from the moving average of calibration
+    profiles over [i-navgh:i+navgh[ (or [i-navgh:i+navgh] if centered)
+    """
+    atb_window = _window_mean(atb_profile, goodatb, navgh, centered=centered)
+    mol_window = _window_mean(mol_profile, np.isfinite(mol_profile), navgh, centered=centered)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coef = atb_window / mol_window
+
+    return coef
+
 
 class Cal1(_Cal):
     """
@@ -53,74 +78,147 @@ class Cal1(_Cal):
         ...
         c.close()
         
+    To avoid reading the same variables several times, e.g. in interactive
+    sessions, keep the arrays read from the file in memory up to a byte budget:
+    
+        c = Cal1(filename, cache_size=2e9)
+        
+    Arrays keep the floating point type of the file (float32) after averaging,
+    remapping and calibration. Another type can be requested:
+    
+        c = Cal1(filename, dtype='float64')
+        
     """
 
-    def __init__(self, filename, max_rms=None):
+    def __init__(self, filename, max_rms=None, cache_size=None, dtype=None):
 
-        _Cal.__init__(self, filename)
-        self.valid_rms_profiles = None
-        if self.date < datetime.datetime(2007,12,1):
-            self.lidar_alt = lidar_alt_pretilt
-        else:
-            self.lidar_alt = lidar_alt_posttilt
-        self.met_alt = met_alt
-        if max_rms is not None:
-            rms = self.parallel_rms_baseline(navg=1)
-            self.valid_rms_profiles = (rms < max_rms)
+        _Cal.__init__(self, filename, cache_size=cache_size, dtype=dtype)
+        self.max_rms = max_rms
+        self._valid_rms_profiles = None
+        self._metadata = None
+        self._lidar_alt = None
+        self._met_alt = None
 
-    def _read_sds(self, varname):
+    def _load_altitudes(self):
+        try:
+            self._lidar_alt, self._met_alt = self._altitudes()
+        except (IOError, KeyError):
+            if self.date < tilt_date:
+                self._lidar_alt = lidar_alt_pretilt
+            else:
+                self._lidar_alt = lidar_alt_posttilt
+            self._met_alt = met_alt
+
+    def _alt_slice(self, alt_range):
+        """
+        Returns the slice of altitude bins within alt_range=(zmin, zmax), in km,
+        or None if alt_range is None.
+        """
+        if alt_range is None:
+            return None
+        zbins = np.where((self.lidar_alt >= min(alt_range)) & (self.lidar_alt <= max(alt_range)))[0]
+        if zbins.size == 0:
+            raise ValueError('No CALIOP altitude bin between %g and %g km' % tuple(alt_range))
+        # pyhdf only accepts python integers in slices
+        return slice(int(zbins[0]), int(zbins[-1]) + 1)
+
+    def lidar_alt_range(self, alt_range=None):
+        """
+        Returns the CALIOP altitude levels within alt_range=(zmin, zmax), in km,
+        i.e. the vertical axis of data read with the same alt_range.
+        """
+        if alt_range is None:
+            return self.lidar_alt
+        return self.lidar_alt[self._alt_slice(alt_range)]
+
+    def _alt_defaults(self, alt, metalt):
+        # altitudes of the file when not given
+        if alt is None:
+            alt = self.lidar_alt
+        if metalt is None:
+            metalt = self.met_alt
+        return alt, metalt
+
+    def _alt_subset(self, alt, alt_range):
+        # altitude levels of alt matching the bins read with alt_range,
+        # which are found on the altitudes of the file
+        if alt_range is None:
+            return alt
+        return alt[self._alt_slice(alt_range)]
+
+    def _read_sds(self, varname, idx=None, zslice=None):
+        """
+        Reads a variable in an hdf file.
+        Only the profiles in idx=(i0, i1) and the vertical bins in zslice
+        are read from the file.
+        """
         try:
             hdfvar = self.hdf.select(varname)
         except:
             print('Cannot read ' + varname)
             return None
-            
-        var = hdfvar[:].squeeze()
+
+        sel = [slice(None)] * len(hdfvar.dimensions())
+        if idx is not None:
+            sel[0] = slice(*[None if i is None else int(i) for i in idx])
+        if zslice is not None and len(sel) > 1:
+            sel[1] = zslice
+        var = hdfvar[tuple(sel)]
         hdfvar.endaccess()
+        # 1D variables are stored as [nprof, 1]
+        if var.ndim == 2 and var.shape[1] == 1:
+            var = var[:, 0]
         return var
 
-    def _read_std(self, varname, navg):
+    def _read_std(self, varname, navg, alt_range=None):
         """
         Reads a variable in an hdf file, and computes the standard deviation
         of the variable over navg profiles
         """
 
-        var = self._read_sds(varname)
+        var = self._read_sds(varname, zslice=self._alt_slice(alt_range))
         if var.ndim == 1:
             print('sorry, ndim=1 not implemented in _read_std')
             return None
-        data = var[...]
-        data = _array_std(data, navg, valid=self.valid_rms_profiles)
+        if navg == 1:
+            return np.zeros_like(var, dtype=self._float_dtype(var))
+        data = _block_average(var, navg, valid=self.valid_rms_profiles, std=True,
+                              dtype=self._float_dtype(var))
         
         return data
 
-    def _read_var(self, varname, navg, idx=None, missing=None):
+    def _read_var(self, varname, navg, idx=None, missing=None, alt_range=None):
         """
         Read a variable in an hdf file, averaging the data if navg is > 1
         considers only profiles with valid RMS if required at file opening
+        idx = (i0, i1), only reads profiles i0 to i1
+        alt_range = (zmin, zmax) in km, only reads altitude bins in this range
         """
         
         if navg==0:
             return []
         
-        var = self._read_sds(varname)
-        if navg > np.size(var, 0):
+        zslice = self._alt_slice(alt_range)
+        key = self._cache_key(varname, navg, idx, zslice, missing)
+        data = self._cache_get(key)
+        if data is not None:
+            return data
+
+        data = self._read_sds(varname, idx=idx, zslice=zslice)
+        if navg > np.size(data, 0):
             return None
         
-        if idx is None:
-            data = var[...]
-        else:
-            i0, i1 = idx
-            if var.ndim == 1:
-                data = var[i0:i1]
-            elif var.ndim == 2:
-                data = var[i0:i1,:]
+        valid = self.valid_rms_profiles
+        if idx is not None and valid is not None:
+            valid = valid[idx[0]:idx[1]]
         
         if navg > 1:
-            avg_function = {1:_vector_average, 2:_array_average}[var.ndim]
-            data = avg_function(data, navg, missing=missing, valid=self.valid_rms_profiles)
+            data = _block_average(data, navg, missing=missing, valid=valid,
+                                  dtype=self._float_dtype(data))
+        else:
+            data = self._as_dtype(data, varname)
 
-        return data
+        return self._cache_put(key, data)
 
     def valid_profiles(self, navg=30):
         """
@@ -131,11 +229,7 @@ class Cal1(_Cal):
         if navg < 2:
             return self.valid_rms_profiles
         else:
-            n = np.size(self.valid_rms_profiles, 0) / navg
-            nprof = np.zeros(n)
-            for i in np.arange(n):
-                validslice = self.valid_rms_profiles[i * navg:i * navg + navg - 1]
-                nprof[i] = np.sum(validslice)
+            nprof = _block_count(self.valid_rms_profiles, navg)
             nprof = 100. * nprof / (navg - 1)
 
         return nprof
@@ -143,26 +237,24 @@ class Cal1(_Cal):
     def utc_time(self, navg=30, idx=None):
         if navg==0:
             return []
-        time = self._read_var('Profile_UTC_Time', navg=1)
+        time = self._read_var('Profile_UTC_Time', navg=1, idx=idx)
         if navg > np.size(time, 0):
             return None
-        if idx is not None:
-            time = time[idx[0]:idx[1]]
         if time is not None and navg > 1:
-            n = np.size(time, 0) / navg
-            time2 = np.zeros(n)
-            for i in np.arange(n):
-                time2[i] = time[i * navg]
-            time = time2
+            time = _block_first(time, navg)
 
         return time
 
-    def datetimes(self, navg=30):
+    def datetimes(self, navg=30, idx=None):
+        """
+        returns profile times as a datetime64[ns] array
+        """
         if navg==0:
             return []
-        time = self.time(navg=navg)
-        datetimes = netCDF4.num2date(time, units='seconds since 1993-01-01')
-        return np.array(datetimes)
+        time = self.time(navg=navg, idx=idx)
+        if time is None:
+            return None
+        return tai93_to_datetime64(time)
 
     def time(self, navg=30, idx=None):
         """
@@ -178,43 +270,46 @@ class Cal1(_Cal):
         if navg > len(time):
             return None
         if time is not None and navg > 1:
-            n = np.size(time, 0) / navg
-            time2 = np.zeros(n)
-            for i in np.arange(n):
-                time2[i] = time[i * navg]
-            time = time2
+            time = _block_first(time, navg)
 
         return time
 
+    def metadata(self):
+        """
+        Reads the metadata of the CALIOP file, e.g. Product_ID,
+        Lidar_Data_Altitudes, Met_Data_Altitudes...
+        returns a dict
+        """
+        if self._metadata is None:
+            self._metadata = read_vdata(self.filename, 'metadata')
+        return self._metadata
+
+    def _altitudes(self):
+        """
+        Returns the lidar and met altitude vectors from the file metadata.
+        They only change with the product version and the lidar tilt,
+        so the metadata is read once for all files sharing those.
+        """
+        key = (self.product, self.date < tilt_date)
+        if key not in _metadata_altitudes:
+            meta = self.metadata()
+            _metadata_altitudes[key] = (meta['Lidar_Data_Altitudes'], meta['Met_Data_Altitudes'])
+        return _metadata_altitudes[key]
+
     def altitude(self):
-        '''
+        """
         Reads altitude levels from CALIOP metadata.
         shape [nalt=583]
-        '''
+        """
+        return self._altitudes()[0]
 
-        # This should work but segfaults.
-        
-        #from pyhdf import VS
-        #from pyhdf import HDF
-        #
-        #hdffile = HDF.HDF(self.filename, HDF.HC.READ)
-        #vs = hdffile.vstart()
-        #meta_id = vs.find('metadata')
-        #vd = vs.attach('metadata', write=0) # same as vs.attach(meta_id, write=0)
-        #alt = vd.field('Lidar_Data_Altitudes')  # segfaults
-        
-        # workaround to get the altitude metadata field : use the hdf dump tool
-        # lifted from http://code.ohloh.net/file?fid=pMlnajrQ2omfIKEwb6bcZlejO1U
-        
-        import subprocess
-        import os
-        
-        FNULL = open(os.devnull, 'w')
-        command = 'hdp dumpvd -d -n metadata -f Lidar_Data_Altitudes ' + self.filename
-        dump = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=FNULL).communicate()[0]
-        alt = np.array(dump.split(), dtype='float32')
-        
-        return alt
+    def met_altitude(self):
+        """
+        Reads the altitude levels of ancillary meteorological data
+        from CALIOP metadata.
+        shape [nlevels=33]
+        """
+        return self._altitudes()[1]
 
     def coords(self, navg=30, idx=None):
         """
@@ -236,29 +331,34 @@ class Cal1(_Cal):
         elev = self._read_var('Surface_Elevation', navg, idx=idx)
         return elev
 
-    def perp(self, navg=30, idx=None):
+    def perp(self, navg=30, idx=None, alt_range=None):
         """
         Reads the perpendicular signal from CALIOP file
         shape [nprof, nz]
+        alt_range = (zmin, zmax) in km, only reads altitudes in this range
         """
         perp = self._read_var('Perpendicular_Attenuated_Backscatter_532',
-                              navg, idx=idx)
+                              navg, idx=idx, alt_range=alt_range)
         return perp
 
-    def atb_std(self, navg=30):
+    def atb_std(self, navg=30, alt_range=None):
         """
         Standard deviation from the Attenuated Total Backscatter 532nm from CALIOP file
         shape [nprof/navg, nz]
         """
-        atbstd = self._read_std('Total_Attenuated_Backscatter_532', navg)
+        atbstd = self._read_std('Total_Attenuated_Backscatter_532', navg, alt_range=alt_range)
         return atbstd
 
-    def atb(self, navg=30, idx=None):
+    def atb(self, navg=30, idx=None, alt_range=None):
         """
         Reads the Attenuated Total Backscatter 532nm from CALIOP file
         shape [nprof, nz]
+        alt_range = (zmin, zmax) in km, only reads altitudes in this range.
+        Example:
+            atb = c.atb(navg=15, idx=(1000, 2000), alt_range=(8, 30))
+            alt = c.lidar_alt_range((8, 30))
         """
-        atb = self._read_var('Total_Attenuated_Backscatter_532', navg, idx=idx)
+        atb = self._read_var('Total_Attenuated_Backscatter_532', navg, idx=idx, alt_range=alt_range)
         return atb
 
     def parallel_rms_baseline(self, navg=30, idx=None):
@@ -275,11 +375,12 @@ class Cal1(_Cal):
         au = self._read_var('Calibration_Constant_Uncertainty_532', navg, idx=idx)
         return au
 
-    def atb1064(self, navg=30, idx=None):
+    def atb1064(self, navg=30, idx=None, alt_range=None):
         """
         Reads the Attenuated Total Backscatter 1064nm from CALIOP file
+        alt_range = (zmin, zmax) in km, only reads altitudes in this range
         """
-        atb = self._read_var('Attenuated_Backscatter_1064', navg, idx=idx)
+        atb = self._read_var('Attenuated_Backscatter_1064', navg, idx=idx, alt_range=alt_range)
         return atb
 
     def pressure(self, navg=30, idx=None):
@@ -314,77 +415,101 @@ class Cal1(_Cal):
         rh = self._read_var('Relative_Humidity', navg, idx=idx)
         return rh
 
-    def pressure_on_lidar_alt(self, navg=30, alt=lidar_alt, metalt=met_alt, idx=None):
+    def pressure_on_lidar_alt(self, navg=30, alt=None, metalt=None, idx=None, alt_range=None):
         """
         Reads the ancillary pressure field from CALIOP file, interpolated on
         CALIOP altitude levels.
         shape [nprof, nz]
+        alt_range = (zmin, zmax) in km, only interpolates on altitudes in this range
         """
+        alt, metalt = self._alt_defaults(alt, metalt)
         p0 = self.pressure(navg=navg, idx=idx)
-        p = _remap_y(p0, metalt, alt)
+        p = _remap_y(p0, metalt, self._alt_subset(alt, alt_range))
 
         return p
 
-    def mol_on_lidar_alt(self, navg=30, alt=lidar_alt, metalt=met_alt, idx=None):
+    def mol_on_lidar_alt(self, navg=30, alt=None, metalt=None, idx=None, alt_range=None):
         """
         Reads the ancillary molecular number density from CALIOP file,
         interpolated on
         CALIOP altitude levels.
         shape [nprof, nz]
+        alt_range = (zmin, zmax) in km, only interpolates on altitudes in this range
         """
+        alt, metalt = self._alt_defaults(alt, metalt)
         mol0 = self.mol(navg=navg, idx=idx)
-        mol = _remap_y(mol0, metalt, alt)
+        mol = _remap_y(mol0, metalt, self._alt_subset(alt, alt_range))
 
         return mol
 
+    def met_on_lidar_alt(self, navg=30, alt=None, metalt=None, idx=None, alt_range=None,
+                         variables=('pressure', 'mol', 'temperature', 'rh')):
+        """
+        Reads several ancillary fields from CALIOP file and interpolates them
+        on CALIOP altitude levels at once.
+        variables = names of the reading methods, among pressure, mol, temperature, rh
+        returns a dict of arrays, shape [nprof, nz]
+        Example:
+            met = c.met_on_lidar_alt(navg=30, variables=('temperature', 'pressure'))
+            t, p = met['temperature'], met['pressure']
+        """
+        alt, metalt = self._alt_defaults(alt, metalt)
+        fields = [getattr(self, v)(navg=navg, idx=idx) for v in variables]
+        fields = _remap_y(fields, metalt, self._alt_subset(alt, alt_range))
+        return dict(zip(variables, fields))
+
     def mol_calibration_coef(self, mol=None, atb=None, navg=30, 
-                             alt=lidar_alt, metalt=met_alt, idx=None, navgh=50, zmin=30,
-                             zmax=34):
+                             alt=None, metalt=None, idx=None, navgh=50, zmin=30,
+                             zmax=34, centered=False):
         """
         Returns the molecular calibration coefficient, computed from
         atb 532 nm and molecular density profiles,
         averaged between zmin and zmax km vertically, and [i-navgh:i+navgh]
         profiles horizontally using a moving average.
+        centered = if False, the moving window is [i-navgh:i+navgh[ and never
+        includes the last profile, as it always did.
+        If True, the window is [i-navgh:i+navgh] (2*navgh+1 profiles).
+        Profiles with no usable data in their window get a NaN coefficient.
         shape [nprof]
         """
+        alt, metalt = self._alt_defaults(alt, metalt)
         if mol is None and atb is None:
+            # only read the altitudes needed for the calibration
             mol = self.mol_on_lidar_alt(navg=navg, alt=alt,
-                                        metalt=metalt, idx=idx)
-            atb = self.atb(navg=navg, idx=idx)
+                                        metalt=metalt, idx=idx, alt_range=(zmin, zmax))
+            atb = self.atb(navg=navg, idx=idx, alt_range=(zmin, zmax))
+            alt = self._alt_subset(alt, (zmin, zmax))
+
+        atb_profile, goodatb, mol_profile = self._calibration_profiles(atb, mol, alt, zmin, zmax)
+        return _calibration_coef(atb_profile, goodatb, mol_profile, navgh, centered)
+
+    def _calibration_profiles(self, atb, mol, alt, zmin, zmax):
+        """
+        Returns the atb and molecular profiles averaged between zmin and zmax,
+        and the flag of atb profiles usable for calibration.
+        shape [nprof]
+        """
+        idx = (alt >= zmin) & (alt <= zmax)
+        atb = atb[:, idx]
+        mol = mol[:, idx]
 
         # remove atb and molecular unfit for calibration purposes
         # this level of backscattering is most probably due to noise
         # in the lower stratosphere
         # (and if it's not noise we don't want it anyway)
+        # NaNs fail the comparisons and are removed as well
 
-        atb[np.abs(atb) > atb_max[self.z]] = np.nan
-        mol[mol < 0] = np.nan
-
-        atb = ma.masked_invalid(atb)
-        mol = ma.masked_invalid(mol)
-
-        idx = (alt >= zmin) & (alt <= zmax)
-
-        atb_calib_profile = ma.mean(atb[:, idx], axis=1)
-        mol_calib_profile = ma.mean(mol[:, idx], axis=1)
+        atb_calib_profile = _masked_mean(atb, np.abs(atb) <= atb_max[self.z], axis=1)
+        mol_calib_profile = _masked_mean(mol, mol >= 0, axis=1)
 
-        # now do a moving average, weeding out bad profiles
         atbbounds = iatb_bounds[self.z]
+        goodatb = (atb_calib_profile > atbbounds[0]) & (atb_calib_profile < atbbounds[1])
 
-        nprof = mol.shape[0]
-        coef = np.zeros([nprof])
+        return atb_calib_profile, goodatb, mol_calib_profile
 
-        for i in np.arange(nprof):
-            idxh = np.r_[np.max([0, i - navgh]):np.min([nprof - 1, i + navgh])]
-            atbslice = atb_calib_profile[idxh]
-            molslice = mol_calib_profile[idxh]
-            idx = (atbslice > atbbounds[0]) & (atbslice < atbbounds[1])
-            coef[i] = ma.mean(atbslice[idx]) / ma.mean(molslice)
-
-        return coef
-
-    def mol_on_lidar_alt_calibrated(self, navg=30, alt=lidar_alt,
-                                    navgh=50, metalt=met_alt, idx=None, zcal=(30, 34), atb=None):
+    def mol_on_lidar_alt_calibrated(self, navg=30, alt=None,
+                                    navgh=50, metalt=None, idx=None, zcal=(30, 34), atb=None,
+                                    alt_range=None, centered=False):
         """
         Returns an estimate of the molecular backscatter at 532 nm, computed
         from the molecular number density calibrated on
@@ -393,15 +518,24 @@ class Cal1(_Cal):
         from mol_calibration_coef().
         Shape: [nprof, nz]
         
-        atb can be passed as an argument if it's been read and averaged already.
+        atb can be passed as an argument if it's been read and averaged already,
+        on all altitudes.
+        alt_range = (zmin, zmax) in km, only returns altitudes in this range.
+        In this case the calibration reads the atb in the zcal range only.
+        centered = moving window mode of the calibration, see mol_calibration_coef()
         """
+        alt, metalt = self._alt_defaults(alt, metalt)
         mol = self.mol_on_lidar_alt(navg=navg, alt=alt,
-                                    metalt=metalt, idx=idx)
-        if atb is None:
-            atb = self.atb(navg=navg, idx=idx)
-
-        coef = self.mol_calibration_coef(mol=mol, atb=atb, zmin=zcal[0],
-                                         zmax=zcal[1], navgh=navgh)
+                                    metalt=metalt, idx=idx, alt_range=alt_range)
+        if alt_range is None:
+            if atb is None:
+                atb = self.atb(navg=navg, idx=idx)
+            coef = self.mol_calibration_coef(mol=mol, atb=atb, alt=alt, zmin=zcal[0],
+                                             zmax=zcal[1], navgh=navgh, centered=centered)
+        else:
+            coef = self.mol_calibration_coef(navg=navg, alt=alt, metalt=metalt, idx=idx,
+                                             zmin=zcal[0], zmax=zcal[1], navgh=navgh,
+                                             centered=centered)
 
         # x * y is equivalent to x[:,i] * y[i]
         # mol is [i,:], so we need to rotate it twice
@@ -411,37 +545,129 @@ class Cal1(_Cal):
 
         return mol
 
-    def temperature_on_lidar_alt(self, navg=30, alt=lidar_alt, metalt=met_alt, idx=None):
+    def temperature_on_lidar_alt(self, navg=30, alt=None, metalt=None, idx=None, alt_range=None):
         """
         Returns the ancillary temperature field in degC, interpolated on
         CALIOP altitude levels.
+        alt_range = (zmin, zmax) in km, only interpolates on altitudes in this range
         """
+        alt, metalt = self._alt_defaults(alt, metalt)
         t0 = self.temperature(navg=navg, idx=idx)
-        t = _remap_y(t0, metalt, alt)
+        t = _remap_y(t0, metalt, self._alt_subset(alt, alt_range))
         return t
 
-    def rh_on_lidar_alt(self, navg=30, alt=lidar_alt, metalt=met_alt, idx=None):
+    def rh_on_lidar_alt(self, navg=30, alt=None, metalt=None, idx=None, alt_range=None):
         """
         Returns the ancillary relative humidity field from the CALIOP file,
         interpolated on CALIOP altitude levels.
+        alt_range = (zmin, zmax) in km, only interpolates on altitudes in this range
         """
+        alt, metalt = self._alt_defaults(alt, metalt)
         rh0 = self.rh(navg=navg, idx=idx)
-        rh = _remap_y(rh0, metalt, alt)
+        rh = _remap_y(rh0, metalt, self._alt_subset(alt, alt_range))
 
         return rh
 
-    def scattering_ratio(self, navg=30, alt=None, metalt=None, idx=None):
+    def scattering_ratio(self, navg=30, alt=None, metalt=None, idx=None, alt_range=None):
         """
         Returns the scattering ratio, i.e. the ratio between the attenuated
         total backscatter and the molecular
         backscatter, both at 532 nm, both read from the CALIOP file.
-        """
-        mol_calib = self.mol_on_lidar_alt_calibrated(navg=navg,
-                                                     alt=alt, metalt=metalt, idx=idx)
-        atb = self.atb(navg=navg, idx=idx)
+        alt_range = (zmin, zmax) in km, only returns altitudes in this range
+        """
+        alt, metalt = self._alt_defaults(alt, metalt)
+        atb = self.atb(navg=navg, idx=idx, alt_range=alt_range)
+        if alt_range is not None:
+            # the calibration needs atb outside of alt_range, let it read its own
+            mol_calib = self.mol_on_lidar_alt_calibrated(navg=navg, alt=alt, metalt=metalt,
+                                                         idx=idx, alt_range=alt_range)
+        else:
+            mol_calib = self.mol_on_lidar_alt_calibrated(navg=navg,
+                                                         alt=alt, metalt=metalt, idx=idx, atb=atb)
         sr = atb / mol_calib
         return sr
 
+    def iter_chunks(self, chunk_profiles=15000, navg=30, variables=('coords', 'atb'),
+                    alt_range=None, navgh=50, zcal=(30, 34), centered=False):
+        """
+        Reads the file one chunk of profiles at a time, to process long orbits
+        with bounded memory.
+        chunk_profiles = number of profiles read at once, rounded down to a
+                         multiple of navg so chunks start and end on averaging blocks
+        variables = names of reading methods, e.g. time, coords, atb, perp,
+                    mol_on_lidar_alt, scattering_ratio, mol_on_lidar_alt_calibrated...
+                    coords gives lon and lat.
+        alt_range = (zmin, zmax) in km, only returns altitudes in this range
+        navgh, zcal, centered = molecular calibration parameters,
+                                see mol_on_lidar_alt_calibrated()
+        yields a dict of arrays averaged on navg for each chunk, including
+        idx = (i0, i1), the range of profiles read in the file.
+        Concatenating the chunks gives the same arrays as reading the whole orbit:
+        the moving calibration window uses the profiles of neighbouring chunks.
+        Example:
+            for chunk in c.iter_chunks(navg=30, variables=('coords', 'scattering_ratio')):
+                sr = chunk['scattering_ratio']
+                ...
+        """
+        navg = max(navg, 1)
+        nblocks = self.nprof() // navg
+        chunk_blocks = max(chunk_profiles // navg, 1)
+        alt, metalt = self.lidar_alt, self.met_alt
+
+        calibrated = 'scattering_ratio' in variables or 'mol_on_lidar_alt_calibrated' in variables
+        # calibration profiles of the blocks [b0, b1[, kept from one chunk to the next
+        b0 = b1 = 0
+        calib = None
+
+        for j0 in range(0, nblocks, chunk_blocks):
+            j1 = min(j0 + chunk_blocks, nblocks)
+            idx = (j0 * navg, j1 * navg)
+            chunk = dict(idx=idx)
+
+            for name in variables:
+                if name in ('scattering_ratio', 'mol_on_lidar_alt_calibrated'):
+                    continue
+                if name == 'coords':
+                    chunk['lon'], chunk['lat'] = self.coords(navg=navg, idx=idx)
+                elif name in _alt_range_variables:
+                    chunk[name] = getattr(self, name)(navg=navg, idx=idx, alt_range=alt_range)
+                else:
+                    chunk[name] = getattr(self, name)(navg=navg, idx=idx)
+
+            if calibrated:
+                # the moving window needs navgh blocks on each side of the chunk
+                c0, c1 = max(j0 - navgh, 0), min(j1 + navgh, nblocks)
+                if c1 > b1:
+                    new = self._read_calibration_profiles(navg, (b1 * navg, c1 * navg),
+                                                          alt, metalt, zcal)
+                    calib = new if calib is None else [np.r_[old, n] for old, n in zip(calib, new)]
+                    b1 = c1
+                calib = [p[c0 - b0:] for p in calib]
+                b0 = c0
+                coef = _calibration_coef(calib[0], calib[1], calib[2], navgh, centered)
+                coef = coef[j0 - b0:j1 - b0]
+
+                mol = self.mol_on_lidar_alt(navg=navg, alt=alt, metalt=metalt, idx=idx,
+                                            alt_range=alt_range)
+                mol = mol.T
+                mol *= coef
+                mol = mol.T
+                if 'mol_on_lidar_alt_calibrated' in variables:
+                    chunk['mol_on_lidar_alt_calibrated'] = mol
+                if 'scattering_ratio' in variables:
+                    atb = chunk.get('atb')
+                    if atb is None:
+                        atb = self.atb(navg=navg, idx=idx, alt_range=alt_range)
+                    chunk['scattering_ratio'] = atb / mol
+
+            yield chunk
+
+    def _read_calibration_profiles(self, navg, idx, alt, metalt, zcal):
+        # calibration profiles of profiles idx=(i0, i1), only reading the zcal altitudes
+        mol = self.mol_on_lidar_alt(navg=navg, alt=alt, metalt=metalt, idx=idx, alt_range=zcal)
+        atb = self.atb(navg=navg, idx=idx, alt_range=zcal)
+        return self._calibration_profiles(atb, mol, self._alt_subset(alt, zcal), zcal[0], zcal[1])
+
     def tropopause_height(self, navg=30, idx=None):
         """
         Reads the ancillary tropopause height, in km, from the CALIOP file.
@@ -563,7 +789,8 @@ class Cal1(_Cal):
         else:
             maxtime = mdates.date2num(maxtime)
 
-        tropo = self.tropopause_height(navg=navg)
+        atb = atb.copy()
+        tropo = self.tropopause_height(navg=navg).copy()
         tropo[tropo > 13] = 11
         for i, z in enumerate(tropo):
             # I don't remember why this exists
@@ -629,3 +856,41 @@ class Cal1(_Cal):
         self._peek(lat, lidar_alt, cr, latrange,
                    'Volumic Color Ratio', 0.2, 1.)  # , cmap=get_cmap('jet'))
 
+    # lazy attributes
+
+    @property
+    def lidar_alt(self):
+        """
+        CALIOP altitude levels, read from the file metadata on first access
+        """
+        if self._lidar_alt is None:
+            self._load_altitudes()
+        return self._lidar_alt
+
+    @lidar_alt.setter
+    def lidar_alt(self, alt):
+        self._lidar_alt = alt
+
+    @property
+    def met_alt(self):
+        """
+        Altitude levels of ancillary met data, read from the file metadata on first access
+        """
+        if self._met_alt is None:
+            self._load_altitudes()
+        return self._met_alt
+
+    @met_alt.setter
+    def met_alt(self, alt):
+        self._met_alt = alt
+
+    @property
+    def valid_rms_profiles(self):
+        """
+        Profiles with a parallel RMS baseline below max_rms, if max_rms was given
+        at file opening, None otherwise. Computed on first access.
+        """
+        if self._valid_rms_profiles is None and self.max_rms is not None:
+            rms = self._read_sds('Parallel_RMS_Baseline_532')
+            self._valid_rms_profiles = (rms < self.max_rms)
+        return self._valid_rms_profiles
@@ -9,8 +9,23 @@ LMD/CNRS
 """
 
 import numpy as np
-import datetime
-from calipso_hdf import _Cal
+from pyhdf.SD import HDF4Error
+from calipso_hdf import _Cal, _decode_fcf
+from timeutils import tai93_to_datetime64, caliop_utc_to_datetime64
+from arraydict import ArrayDict
+
+
+# columns of layer_table() read from [nprof, nlaymax] variables
+_layer_columns = (('base', 'Layer_Base_Altitude'), ('top', 'Layer_Top_Altitude'),
+                  ('pbase', 'Layer_Base_Pressure'), ('ptop', 'Layer_Top_Pressure'),
+                  ('midlayer_temperature', 'Midlayer_Temperature'),
+                  ('opacity', 'Opacity_Flag'),
+                  ('od', 'Feature_Optical_Depth_532'),
+                  ('iatb532', 'Integrated_Attenuated_Backscatter_532'),
+                  ('ivdp', 'Integrated_Volume_Depolarization_Ratio'),
+                  ('ipdp', 'Integrated_Particulate_Depolarization_Ratio'),
+                  ('icr', 'Integrated_Attenuated_Total_Color_Ratio'),
+                  ('ipcr', 'Integrated_Particulate_Color_Ratio'))
 
 
 class Cal2(_Cal):
@@ -27,18 +42,42 @@ class Cal2(_Cal):
         ...
         c.close()
         
+    With cache_size (in bytes), arrays read from the file are kept in memory,
+    so the layer_type(), phase()... accessors read the feature classification
+    flags only once.
+    With dtype (e.g. 'float64'), floating point variables are converted
+    to this type, otherwise they keep their type in the file.
+        
     """
 
-    def __init__(self, filename):
-        _Cal.__init__(self, filename)
-        lat = self._read_var('Latitude')
-        # identify 333m or more level 2 files
-        if lat.shape[1] == 1:
-            self.havg = 0.333
-            self.iavg = 0
-        else:
-            self.havg = 5.
-            self.iavg = 1
+    def __init__(self, filename, cache_size=None, dtype=None):
+        _Cal.__init__(self, filename, cache_size=cache_size, dtype=dtype)
+        self._havg = None
+        # last decoded feature classification flags, as (idx, flags)
+        self._feature_flags = None
+
+    @property
+    def havg(self):
+        """
+        horizontal resolution of the file in km, 0.333 or 5.
+        """
+        if self._havg is None:
+            # identify 333m or more level 2 files from the shape of Latitude,
+            # [nprof, 1] for 333m files, [nprof, 3] otherwise
+            if self.sds_shape('Latitude')[1] == 1:
+                self._havg = 0.333
+            else:
+                self._havg = 5.
+        return self._havg
+
+    @property
+    def iavg(self):
+        """
+        index of the profile-average value in level 2 [nprof, 3] vectors
+        """
+        if self.havg < 1.:
+            return 0
+        return 1
 
     def coords(self, idx=None):
         """
@@ -91,47 +130,15 @@ class Cal2(_Cal):
 
     def datetime(self, idx=None):
         """
-        Returns an array of datetime objects based on utc_time values
+        Returns profile times as a datetime64[ns] array, based on time values
         """
-        time = self.time(navg=navg)
-        datetimes = netCDF4.num2date(time, units='seconds since 1993-01-01')
-        return np.array(datetimes)
+        return tai93_to_datetime64(self.time(idx=idx))
 
     def datetime2(self, idx=None):
         """
-        Returns an array of datetime objects based on utc_time values
-        this version is 5 times faster than the datetime function above. 
-        Is it worth it ? not sure.
+        Returns profile times as a datetime64[ns] array, based on utc_time values
         """
-
-        def _decdate_to_ymd(decdate):
-
-            year = np.floor(decdate / 10000.)
-            remainder = decdate - year * 10000
-            month = np.floor(remainder / 100.)
-            day = np.floor(remainder - month * 100)
-
-            return year + 2000, month, day
-
-        utc = self.utc_time(idx=idx)
-        seconds_into_day = ((utc - np.floor(utc)) * 24. * 3600.)
-
-        # first let's check if the orbit spans more than a single date
-        y0, m0, d0 = _decdate_to_ymd(utc[0])
-        y1, m1, d1 = _decdate_to_ymd(utc[-1])
-        if d0 == d1:
-            # orbit spans a single date
-            # we can be a little faster
-            datetimes = np.array(datetime.datetime(int(y0), int(m0), int(d0), 0, 0, 0)) + np.array(
-                [datetime.timedelta(seconds=int(ss)) for ss in seconds_into_day])
-        else:
-            # orbits spans more than a day, we have to compute everything
-            print('multi date', y0, m0, d0, y1, m1, d1)
-            y, m, d = _decdate_to_ymd(utc)
-            datetimes = [datetime.datetime(int(yy), int(mm), int(dd), 0, 0, 0) + datetime.timedelta(seconds=int(ss)) for
-                         yy, mm, dd, ss in zip(y, m, d, seconds_into_day)]
-
-        return np.array(datetimes)
+        return caliop_utc_to_datetime64(self.utc_time(idx=idx))
 
     def statistics_532(self):
 
@@ -242,6 +249,30 @@ class Cal2(_Cal):
         """
         return self._read_var('Feature_Classification_Flags', idx=idx)
 
+    def feature_flags(self, idx=None):
+        """
+        Decodes the feature classification flags by layer, reading them only once.
+        returns a dict of uint8 arrays, shape [nprof, nlaymax]:
+            type, type_qa, phase, phase_qa, subtype, subtype_qa, horizontal_averaging
+        see layer_type(), phase()... for the meaning of values.
+        The result is kept until flags are decoded for another idx,
+        its arrays are read-only. layer_type(), phase()... return writable copies.
+        Example:
+            flags = c.feature_flags()
+            ice = (flags['type'] == 2) & (flags['phase'] == 1)
+        """
+        key = None if idx is None else tuple(idx)
+        if self._feature_flags is None or self._feature_flags[0] != key:
+            flags = _decode_fcf(self.flag(idx=idx))
+            for v in flags.values():
+                v.flags.writeable = False
+            self._feature_flags = (key, flags)
+        return self._feature_flags[1]
+
+    def _flag_field(self, field, idx=None):
+        # writable copy of a decoded field, with the integer type of the flags in the file
+        return self.feature_flags(idx=idx)[field].astype('uint16')
+
     def layer_type(self, idx=None):
         """
         Returns the layer type from the feature classification flag
@@ -257,10 +288,8 @@ class Cal2(_Cal):
         7 = no signal (totally attenuated)
         
         """
-        f = self.flag(idx=idx)
         # type flag : bits 1 to 3
-        typeflag = (f & 7)
-        return typeflag
+        return self._flag_field('type', idx=idx)
 
     def layer_subtype(self, idx=None):
         """
@@ -277,10 +306,8 @@ class Cal2(_Cal):
         6 = cirrus (transparent)
         7 = deep convective (opaque)
         """
-        f = self.flag(idx=idx)
         # subtype flag : bits 10 to 12
-        subtype = (f & 3584) >> 9
-        return subtype
+        return self._flag_field('subtype', idx=idx)
 
     def layer_type_qa(self, idx=None):
         """
@@ -288,9 +315,8 @@ class Cal2(_Cal):
         feature classification flag
         shape [nprof, nlaymax]
         """
-        f = self.flag(idx=idx)
-        typeflag_qa = (f & 24) >> 3
-        return typeflag_qa
+        # bits 4 to 5
+        return self._flag_field('type_qa', idx=idx)
 
     def phase(self, idx=None):
         """
@@ -302,10 +328,8 @@ class Cal2(_Cal):
         2 = water
         3 = horizontally oriented ice
         """
-        f = self.flag(idx=idx)
         # 96 = 0b1100000, bits 6 to 7
-        cloudflag = (f & 96) >> 5
-        return cloudflag
+        return self._flag_field('phase', idx=idx)
 
     def phase_qa(self, idx=None):
         """
@@ -317,10 +341,52 @@ class Cal2(_Cal):
         1 = low
         2 = medium 3 = high
         """
-
-        f = self.flag(idx=idx)
-        cloudflag_qa = (f & 384) >> 7
-        return cloudflag_qa
+        # bits 8 to 9
+        return self._flag_field('phase_qa', idx=idx)
+
+    def layer_table(self, idx=None, where=None):
+        """
+        Returns the layers found in the file as flat columns, one item per layer,
+        instead of [nprof, nlaymax] arrays mostly filled with missing values.
+        Columns:
+            profile, rank = profile index and layer number in the profile
+            lon, lat, time = profile coordinates and time
+            base, top, pbase, ptop, midlayer_temperature, opacity,
+            od, iatb532, ivdp, ipdp, icr, ipcr = layer properties,
+                (only those present in the file, e.g. no od in 333m files)
+            type, type_qa, phase, phase_qa, subtype, subtype_qa,
+            horizontal_averaging = decoded feature classification flags
+        where = function of the table returning a boolean vector,
+                to only keep some layers
+        returns an ArrayDict
+        Example:
+            cirrus = c.layer_table(where=lambda t: (t['type'] == 2) & (t['phase'] == 1) & (t['top'] > 8))
+            od = cirrus['od']
+        """
+        nl = self.layers_number(idx=idx)
+        flags = self.feature_flags(idx=idx)
+        nlaymax = flags['type'].shape[1]
+        valid = np.arange(nlaymax) < nl[:, np.newaxis]
+        profile, rank = np.nonzero(valid)
+
+        table = ArrayDict(profile=profile, rank=rank)
+        lon, lat = self.coords(idx=idx)
+        table['lon'], table['lat'] = lon[profile], lat[profile]
+        table['time'] = self.time(idx=idx)[profile]
+        for name, var in _layer_columns:
+            try:
+                data = self._read_var(var, idx=idx)
+            except HDF4Error:
+                continue
+            table[name] = data[valid]
+        for name in flags:
+            table[name] = flags[name][valid]
+        if idx is not None:
+            table['profile'] += idx[0]
+
+        if where is not None:
+            table.subset(np.asarray(where(table), dtype=bool))
+        return table
 
     def opacity_flag(self, idx=None):
         """
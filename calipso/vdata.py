@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+"""
+Minimal reader for HDF4 vdata tables, e.g. the metadata vdata in CALIOP files.
+
+Reading vdata fields through pyhdf.VS segfaults, and the hdp command-line
+tool needs one process per file. This module parses the HDF4 data descriptors
+directly, which only takes a few small reads per file.
+
+example use:
+
+    from calipso.vdata import read_vdata
+
+    meta = read_vdata('CAL_LID_L1-ValStage1-V3-01.2010-02-05T01-47-40ZN.hdf', 'metadata')
+    alt = meta['Lidar_Data_Altitudes']
+
+V. Noel 2008-2014
+LMD/CNRS
+"""
+
+import struct
+import numpy as np
+
+
+_hdf_magic = b'\x0e\x03\x13\x01'
+
+# HDF4 tags
+_tag_null = 1
+_tag_vh = 1962      # vdata header
+_tag_vs = 1963      # vdata storage
+_tag_special = 0x4000
+
+# HDF4 number types -> numpy types (HDF4 stores numbers big-endian)
+_number_types = {3: 'u1', 4: 'S1', 5: '>f4', 6: '>f8', 20: 'i1', 21: 'u1',
+                 22: '>i2', 23: '>u2', 24: '>i4', 25: '>u4'}
+_native_flag = 0x1000
+_little_endian_flag = 0x4000
+
+# vdata interlace modes
+_full_interlace = 0
+
+
+def _read_dds(f):
+    """
+    reads the data descriptor blocks of an open HDF4 file
+    returns a list of (tag, ref, offset, length)
+    """
+
+    if f.read(4) != _hdf_magic:
+        raise IOError('%s is not an HDF4 file' % f.name)
+
+    dds = []
+    offset = 4
+    while offset:
+        f.seek(offset)
+        ndds, offset = struct.unpack('>hi', f.read(6))
+        block = np.frombuffer(f.read(12 * ndds), dtype=[('tag', '>u2'), ('ref', '>u2'),
+                                                         ('offset', '>i4'), ('length', '>i4')])
+        dds.extend(block[block['tag'] != _tag_null].tolist())
+    return dds
+
+
+def _numpy_type(hdftype):
+    little_endian = hdftype & _little_endian_flag
+    dtype = np.dtype(_number_types[hdftype & ~(_native_flag | _little_endian_flag)])
+    if little_endian:
+        dtype = dtype.newbyteorder('<')
+    return dtype
+
+
+def _parse_vh(buf):
+    """
+    parses a vdata header
+    returns a dict with the vdata name, number of records, interlace mode
+    and its fields as (name, numpy type, order, size in bytes)
+    """
+
+    interlace, nrec, recsize, nfields = struct.unpack('>hiHh', buf[:10])
+    pos = 10
+    info = np.frombuffer(buf[pos:pos + 8 * nfields], dtype='>u2').reshape(4, nfields)
+    pos += 8 * nfields
+    types, sizes, orders = info[0], info[1], info[3]
+
+    def _string(pos):
+        n = struct.unpack('>h', buf[pos:pos + 2])[0]
+        return buf[pos + 2:pos + 2 + n].decode('ascii'), pos + 2 + n
+
+    names = []
+    for i in range(nfields):
+        name, pos = _string(pos)
+        names.append(name)
+    vdname, pos = _string(pos)
+
+    fields = [(name, _numpy_type(int(t)), int(order), int(size))
+              for name, t, order, size in zip(names, types, orders, sizes)]
+    return dict(name=vdname, nrec=nrec, recsize=recsize, interlace=interlace, fields=fields)
+
+
+def _parse_vs(buf, vh):
+    """
+    splits vdata storage into fields
+    returns a dict of arrays, shape [nrec, order] (or [nrec] if order is 1).
+    character fields are returned as strings, one per record.
+    """
+
+    nrec = vh['nrec']
+    data = dict()
+    pos = 0
+    for name, dtype, order, size in vh['fields']:
+        if vh['interlace'] == _full_interlace:
+            # records one after the other, fields inside the record
+            raw = np.frombuffer(buf, dtype='u1', count=nrec * vh['recsize']).reshape(nrec, vh['recsize'])
+            raw = np.ascontiguousarray(raw[:, pos:pos + size])
+            pos += size
+        else:
+            # all values of a field, then the next field
+            raw = np.frombuffer(buf, dtype='u1', count=nrec * size, offset=pos).reshape(nrec, size)
+            pos += nrec * size
+        if dtype.kind == 'S':
+            values = [r.tobytes().rstrip(b'\x00').decode('ascii', 'replace') for r in raw]
+        else:
+            values = raw.view(dtype).astype(dtype.newbyteorder('='))
+            if order == 1:
+                values = values[:, 0]
+        data[name] = values
+    return data
+
+
+def list_vdata(filename):
+    """
+    returns the names of vdata tables in an HDF4 file
+    """
+
+    with open(filename, 'rb') as f:
+        names = []
+        for tag, ref, offset, length in _read_dds(f):
+            if tag == _tag_vh:
+                f.seek(offset)
+                names.append(_parse_vh(f.read(length))['name'])
+    return names
+
+
+def read_vdata(filename, name):
+    """
+    reads all the fields of a vdata table in an HDF4 file.
+    returns a dict of arrays, shape [nrec, order] for each field,
+    shape [order] for single-record vdatas like the CALIOP metadata.
+    Raises IOError if the file is not an HDF4 file,
+    KeyError if there is no vdata table with this name.
+    """
+
+    with open(filename, 'rb') as f:
+        dds = _read_dds(f)
+        vh = None
+        for tag, ref, offset, length in dds:
+            if tag == _tag_vh:
+                f.seek(offset)
+                vh = _parse_vh(f.read(length))
+                if vh['name'] == name:
+                    vsref = ref
+                    break
+                vh = None
+        if vh is None:
+            raise KeyError('No vdata named %s in %s' % (name, filename))
+
+        for tag, ref, offset, length in dds:
+            if ref != vsref:
+                continue
+            if tag == _tag_vs:
+                f.seek(offset)
+                buf = f.read(length)
+                break
+            if tag == (_tag_vs | _tag_special):
+                raise IOError('Linked or compressed vdata storage is not supported (%s)' % name)
+        else:
+            raise IOError('No storage for vdata %s in %s' % (name, filename))
+
+    data = _parse_vs(buf, vh)
+    if vh['nrec'] == 1:
+        for field in data:
+            data[field] = data[field][0]
+    return data
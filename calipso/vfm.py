@@ -3,7 +3,41 @@
 
 # Created by VNoel 2014-05-16 12:40
 
-from calipso_hdf import _Cal
+import os
+import numpy as np
+from calipso_hdf import _Cal, _decode_fcf
+from timeutils import tai93_to_datetime64
+
+
+# altitude regions of a VFM record, from top to bottom:
+# (number of 333m profiles per region profile, number of bins, top altitude, bin size in km)
+# one record covers 15 profiles at 333m (5 km) in 5515 values.
+_vfm_regions = ((5, 55, 30.1, 0.18),   # 20.2-30.1 km, 1665 m x 180 m, 3 profiles
+                (3, 200, 20.2, 0.06),  # 8.2-20.2 km, 1 km x 60 m, 5 profiles
+                (1, 290, 8.2, 0.03))   # -0.5-8.2 km, 333 m x 30 m, 15 profiles
+_vfm_nprof = 15
+_vfm_record_size = 5515
+
+
+def _vfm_index_map():
+    """
+    precomputes the position in a VFM record of each point of the 333m grid
+    returns index [15, nz] and the altitude of bin centers [nz], from top to bottom
+    """
+    index, altitude = [], []
+    offset = 0
+    p = np.arange(_vfm_nprof)
+    for nprof_region, nbins, top, dz in _vfm_regions:
+        # values of one region profile are contiguous, profile after profile
+        k = np.arange(nbins)
+        index.append(offset + (p // nprof_region)[:, np.newaxis] * nbins + k)
+        altitude.append(top - dz * (k + 0.5))
+        offset += (_vfm_nprof // nprof_region) * nbins
+    assert offset == _vfm_record_size
+    return np.hstack(index), np.concatenate(altitude)
+
+
+_vfm_index, vfm_altitude = _vfm_index_map()
 
 class VFM(_Cal):
     """
@@ -16,6 +50,8 @@ class VFM(_Cal):
     >>> time = vfm.time()
     >>> lon, lat = vfm.coords()
     >>> flags = vfm.flags()
+    >>> grid = vfm.grid()
+    >>> cloud = grid['type'] == 2
         ...
     >>> vfm.close()
     """
@@ -33,6 +69,10 @@ class VFM(_Cal):
         
         time = self._read_var('Profile_UTC_Time')[:,0]
         return time
+
+    def datetimes(self):
+        
+        return tai93_to_datetime64(self.time())
     
     def coords(self):
         
@@ -58,6 +98,59 @@ class VFM(_Cal):
         
         flags = self._read_var('Feature_Classification_Flags')[:,:]
         return flags
+
+    def nprof_333m(self):
+        
+        return self.nprof() * _vfm_nprof
+
+    def altitude(self):
+        '''
+        altitude of the vertical bins of grid(), in km, from top to bottom
+        shape [nz=545]
+        '''
+        return vfm_altitude
+
+    def grid(self, fields=('type', 'type_qa', 'phase', 'phase_qa'), out=None, chunk_records=500):
+        '''
+        Decodes the Feature_Classification_Flags records on a regular 333m grid,
+        shape [nprof*15, nz=545]. Values in the upper altitude regions,
+        coarser horizontally, are repeated on the 333m profiles they cover.
+        Vertical levels are given by altitude().
+        fields = decoded fields, among type, type_qa, phase, phase_qa,
+                 subtype, subtype_qa, horizontal_averaging (cf Cal2.feature_flags)
+        out = None to decode in memory,
+              a directory name to decode in memory-mapped .npy files
+              (one per field, named after the granule),
+              or a dict of preallocated arrays [nprof*15, 545] by field,
+              e.g. slices of a memmap holding a whole day.
+        records are decoded chunk_records at a time, so with memory-mapped
+        output only one chunk is in memory.
+        returns a dict of uint8 arrays by field
+        '''
+        
+        nrec = self.nprof()
+        shape = (nrec * _vfm_nprof, vfm_altitude.size)
+        if out is None:
+            out = dict((field, np.empty(shape, dtype='uint8')) for field in fields)
+        elif not isinstance(out, dict):
+            outdir = out
+            out = dict()
+            for field in fields:
+                filename = os.path.join(outdir, 'VFM_%s_%s.npy' % (self.id, field))
+                out[field] = np.lib.format.open_memmap(filename, mode='w+', dtype='uint8', shape=shape)
+        
+        for i0 in range(0, nrec, chunk_records):
+            i1 = min(nrec, i0 + chunk_records)
+            records = self._read_var('Feature_Classification_Flags', idx=(i0, i1))
+            f = records[:, _vfm_index].reshape(-1, vfm_altitude.size)
+            decoded = _decode_fcf(f, fields=fields)
+            for field in fields:
+                out[field][i0 * _vfm_nprof:i1 * _vfm_nprof] = decoded[field]
+        
+        for field in fields:
+            if isinstance(out[field], np.memmap):
+                out[field].flush()
+        return out
     
     
 def test_read():
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+'''
+Process many CALIOP orbit files in parallel.
+
+Each orbit is opened in a worker process, handed to a user function that
+extracts what it needs, and closed. Results are streamed back, and can be
+merged into an ArrayDict.
+
+example use:
+
+    import calipso_local
+    import calipso_batch
+
+    def extract(c):
+        lon, lat = c.coords(navg=30)
+        atb = c.atb(navg=30)
+        idx = (lat > -80) & (lat < -60)
+        return dict(lon=lon[idx], lat=lat[idx], atb=atb[idx, :])
+
+    files = calipso_local.l1_night_files(2008, 7, 1)
+    data, failed = calipso_batch.process_orbits(files, extract, nworkers=8)
+    data.save('night_20080701.npz')
+
+The extraction function is sent to worker processes, so it must be defined
+at module level (not a lambda or a nested function).
+'''
+
+import multiprocessing
+from arraydict import ArrayDict
+
+
+def _process_orbit(args):
+    '''
+    opens an orbit file, applies func on it, closes it.
+    errors are caught here so a bad file does not stop the whole batch.
+    returns filename, result, error message (or None)
+    '''
+
+    filename, func, reader, reader_kwargs = args
+    if reader is None:
+        from calipso import Cal1 as reader
+    try:
+        c = reader(filename, **reader_kwargs)
+    except Exception as e:
+        return filename, None, 'Cannot open file: %s' % e
+    try:
+        result = func(c)
+    except Exception as e:
+        return filename, None, '%s: %s' % (type(e).__name__, e)
+    finally:
+        c.close()
+    return filename, result, None
+
+
+def iter_orbits(files, func, nworkers=1, ordered=True, reader=None, **reader_kwargs):
+    '''
+    Applies func on each orbit file, using nworkers processes.
+    files = list of CALIOP files
+    func = function called as func(c), with c the opened file object
+    nworkers = number of worker processes. 1 means no pool, useful for debugging.
+    ordered = if True, results come back in the order of files,
+              otherwise as soon as they are available
+    reader = class used to open files, Cal1 by default (e.g. Cal2)
+    other keyword arguments are passed to the reader, e.g. max_rms=150
+    yields (filename, result, error) tuples.
+    error is None if everything went fine, a message otherwise (and result is None).
+    '''
+
+    tasks = [(f, func, reader, reader_kwargs) for f in files]
+
+    if nworkers == 1 or len(tasks) < 2:
+        for task in tasks:
+            yield _process_orbit(task)
+        return
+
+    pool = multiprocessing.Pool(processes=nworkers)
+    try:
+        if ordered:
+            results = pool.imap(_process_orbit, tasks, chunksize=1)
+        else:
+            results = pool.imap_unordered(_process_orbit, tasks, chunksize=1)
+        for result in results:
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def process_orbits(files, func, nworkers=1, ordered=True, reader=None, verbose=True, **reader_kwargs):
+    '''
+    Applies func on each orbit file, using nworkers processes,
+    and merges the results in an ArrayDict.
+    func must return a dict of arrays (or an ArrayDict), or None to skip an orbit.
+    Arrays are concatenated along their first dimension.
+    returns data, failed
+        data = ArrayDict with merged results
+        failed = list of (filename, error message) for files that could not be processed
+    '''
+
+    data = ArrayDict()
+    failed = []
+    for filename, result, error in iter_orbits(files, func, nworkers=nworkers, ordered=ordered,
+                                               reader=reader, **reader_kwargs):
+        if error is not None:
+            if verbose:
+                print('Skipping %s - %s' % (filename, error))
+            failed.append((filename, error))
+            continue
+        if result is None:
+            continue
+        if not isinstance(result, ArrayDict):
+            result = ArrayDict(**result)
+        data.append(result)
+
+    if verbose:
+        print('Processed %d files, %d failed' % (len(files) - len(failed), len(failed)))
+    return data, failed
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+'''
+Catalogue of the local CALIOP archive, stored in an SQLite file.
+
+One row per granule, with product, version, start and end time,
+day/night, number of profiles and lat/lon bounds. Rescans only list
+the day directories that changed since the last scan, and queries
+return the newest version of each granule (v3.30 > v3.02 > v3.01).
+
+example use:
+
+    import calipso_catalog
+
+    cat = calipso_catalog.Catalog()
+    cat.scan()
+    files = cat.query('CAL_LID_L1', start='2008-01-01', end='2009-01-01',
+                      night=True, latrange=(-90, -60))
+    cat.close()
+
+The first scan opens every granule to read its time and coordinates,
+which takes a while. Later scans only open new files.
+
+The catalogue also indexes the ground track of each granule, as ranges
+of consecutive profiles in cells of 1x1 degrees. Profile ranges inside a region
+can then be read without opening other orbits, or reading other profiles:
+
+    for filename, i0, i1 in cat.track_ranges(latrange=(-90, -60), lonrange=(-60, 0),
+                                             start='2008-07-01', end='2008-08-01'):
+        c = Cal1(filename)
+        lon, lat = c.coords(navg=1, idx=(i0, i1))
+        atb = c.atb(navg=1, idx=(i0, i1))
+
+V. Noel - LMD/CNRS
+'''
+
+import os
+import glob
+import sqlite3
+import datetime
+import numpy as np
+from pyhdf.SD import SD, SDC, HDF4Error
+import localpaths
+from timeutils import tai93_to_datetime64
+
+default_catalog = os.path.join(os.path.expanduser('~'), '.calipso_catalog.sqlite')
+
+# localpaths roots holding CALIOP granules
+_roots = ('l1dir', 'l2dir', 'l2dir_333', 'l2adir')
+
+_schema = '''
+create table if not exists granules (
+    id integer primary key,
+    path text unique,
+    kind text,          -- product without maturity and version, e.g. CAL_LID_L1
+    product text,       -- e.g. CAL_LID_L1-ValStage1-V3-30
+    version integer,    -- e.g. 330 for V3-30
+    orbit text,         -- e.g. 2013-04-07T10-26-26ZN
+    night integer,
+    start text,         -- ISO date of the first and last profiles
+    end text,
+    nprof integer,
+    latmin real, latmax real, lonmin real, lonmax real
+);
+create index if not exists granules_kind_start on granules (kind, start);
+create index if not exists granules_kind_orbit on granules (kind, orbit);
+create table if not exists tracks (
+    granule integer,    -- id in granules
+    cell integer,       -- index of the lat/lon cell, see _cells()
+    i0 integer,         -- profiles i0 to i1 (excluded) are in this cell
+    i1 integer
+);
+create index if not exists tracks_cell on tracks (cell);
+create index if not exists tracks_granule on tracks (granule);
+create table if not exists dirs (
+    path text primary key,
+    mtime real
+);
+'''
+
+
+def _product_info(filename):
+    '''
+    kind, product, version and orbit from a CALIOP granule name, e.g.
+    CAL_LID_L2_05kmCLay-Prov-V3-02.2012-01-01T10-04-03ZN.hdf
+    -> CAL_LID_L2_05kmCLay, CAL_LID_L2_05kmCLay-Prov-V3-02, 302, 2012-01-01T10-04-03ZN
+    '''
+    basename = os.path.basename(filename)
+    product = basename[:-26]
+    orbit = basename[-25:-4]
+    kind = product.split('-')[0]
+    version = int(product[-4] + product[-2:])
+    return kind, product, version, orbit
+
+
+def _isodate(d):
+    # dates are stored as ISO strings, they sort like dates
+    if d is None or isinstance(d, str):
+        return d
+    if isinstance(d, np.datetime64):
+        return str(d.astype('datetime64[s]'))
+    return d.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _read_coords(hdf):
+    # profile coordinates, the middle value for L2 [nprof, 3] vectors
+    lat = hdf.select('Latitude')[:]
+    lon = hdf.select('Longitude')[:]
+    i = 1 if lat.shape[1] == 3 else 0
+    return lon[:, i], lat[:, i]
+
+
+def _granule_info(filename):
+    '''
+    reads time and coordinates of a granule
+    returns (start, end, nprof, latmin, latmax, lonmin, lonmax), lon, lat
+    '''
+    hdf = SD(filename, SDC.READ)
+    try:
+        time = hdf.select('Profile_Time')[:]
+        lon, lat = _read_coords(hdf)
+    finally:
+        hdf.end()
+    start, end = tai93_to_datetime64(time[[0, -1], 0])
+    ok = (lat > -999) & (lon > -999)
+    info = (_isodate(start), _isodate(end), time.shape[0],
+            float(lat[ok].min()), float(lat[ok].max()), float(lon[ok].min()), float(lon[ok].max()))
+    return info, lon, lat
+
+
+# size of ground track cells, in degrees
+_cell_size = 1.
+_ncell_lon = int(360 / _cell_size)
+
+
+def _cells(lon, lat):
+    '''
+    index of the lat/lon cell containing each point, -1 for missing coordinates
+    '''
+    ilat = np.floor((np.clip(lat, -90, 89.999) + 90) / _cell_size).astype('int64')
+    ilon = np.floor((np.mod(lon + 180, 360)) / _cell_size).astype('int64')
+    ilon = np.minimum(ilon, _ncell_lon - 1)
+    cells = ilat * _ncell_lon + ilon
+    cells[(lat < -999) | (lon < -999)] = -1
+    return cells
+
+
+def _track_runs(lon, lat):
+    '''
+    cuts a ground track in runs of consecutive profiles in the same cell
+    returns cell, i0, i1 vectors, profiles i0 to i1 (excluded) being in cell
+    '''
+    cells = _cells(lon, lat)
+    starts = np.r_[0, np.flatnonzero(np.diff(cells)) + 1]
+    ends = np.r_[starts[1:], cells.size]
+    cells = cells[starts]
+    ok = cells >= 0
+    return cells[ok], starts[ok], ends[ok]
+
+
+def _box_cells(latrange, lonrange):
+    '''
+    indexes of cells intersecting a lat/lon box.
+    lonrange can cross the dateline, e.g. (170, -170)
+    '''
+    lat0, lat1 = min(latrange), max(latrange)
+    ilat = np.arange(np.floor((lat0 + 90) / _cell_size), np.floor((min(lat1, 89.999) + 90) / _cell_size) + 1)
+    if lonrange is None:
+        ilon = np.arange(_ncell_lon)
+    else:
+        i0 = int(np.floor(np.mod(lonrange[0] + 180, 360) / _cell_size))
+        i1 = int(np.floor(np.mod(lonrange[1] + 180, 360) / _cell_size))
+        if lonrange[1] - lonrange[0] >= 360:
+            ilon = np.arange(_ncell_lon)
+        else:
+            ilon = np.mod(np.arange(i0, i1 + 1 if i1 >= i0 else i1 + _ncell_lon + 1), _ncell_lon)
+    return (ilat.astype('int64')[:, np.newaxis] * _ncell_lon + ilon).ravel()
+
+
+class Catalog(object):
+    '''
+    SQLite catalogue of CALIOP granules found under the localpaths directories
+    '''
+
+    def __init__(self, filename=default_catalog):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def scan(self, roots=None, verbose=True):
+        '''
+        adds new granules to the catalogue, removes those that disappeared.
+        roots = list of product directories, containing YYYY/YYYY_MM_DD/ folders.
+                By default, all the CALIOP directories in localpaths.
+        Day folders are only listed if their modification time changed
+        since the last scan. Granules of day folders that were removed are
+        removed too, unless their whole root directory is missing (e.g. an
+        unmounted disk).
+        returns the number of granules added
+        '''
+        if roots is None:
+            roots = []
+            for name in _roots:
+                roots.extend(getattr(localpaths, name, None) or [])
+
+        known = dict(self.db.execute('select path, mtime from dirs'))
+        nadded = 0
+        for root in roots:
+            daydirs = sorted(glob.glob(os.path.join(root, '[0-9]' * 4, '[0-9]' * 4 + '_*')))
+            for daydir in daydirs:
+                mtime = os.stat(daydir).st_mtime
+                if known.get(daydir) == mtime:
+                    continue
+                nadded += self._scan_dir(daydir, verbose=verbose)
+                self.db.execute('insert or replace into dirs values (?, ?)', (daydir, mtime))
+                self.db.commit()
+            if not os.path.isdir(root):
+                continue
+            # day folders removed since the last scan, none of their files is found
+            prefix = os.path.join(root, '')
+            for daydir in sorted(set(d for d in known if d.startswith(prefix)) - set(daydirs)):
+                self._scan_dir(daydir, verbose=verbose)
+                self.db.execute('delete from dirs where path = ?', (daydir,))
+                self.db.commit()
+        if verbose:
+            print('Added %d granules to %s' % (nadded, self.filename))
+        return nadded
+
+    def _scan_dir(self, daydir, verbose=True):
+        files = set(glob.glob(os.path.join(daydir, 'CAL_LID_*.hdf')))
+        prefix = os.path.join(daydir, '')
+        # not a like, _ in directory names would match any character
+        known = set(row[0] for row in
+                    self.db.execute('select path from granules where substr(path, 1, ?) = ?',
+                                    (len(prefix), prefix)))
+        for path in known - files:
+            self.db.execute('delete from tracks where granule in (select id from granules where path = ?)', (path,))
+            self.db.execute('delete from granules where path = ?', (path,))
+        nadded = 0
+        for path in sorted(files - known):
+            kind, product, version, orbit = _product_info(path)
+            try:
+                info, lon, lat = _granule_info(path)
+            except (HDF4Error, IndexError, ValueError) as e:
+                if verbose:
+                    print('Cannot read %s - %s' % (path, e))
+                # recorded anyway, so it is not opened again at each scan
+                date = datetime.datetime.strptime(orbit[:19], '%Y-%m-%dT%H-%M-%S')
+                info, lon, lat = (_isodate(date), _isodate(date), None, None, None, None, None), None, None
+            cursor = self.db.execute('insert into granules (path, kind, product, version, orbit, night, start, end, '
+                                     'nprof, latmin, latmax, lonmin, lonmax) values (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                                     (path, kind, product, version, orbit, orbit.endswith('ZN')) + info)
+            if lon is not None:
+                self._add_track(cursor.lastrowid, lon, lat)
+            nadded += 1
+        return nadded
+
+    def _add_track(self, granule, lon, lat):
+        cells, i0, i1 = _track_runs(lon, lat)
+        self.db.executemany('insert into tracks values (?, ?, ?, ?)',
+                            zip([granule] * cells.size, cells.tolist(), i0.tolist(), i1.tolist()))
+
+    def index_tracks(self, verbose=True):
+        '''
+        indexes the ground track of catalogued granules that have no track yet,
+        e.g. in catalogues built before tracks were indexed.
+        returns the number of granules indexed
+        '''
+        rows = self.db.execute('select id, path from granules where nprof is not null and id not in '
+                               '(select distinct granule from tracks)').fetchall()
+        for granule, path in rows:
+            try:
+                hdf = SD(path, SDC.READ)
+                try:
+                    lon, lat = _read_coords(hdf)
+                finally:
+                    hdf.end()
+            except HDF4Error as e:
+                if verbose:
+                    print('Cannot read %s - %s' % (path, e))
+                continue
+            self._add_track(granule, lon, lat)
+            self.db.commit()
+        return len(rows)
+
+    def query(self, kind='CAL_LID_L1', start=None, end=None, night=None,
+              latrange=None, lonrange=None, newest=True, columns='path'):
+        '''
+        returns granules matching all the criteria, sorted by time
+        kind = product, e.g. CAL_LID_L1, CAL_LID_L2_05kmCLay, CAL_LID_L2_333mCLay
+        start, end = time range (datetime or ISO string), granules overlapping it are returned
+        night = True for night granules, False for day granules, None for both
+        latrange, lonrange = (min, max), granules whose bounds intersect this box are returned
+        newest = if True, only the newest version of each granule is returned
+        columns = comma-separated columns of the granules table to return.
+                  if only one column is asked for, returns a list of values,
+                  otherwise a list of tuples. Raises ValueError for unknown columns.
+        Example:
+            files = cat.query(start=datetime(2008, 1, 1), end=datetime(2009, 1, 1),
+                              night=True, latrange=(-90, -60))
+        '''
+        names = [c.strip() for c in columns.split(',')]
+        known = [row[1] for row in self.db.execute('pragma table_info(granules)')]
+        for name in names:
+            if name not in known:
+                raise ValueError('Unknown column %r, not in %s' % (name, ', '.join(known)))
+
+        where = ['kind = ?']
+        args = [kind]
+        if start is not None:
+            where.append('end >= ?')
+            args.append(_isodate(start))
+        if end is not None:
+            where.append('start < ?')
+            args.append(_isodate(end))
+        if night is not None:
+            where.append('night = ?')
+            args.append(int(night))
+        if latrange is not None:
+            where.append('latmax >= ? and latmin <= ?')
+            args.extend([min(latrange), max(latrange)])
+        if lonrange is not None:
+            where.append('lonmax >= ? and lonmin <= ?')
+            args.extend([min(lonrange), max(lonrange)])
+        if newest:
+            where.append('version = (select max(version) from granules g '
+                         'where g.kind = granules.kind and g.orbit = granules.orbit)')
+
+        sql = 'select %s from granules where %s order by start' % (', '.join(names), ' and '.join(where))
+        rows = self.db.execute(sql, args).fetchall()
+        if len(names) == 1:
+            return [row[0] for row in rows]
+        return rows
+
+    def track_ranges(self, latrange, lonrange=None, kind='CAL_LID_L1', start=None, end=None,
+                     night=None, newest=True):
+        '''
+        finds the profiles of catalogued granules inside a lat/lon box.
+        latrange, lonrange = (min, max). lonrange can cross the dateline, e.g. (170, -170)
+        other arguments select granules, as in query()
+        returns a list of (filename, i0, i1), sorted by time: profiles i0 to i1 (excluded)
+        of the file cross the box, and can be read with idx=(i0, i1).
+        Ranges cover whole 1x1 degree cells, so profiles slightly outside the box
+        can be included, and should be filtered out from their coordinates.
+        Example:
+            for f, i0, i1 in cat.track_ranges((-90, -60), start='2008-01-01', end='2009-01-01'):
+                lon, lat = Cal1(f).coords(navg=1, idx=(i0, i1))
+        '''
+        cells = _box_cells(latrange, lonrange)
+        self.db.execute('create temp table if not exists query_cells (cell integer primary key)')
+        self.db.execute('delete from query_cells')
+        self.db.executemany('insert into query_cells values (?)', zip(cells.tolist()))
+
+        ids = self.query(kind=kind, start=start, end=end, night=night, latrange=latrange,
+                         newest=newest, columns='id, path, start')
+        order = dict((row[0], (row[2], row[1])) for row in ids)
+        rows = self.db.execute('select granule, i0, i1 from tracks join query_cells using (cell)').fetchall()
+
+        # merge ranges that touch within each granule
+        rows = sorted((order[g] + (i0, i1) for g, i0, i1 in rows if g in order))
+        ranges = []
+        for start, path, i0, i1 in rows:
+            if ranges and ranges[-1][0] == path and i0 <= ranges[-1][2]:
+                ranges[-1][2] = max(ranges[-1][2], i1)
+            else:
+                ranges.append([path, i0, i1])
+        return [tuple(r) for r in ranges]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+'''
+Collocation of CALTRACK GeoProf profiles with CALIOP profiles.
+
+Profiles are paired by time with a single searchsorted pass on sorted
+times, O(n log n), instead of looking for the nearest time profile by profile.
+Times must be in the same units, seconds since 1993-01-01 for CALIOP and CALTRACK.
+
+example use:
+
+    from caltrack.geoprof import GeoProf
+    from calipso import Cal2
+    from caltrack.collocation import collocate_geoprof
+
+    geo = GeoProf('CALTRACK-5km_CS-2B-GEOPROF_V1-00_2008-01-01T01-30-23ZN.hdf')
+    c = Cal2('CAL_LID_L2_05kmCLay-Prov-V3-01.2008-01-01T01-30-23ZN.hdf')
+    match = collocate_geoprof(geo, c, max_dt=1.)
+    cm = geo.cloudmask()[match['i1']]
+    nl = c.layers_number()[match['i2']]
+
+V. Noel - LMD/CNRS
+'''
+
+import os
+import glob
+import numpy as np
+from arraydict import ArrayDict
+
+# mean earth radius, km
+earth_radius = 6371.
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    '''
+    great circle distance in km between points, coordinates in degrees
+    '''
+    lon1, lat1, lon2, lat2 = [np.radians(x) for x in (lon1, lat1, lon2, lat2)]
+    a = np.sin((lat2 - lat1) / 2.) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return 2. * earth_radius * np.arcsin(np.sqrt(np.clip(a, 0., 1.)))
+
+
+def collocate(time1, time2, max_dt=1., lon1=None, lat1=None, lon2=None, lat2=None, max_distance=None):
+    '''
+    pairs each profile of a first set with the closest profile in time of a second set.
+    time1, time2 = profile times, in the same units (e.g. seconds), any order
+    max_dt = pairs further apart in time are dropped
+    lon1, lat1, lon2, lat2 = profile coordinates, if given the distance of pairs is computed
+    max_distance = pairs further apart (km) are dropped
+    returns an ArrayDict with
+        i1, i2 = indexes of paired profiles in each set
+        dt = time2[i2] - time1[i1]
+        distance = distance in km between paired profiles (if coordinates are given)
+    '''
+    time1 = np.asarray(time1, dtype='float64')
+    time2 = np.asarray(time2, dtype='float64')
+    order = np.argsort(time2, kind='mergesort')
+    t2 = time2[order]
+
+    # closest of the two neighbours in the sorted times
+    if t2.size < 2:
+        j = np.zeros(time1.size if t2.size else 0, dtype='int64')
+        time1 = time1[:j.size]
+    else:
+        j = np.clip(np.searchsorted(t2, time1), 1, t2.size - 1)
+        before = np.abs(time1 - t2[j - 1]) <= np.abs(t2[j] - time1)
+        j = np.where(before, j - 1, j)
+    dt = t2[j] - time1
+    ok = np.abs(dt) <= max_dt
+
+    match = ArrayDict(i1=np.flatnonzero(ok), i2=order[j[ok]], dt=dt[ok])
+    if lon1 is not None:
+        match['distance'] = _haversine(np.asarray(lon1)[match['i1']], np.asarray(lat1)[match['i1']],
+                                       np.asarray(lon2)[match['i2']], np.asarray(lat2)[match['i2']])
+        if max_distance is not None:
+            match.subset(match['distance'] <= max_distance)
+    return match
+
+
+def _profiles(obj, navg=None):
+    '''
+    time and coordinates of profiles of a GeoProf, Cal2 or Cal1 object,
+    averaged on navg profiles for Cal1
+    '''
+    if navg is not None:
+        time, (lon, lat) = obj.time(navg=navg), obj.coords(navg=navg)
+    else:
+        time, (lon, lat) = obj.time(), obj.coords()
+    return np.ravel(time), (np.ravel(lon), np.ravel(lat))
+
+
+def collocate_geoprof(geo, cal, max_dt=1., max_distance=None, navg=None):
+    '''
+    collocates GeoProf profiles with the profiles of a CALIOP file.
+    geo = GeoProf object
+    cal = Cal2 object, or Cal1 object with navg set, e.g. navg=15 for 5 km profiles
+    returns an ArrayDict with i1 (GeoProf profiles), i2 (CALIOP profiles), dt, distance,
+    see collocate()
+    '''
+    time1, (lon1, lat1) = _profiles(geo)
+    time2, (lon2, lat2) = _profiles(cal, navg=navg)
+    return collocate(time1, time2, max_dt=max_dt, lon1=lon1, lat1=lat1, lon2=lon2, lat2=lat2,
+                     max_distance=max_distance)
+
+
+def geoprof_files(y, m, d):
+    '''
+    returns the list of available CALTRACK GeoProf files for a date
+    raises IOError if localpaths has no caltrack_geoprof_dir for this host
+    '''
+    import localpaths
+    geodirs = getattr(localpaths, 'caltrack_geoprof_dir', None) or ()
+    if not geodirs:
+        raise IOError('No CALTRACK GeoProf directory on this host, set caltrack_geoprof_dir in localpaths')
+    files = []
+    for geodir in geodirs:
+        files.extend(glob.glob(os.path.join(geodir, '%04d/%04d_%02d_%02d/' % (y, y, m, d), '*.hdf')))
+    return sorted(files)
+
+
+def collocate_files(geofiles, calfiles, max_dt=1., max_distance=None, navg=None):
+    '''
+    collocates all the profiles of a list of GeoProf files with all the profiles of a
+    list of CALIOP files, e.g. a whole day, in a single pass.
+    navg = if given, CALIOP files are read with Cal1 averaged on navg profiles,
+           otherwise with Cal2.
+    returns an ArrayDict with
+        file1, i1 = index of the GeoProf file in geofiles, and profile in this file
+        file2, i2 = same for CALIOP files
+        dt, distance, see collocate()
+    '''
+    from geoprof import GeoProf
+    from calipso import Cal1, Cal2
+
+    def _read_all(files, reader, navg=None):
+        data = ArrayDict()
+        for ifile, f in enumerate(files):
+            obj = reader(f)
+            try:
+                time, (lon, lat) = _profiles(obj, navg=navg)
+            finally:
+                obj.close()
+            data.append(ArrayDict(time=time, lon=lon, lat=lat, ifile=np.zeros(len(time), 'int32') + ifile,
+                                  iprof=np.arange(len(time), dtype='int32')))
+        return data
+
+    geo = _read_all(geofiles, GeoProf)
+    if navg is None:
+        cal = _read_all(calfiles, Cal2)
+    else:
+        cal = _read_all(calfiles, Cal1, navg=navg)
+    if not geo or not cal:
+        return ArrayDict()
+
+    match = collocate(geo['time'], cal['time'], max_dt=max_dt, lon1=geo['lon'], lat1=geo['lat'],
+                      lon2=cal['lon'], lat2=cal['lat'], max_distance=max_distance)
+    return ArrayDict(file1=geo['ifile'][match['i1']], i1=geo['iprof'][match['i1']],
+                     file2=cal['ifile'][match['i2']], i2=cal['iprof'][match['i2']],
+                     dt=match['dt'], distance=match['distance'])
+
+
+def collocate_day(y, m, d, catalog=None, kind='CAL_LID_L2_05kmCLay', max_dt=1., max_distance=None, navg=None):
+    '''
+    collocates the GeoProf files of a day with the CALIOP files of the same day,
+    found in a calipso_catalog.Catalog (the default catalogue if None).
+    kind = CALIOP product, CAL_LID_L1 needs navg
+    returns geofiles, calfiles, match (see collocate_files)
+    '''
+    import datetime
+    import calipso_catalog
+    if catalog is None:
+        catalog = calipso_catalog.Catalog()
+    day = datetime.datetime(y, m, d)
+    geofiles = geoprof_files(y, m, d)
+    calfiles = catalog.query(kind=kind, start=day, end=day + datetime.timedelta(days=1))
+    match = collocate_files(geofiles, calfiles, max_dt=max_dt, max_distance=max_distance, navg=navg)
+    return geofiles, calfiles, match
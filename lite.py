@@ -15,7 +15,7 @@ Example usage:
 
     >>> import lite
     >>> l = lite.LITE('LITE_L1_19940910_164558_164706')
-    >>> print l.rawdata['latitude']
+    >>> print(l.rawdata['latitude'])
     >>> l.describe()
 
 The script can also be called on a LITE data file for quick checks:
@@ -43,7 +43,7 @@ Instead of a single value, a vector of calibration values can be passed (length
 '''
 
 import numpy as np
-from datetime import datetime, timedelta
+from timeutils import doy_to_datetime64
 
 header = np.dtype( [ 
                 ('syncvalue', '>i2'), 
@@ -185,7 +185,7 @@ class LITE(object):
     
     def __init__(self, filename, altitude_bottom_up=True):
         
-        fid = open(filename, 'r')
+        fid = open(filename, 'rb')
         self.rawdata = np.fromfile(fid, dtype=header, count=-1)
         fid.close()
         self.altitude = np.linspace(40, -4.985, 3000)
@@ -198,11 +198,10 @@ class LITE(object):
             for field in 'profile355', 'profile532', 'profile064':
                 self.rawdata[field] = self.rawdata[field][:,::-1]
 
-        self.datetimes = []
-        for i in np.r_[0:self.nprof]:
-            date = datetime(1994,1,1) + timedelta(days=self.rawdata['gmtday'][i]-1)
-            fulldate = datetime(date.year, date.month, date.day, self.rawdata['gmthour'][i], self.rawdata['gmtmin'][i], self.rawdata['gmtsec'][i], self.rawdata['gmthund'][i]*10000)
-            self.datetimes.append(fulldate)
+        # datetime64 array, LITE flew in 1994
+        self.datetimes = doy_to_datetime64(1994, self.rawdata['gmtday'], self.rawdata['gmthour'],
+                                           self.rawdata['gmtmin'], self.rawdata['gmtsec'],
+                                           self.rawdata['gmthund'].astype('int64') * 10000)
 
         self.atb = dict()
         self.atb[355] = None
@@ -253,15 +252,15 @@ class LITE(object):
                 
     def describe(self, prof=0):
     
-        print 'Number of profiles in file: ', self.nprof
-        print 'Profile : ', prof
-        print '\tVersion number: ', self.rawdata['majorversionnumber'][prof], self.rawdata['minorversionnumber'][prof]
-        print '\tOrbit number: ', self.rawdata['orbitnumber'][prof]
-        print '\tID number: ', self.rawdata['idnumber'][prof]
-        print '\tRaw Date: ', self.rawdata['gmtday'][prof], self.rawdata['gmthour'][prof], self.rawdata['gmtmin'][prof], self.rawdata['gmtsec'][prof], self.rawdata['gmthund'][prof]
-        print '\tDatetime: ', self.datetimes[prof]
-        print '\tMetDate: ', self.rawdata['metday'][prof], self.rawdata['methour'][prof], self.rawdata['metmin'][prof], self.rawdata['metsec'][prof], self.rawdata['methund'][prof]
-        print '\tlat, lon: ', self.rawdata['latitude'][prof], self.rawdata['longitude'][prof]
+        print('Number of profiles in file: ', self.nprof)
+        print('Profile : ', prof)
+        print('\tVersion number: ', self.rawdata['majorversionnumber'][prof], self.rawdata['minorversionnumber'][prof])
+        print('\tOrbit number: ', self.rawdata['orbitnumber'][prof])
+        print('\tID number: ', self.rawdata['idnumber'][prof])
+        print('\tRaw Date: ', self.rawdata['gmtday'][prof], self.rawdata['gmthour'][prof], self.rawdata['gmtmin'][prof], self.rawdata['gmtsec'][prof], self.rawdata['gmthund'][prof])
+        print('\tDatetime: ', self.datetimes[prof])
+        print('\tMetDate: ', self.rawdata['metday'][prof], self.rawdata['methour'][prof], self.rawdata['metmin'][prof], self.rawdata['metsec'][prof], self.rawdata['methund'][prof])
+        print('\tlat, lon: ', self.rawdata['latitude'][prof], self.rawdata['longitude'][prof])
         
     def plot_photon_profiles(self, wv=355):
         
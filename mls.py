@@ -10,9 +10,8 @@ V. Noel - Created on Thu Jan 27 17:21:26 CET 2011
 
 '''
 
-import numpy as np
 import tables
-from datetime import datetime, timedelta
+from timeutils import tai93_to_datetime64
 
 
 mlspath = '/homedata/noel/Data/MLS/'
@@ -113,13 +112,10 @@ class MLS(object):
     
     def datetime(self):
         '''
-        returns datetimes for MLS profiles.
+        returns datetime64 times for MLS profiles.
         shape: ntime
         '''
-        geo = self.h5.getNode(self.swathnode, 'Geolocation Fields')
-        time = geo.Time.read()
-        datetimes = np.array([datetime(1993, 1, 1) + timedelta(seconds=t) for t in time])
-        return datetimes
+        return tai93_to_datetime64(self.time())
         
         
 class MLSCO(MLS):
@@ -16,6 +16,7 @@ dependencies: numpy, plac to run the module standalone (easy to remove)
 import os
 import numpy as np
 from datetime import datetime, timedelta
+from timeutils import offsets_to_datetime64
 
 i = 'i2'
 pccoraheader = np.dtype( [ ('copyright', 'a20'), ('lenident', i), ('lensyspar', i), 
@@ -119,9 +120,10 @@ def convert_units(data):
     
 
 def create_data_datetimes(launchtime, seconds):
-
-    datetimes = [launchtime+timedelta(seconds=int(x)) if (x is not np.ma.masked) else 0 for x in seconds]
-    return datetimes
+    '''
+    returns a datetime64 array, NaT where seconds are masked
+    '''
+    return offsets_to_datetime64(launchtime, seconds)
   
   
 def pccora_read(file):
@@ -156,7 +158,7 @@ def pccora_read(file):
     hires = convert_object_to_dict(hires, pccoradata.names)
     hires = mask_missing_values(hires)
     hires = convert_units(hires)
-    hires['datetime'] = create_data_datetimes(ident['launchtime'], data['time'])
+    hires['datetime'] = create_data_datetimes(ident['launchtime'], hires['time'])
     
     fid.close()
     
@@ -6,123 +6,774 @@
     Noel V. - LMD/CNRS
 '''
 
+import hashlib
+import multiprocessing
 import numpy as np
+from collections import OrderedDict
 from scipy.interpolate import interp1d
-from datetime import timedelta
+
+bin_statistics = ('count', 'sum', 'mean', 'std', 'min', 'max')
+
+
+def bin_index(x, start, step, n):
+    '''
+    index of the regular bins [start + i * step, start + (i + 1) * step), 0 <= i < n,
+    containing the values x. Values outside the bins, or not finite, get -1.
+    '''
+    x = np.asarray(x, dtype='float64')
+    with np.errstate(invalid='ignore'):
+        i = np.floor((x - start) / step)
+        ok = (i >= 0) & (i < n)
+    return np.where(ok, i, -1).astype('int64')
+
+
+def bin_stats(index, values, nbins, stats=bin_statistics):
+    '''
+    statistics of values in bins, computed for all bins at once.
+    index = bin of each value (e.g. from bin_index), values with index < 0 are ignored
+    values = same shape as index, NaN values are ignored
+    nbins = number of bins
+    stats = statistics to compute, among count, sum, mean, std, min, max
+    returns a dict of arrays [nbins], one per statistic.
+    Empty bins get count = sum = 0, and NaN for other statistics.
+    '''
+    index = np.ravel(index)
+    values = np.ravel(np.ma.filled(np.ma.asarray(values, dtype='float64'), np.nan))
+    ok = (index >= 0) & np.isfinite(values)
+    if not np.all(ok):
+        index, values = index[ok], values[ok]
+
+    out = dict()
+    count = np.bincount(index, minlength=nbins)
+    if 'count' in stats:
+        out['count'] = count
+    if 'sum' in stats or 'mean' in stats or 'std' in stats:
+        total = np.bincount(index, weights=values, minlength=nbins)
+        if 'sum' in stats:
+            out['sum'] = total
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            if 'mean' in stats:
+                out['mean'] = mean
+            if 'std' in stats:
+                # deviations from the bin mean, more accurate than sum of squares
+                dev = np.bincount(index, weights=(values - mean[index]) ** 2, minlength=nbins)
+                out['std'] = np.sqrt(dev / count)
+    for name, ufunc, init in (('min', np.minimum, np.inf), ('max', np.maximum, -np.inf)):
+        if name in stats:
+            extreme = np.full(nbins, init)
+            ufunc.at(extreme, index, values)
+            extreme[count == 0] = np.nan
+            out[name] = extreme
+    return out
+
+
+def _grid_vector(vmin, vmax, step, vrange=None):
+    # lower edges of grid cells, up to the cell containing vmax,
+    # or the cells covering [vrange[0], vrange[1]) if given
+    if vrange is None:
+        n = int(np.floor((vmax - vmin) / step)) + 1
+    else:
+        vmin, n = vrange[0], int(np.ceil((vrange[1] - vrange[0]) / step - 1e-9))
+    return vmin + step * np.arange(n)
+
+
+def grid_stats(lon, lat, var, lonstep, latstep, stats=bin_statistics, lonrange=None, latrange=None):
+    '''
+    statistics of var in the cells of a regular lon/lat grid.
+    Either gridded data:
+        lon [nlon], lat [nlat], var [nlon, nlat]
+    or scattered points (e.g. satellite tracks):
+        lon, lat, var with the same shape
+    lonstep, latstep = size of grid cells
+    stats = statistics to compute, see bin_stats
+    lonrange, latrange = (min, max) of the grid, by default from the minimum
+        up to the cell containing the maximum of lon, lat. Points outside are ignored.
+    returns
+        dict of statistics [nlon2, nlat2] (see bin_stats)
+        newlon [nlon2], newlat [nlat2] = lower edges of grid cells
+    '''
+    lon, lat, var = np.asarray(lon), np.asarray(lat), np.asarray(var)
+    newlon = _grid_vector(np.nanmin(lon), np.nanmax(lon), lonstep, lonrange)
+    newlat = _grid_vector(np.nanmin(lat), np.nanmax(lat), latstep, latrange)
+    nlon, nlat = newlon.size, newlat.size
+    ilon = bin_index(lon, newlon[0], lonstep, nlon)
+    ilat = bin_index(lat, newlat[0], latstep, nlat)
+    if lon.shape != var.shape:
+        # gridded data, cell indexes are computed once per row and column
+        ilon, ilat = ilon[:, np.newaxis], ilat[np.newaxis, :]
+    index = np.where((ilon >= 0) & (ilat >= 0), ilon * nlat + ilat, -1)
+    out = bin_stats(index, var, nlon * nlat, stats=stats)
+    out = dict((k, v.reshape(nlon, nlat)) for k, v in out.items())
+    return out, newlon, newlat
+
 
 def remean(lon, lat, var, lonstep, latstep):
-    lonmin, lonmax = np.min(lon), np.max(lon)
-    latmin, latmax = np.min(lat), np.max(lat)
-    newlon = np.r_[lonmin:lonmax+lonstep:lonstep]
-    newlat = np.r_[latmin:latmax+latstep:latstep]
-    nlon = np.size(newlon)
-    nlat = np.size(newlat)
-    newvar = np.zeros([nlon, nlat])
-    for i in range(nlon-1):
-        idxlon = (lon >= newlon[i]) & (lon < newlon[i+1])
-        for j in range(nlat-1):
-            idxlat = (lat >= newlat[j]) & (lat < newlat[j+1])
-            varslice = var[idxlon,:][:,idxlat]
-            idx = np.isfinite(varslice)
-            newvar[i,j] = np.mean(varslice[idx])
-            # newvar[i,j] = np.mean(var[idxlon,:][:,idxlat])
-
-    return newvar, newlon, newlat
+    '''
+    mean of var in the cells of a regular lon/lat grid, see grid_stats.
+    Empty cells are NaN.
+    '''
+    out, newlon, newlat = grid_stats(lon, lat, var, lonstep, latstep, stats=('mean',))
+    return out['mean'], newlon, newlat
+
 
 def remap(lon, lat, var, lonstep, latstep):
-    lonmin, lonmax = np.min(lon), np.max(lon)
-    latmin, latmax = np.min(lat), np.max(lat)
-    newlon = np.r_[lonmin:lonmax+lonstep:lonstep]
-    newlat = np.r_[latmin:latmax+latstep:latstep]
-    nlon = np.size(newlon)
-    nlat = np.size(newlat)
-    newvar = np.zeros([nlon, nlat])
-    for i in range(nlon-1):
-        idxlon = (lon >= newlon[i]) & (lon < newlon[i+1])
-        for j in range(nlat-1):
-            idxlat = (lat >= newlat[j]) & (lat < newlat[j+1])
-
-            newvar[i,j] = np.sum(var[idxlon,:][:,idxlat])
-
-    return newvar, newlon, newlat
+    '''
+    sum of var in the cells of a regular lon/lat grid, see grid_stats.
+    '''
+    out, newlon, newlat = grid_stats(lon, lat, var, lonstep, latstep, stats=('sum',))
+    return out['sum'], newlon, newlat
+
+
+# mean earth radius used by EASE grids, km
+earth_radius = 6371.228
+
+
+class EqualAreaGrid(object):
+    '''
+    polar Lambert azimuthal equal-area grid, like the EASE-Grid hemispheric
+    grids: all cells have the same area.
+    Square grid of cells of step km, in projected coordinates x, y centered
+    on a pole, down to the latitude boundinglat (negative for the south pole).
+    Subclasses can use another polar projection by redefining _rho and _phi.
+    Point-to-cell index maps are cached for each set of coordinates, so
+    gridding again the same orbits or model domain is a single bincount.
+
+        grid = EqualAreaGrid(25., boundinglat=-50)
+        out = grid.stats(lon, lat, var)
+        lon2, lat2 = grid.centers()
+    '''
+
+    def __init__(self, step=25., boundinglat=-50., lon_0=0., max_maps=16):
+        self.step = float(step)
+        self.boundinglat = float(boundinglat)
+        self.south = boundinglat < 0
+        self.lon_0 = float(lon_0)
+        half = self._rho(np.radians(np.abs(boundinglat)))
+        self.n = int(np.ceil(2. * half / self.step))
+        # cell edges, the grid is centered on the pole
+        self.x = self.step * (np.arange(self.n + 1) - self.n / 2.)
+        self.y = self.x.copy()
+        self.shape = (self.n, self.n)
+        self.max_maps = max_maps
+        self._maps = OrderedDict()
+
+    def _rho(self, phi):
+        # distance to the pole in km, phi in radians, positive towards the pole
+        return 2. * earth_radius * np.sin(np.pi / 4. - phi / 2.)
+
+    def _phi(self, rho):
+        # inverse of _rho
+        return np.pi / 2. - 2. * np.arcsin(np.clip(rho / (2. * earth_radius), -1., 1.))
+
+    def project(self, lon, lat):
+        '''
+        projected coordinates x, y in km of points lon, lat in degrees
+        '''
+        lat = np.asarray(lat, dtype='float64')
+        if self.south:
+            lat = -lat
+        rho = self._rho(np.radians(lat))
+        dlon = np.radians(np.asarray(lon, dtype='float64') - self.lon_0)
+        x = rho * np.sin(dlon)
+        y = rho * np.cos(dlon) if self.south else -rho * np.cos(dlon)
+        return x, y
+
+    def inverse(self, x, y):
+        '''
+        lon, lat in degrees of projected coordinates x, y in km
+        '''
+        x, y = np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64')
+        lat = np.degrees(self._phi(np.hypot(x, y)))
+        lon = self.lon_0 + np.degrees(np.arctan2(x, y if self.south else -y))
+        lon = (lon + 180.) % 360. - 180.
+        return lon, (-lat if self.south else lat)
+
+    def centers(self):
+        '''
+        lon, lat [ny, nx] of cell centers, e.g. to plot results with a Basemap
+        '''
+        xc = 0.5 * (self.x[1:] + self.x[:-1])
+        x, y = np.meshgrid(xc, xc)
+        return self.inverse(x, y)
+
+    def cell_index(self, lon, lat):
+        '''
+        flat index, in grid arrays [ny, nx], of the cells containing the points lon, lat.
+        Points outside the grid or beyond boundinglat get -1.
+        '''
+        x, y = self.project(lon, lat)
+        ix = bin_index(x, self.x[0], self.step, self.n)
+        iy = bin_index(y, self.y[0], self.step, self.n)
+        lat = np.asarray(lat)
+        with np.errstate(invalid='ignore'):
+            inside = (lat <= self.boundinglat) if self.south else (lat >= self.boundinglat)
+        return np.where(inside & (ix >= 0) & (iy >= 0), iy * self.n + ix, -1)
+
+    def index_map(self, lon, lat):
+        '''
+        cell_index(lon, lat), cached for the last max_maps sets of coordinates
+        '''
+        lon, lat = np.asarray(lon, dtype='float64'), np.asarray(lat, dtype='float64')
+        key = (lon.shape, hashlib.md5(lon.tobytes() + lat.tobytes()).hexdigest())
+        try:
+            index = self._maps.pop(key)
+        except KeyError:
+            index = self.cell_index(lon, lat)
+            index.flags.writeable = False
+        # move it to the most recently used end
+        self._maps[key] = index
+        while len(self._maps) > self.max_maps:
+            self._maps.popitem(last=False)
+        return index
+
+    def stats(self, lon, lat, var, stats=bin_statistics):
+        '''
+        statistics of var in grid cells (see bin_stats).
+        lon, lat = coordinates of points, any shape
+        var = same shape as lon, or [..., lon.shape] (e.g. [nz, ny, nx] for a
+              model field on lon, lat [ny, nx]), gridded separately along the first dimensions
+        returns a dict of arrays [ny, nx], or [..., ny, nx]
+        '''
+        index = self.index_map(lon, lat)
+        var = np.asarray(var)
+        ncell = self.n * self.n
+        lead = var.shape[:var.ndim - index.ndim]
+        nlead = int(np.prod(lead))
+        if nlead > 1:
+            index = np.where(index >= 0, index + ncell * np.arange(nlead).reshape((-1,) + (1,) * index.ndim), -1)
+        out = bin_stats(index, var, ncell * nlead, stats=stats)
+        return dict((k, v.reshape(lead + self.shape)) for k, v in out.items())
+
+    def remean(self, lon, lat, var):
+        '''
+        mean of var in grid cells, NaN for empty cells
+        '''
+        return self.stats(lon, lat, var, stats=('mean',))['mean']
+
+
+class PolarStereoGrid(EqualAreaGrid):
+    '''
+    polar stereographic grid, true scale at latitude lat_ts (in the hemisphere
+    of boundinglat), like the NSIDC sea ice grids. See EqualAreaGrid.
+    '''
+
+    def __init__(self, step=25., boundinglat=-50., lon_0=0., lat_ts=70., max_maps=16):
+        self.k = 1. + np.sin(np.radians(np.abs(lat_ts)))
+        EqualAreaGrid.__init__(self, step=step, boundinglat=boundinglat, lon_0=lon_0, max_maps=max_maps)
+
+    def _rho(self, phi):
+        return earth_radius * self.k * np.tan(np.pi / 4. - phi / 2.)
+
+    def _phi(self, rho):
+        return np.pi / 2. - 2. * np.arctan(rho / (earth_radius * self.k))
+
+
+def _edges_index(x, edges):
+    # index of the bins between successive edges, increasing (altitude)
+    # or decreasing (pressure), containing x. -1 outside the edges.
+    x = np.asarray(x, dtype='float64')
+    n = edges.size - 1
+    if edges[0] <= edges[-1]:
+        i = np.searchsorted(edges, x, side='right') - 1
+    else:
+        i = n - np.searchsorted(edges[::-1], x, side='left')
+    return np.where((i >= 0) & (i < n), i, -1).astype('int64')
+
+
+class GridAccumulator(object):
+    '''
+    Accumulates count, sum and sum of squares of a variable in the cells of a
+    regular lon/lat grid, with an optional vertical axis, one batch of points
+    at a time (e.g. one orbit at a time). Accumulators with the same grid,
+    e.g. built by separate processes, can be merged and saved to disk.
+
+        acc = GridAccumulator(1., 1., zedges=np.r_[0:20.5:0.5])
+        for f in files:
+            acc.add(lon, lat, cloud_fraction, z=altitude)
+        acc.save('month.npz')
+        acc = GridAccumulator.load('month1.npz')
+        acc.merge(GridAccumulator.load('month2.npz'))
+        mean = acc.mean()
+    '''
+
+    def __init__(self, lonstep, latstep, lonrange=(-180., 180.), latrange=(-90., 90.), zedges=None):
+        '''
+        lonstep, latstep = size of grid cells
+        lonrange, latrange = (min, max) of the grid
+        zedges = optional edges of vertical bins, increasing (altitude) or decreasing (pressure)
+        '''
+        self.lonstep, self.latstep = float(lonstep), float(latstep)
+        self.lonrange, self.latrange = tuple(lonrange), tuple(latrange)
+        self.lon = _grid_vector(None, None, self.lonstep, self.lonrange)
+        self.lat = _grid_vector(None, None, self.latstep, self.latrange)
+        self.zedges = None if zedges is None else np.asarray(zedges, dtype='float64')
+        shape = (self.lon.size, self.lat.size)
+        if self.zedges is not None:
+            shape += (self.zedges.size - 1,)
+        self.shape = shape
+        self.count = np.zeros(shape, dtype='int64')
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+
+    def _index(self, lon, lat, z=None):
+        nlon, nlat = self.shape[:2]
+        ilon = bin_index(lon, self.lon[0], self.lonstep, nlon)
+        ilat = bin_index(lat, self.lat[0], self.latstep, nlat)
+        ok = (ilon >= 0) & (ilat >= 0)
+        index = ilon * nlat + ilat
+        if self.zedges is not None:
+            iz = _edges_index(z, self.zedges)
+            ok &= (iz >= 0)
+            index = index * self.shape[2] + iz
+        return np.where(ok, index, -1)
+
+    def add(self, lon, lat, values, z=None):
+        '''
+        adds a batch of points to the accumulator.
+        lon, lat, values (and z if the grid has a vertical axis) have the same shape,
+        or lon, lat [npts] and values, z [npts, nz] for profiles.
+        Points outside the grid and NaN values are ignored.
+        '''
+        values = np.asarray(values)
+        lon, lat = np.asarray(lon), np.asarray(lat)
+        if lon.shape != values.shape:
+            lon = np.broadcast_to(lon[:, np.newaxis], values.shape)
+            lat = np.broadcast_to(lat[:, np.newaxis], values.shape)
+        if z is not None:
+            z = np.broadcast_to(z, values.shape)
+        index = self._index(lon, lat, z)
+        nbins = self.count.size
+        out = bin_stats(index, values, nbins, stats=('count', 'sum'))
+        # sum of squares, bin_stats already ignores NaN and outside points
+        sq = bin_stats(index, np.square(values, dtype='float64'), nbins, stats=('sum',))
+        self.count += out['count'].reshape(self.shape)
+        self.sum += out['sum'].reshape(self.shape)
+        self.sumsq += sq['sum'].reshape(self.shape)
+
+    def _same_grid(self, other):
+        return (self.shape == other.shape and self.lonstep == other.lonstep and self.latstep == other.latstep
+                and self.lonrange == other.lonrange and self.latrange == other.latrange
+                and (self.zedges is None) == (other.zedges is None)
+                and (self.zedges is None or np.all(self.zedges == other.zedges)))
+
+    def merge(self, other):
+        '''
+        adds the content of another accumulator with the same grid
+        '''
+        if not self._same_grid(other):
+            raise ValueError('cannot merge accumulators with different grids')
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        return self
+
+    def mean(self):
+        '''
+        mean in grid cells, NaN for empty cells
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.count
+
+    def std(self):
+        '''
+        standard deviation in grid cells, NaN for empty cells
+        '''
+        mean = self.mean()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = self.sumsq / self.count - mean ** 2
+        return np.sqrt(np.maximum(var, 0.))
+
+    def save(self, filename):
+        '''
+        saves the accumulator in a numpy npz file
+        '''
+        grid = dict(lonstep=self.lonstep, latstep=self.latstep, lonrange=self.lonrange, latrange=self.latrange)
+        if self.zedges is not None:
+            grid['zedges'] = self.zedges
+        np.savez(filename, count=self.count, sum=self.sum, sumsq=self.sumsq, **grid)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        reads an accumulator saved with save()
+        '''
+        npz = np.load(filename)
+        zedges = npz['zedges'] if 'zedges' in npz.files else None
+        acc = cls(float(npz['lonstep']), float(npz['latstep']), lonrange=npz['lonrange'],
+                  latrange=npz['latrange'], zedges=zedges)
+        acc.count, acc.sum, acc.sumsq = npz['count'], npz['sum'], npz['sumsq']
+        npz.close()
+        return acc
+
+
+def bin_percentiles(index, values, nbins, percentiles):
+    '''
+    percentiles of values in bins, with linear interpolation like np.percentile.
+    index, values, nbins = see bin_stats
+    percentiles = sequence of percentiles between 0 and 100
+    returns an array [npercentiles, nbins], NaN for empty bins
+    '''
+    index = np.ravel(index)
+    values = np.ravel(np.ma.filled(np.ma.asarray(values, dtype='float64'), np.nan))
+    ok = (index >= 0) & np.isfinite(values)
+    index, values = index[ok], values[ok]
+    # values sorted by bin, then by value
+    order = np.lexsort((values, index))
+    values = values[order]
+    count = np.bincount(index, minlength=nbins)
+    first = np.cumsum(count) - count
+    last = np.maximum(first + count - 1, 0)
+    out = np.full((len(percentiles), nbins), np.nan)
+    full = count > 0
+    for i, q in enumerate(percentiles):
+        pos = first + q / 100. * (count - 1)
+        lo = np.minimum(np.floor(pos).astype('int64'), last)
+        hi = np.minimum(lo + 1, last)
+        frac = pos - lo
+        out[i, full] = values[lo[full]] + frac[full] * (values[hi[full]] - values[lo[full]])
+    return out
+
+
+def _to_datetime64(dates):
+    # datetime objects or datetime64 -> datetime64[ns]
+    dates = np.asarray(dates)
+    if dates.dtype.kind != 'M':
+        dates = dates.astype('datetime64[us]')
+    return dates.astype('datetime64[ns]')
+
 
 def _new_dates_with_timestep(dates, timestep, start=None, end=None):
+    '''
+    lower edges of time bins of size timestep (timedelta or timedelta64),
+    from midnight of start (default: the first date) to end (default:
+    midnight after the last date). Returns datetime64[ns].
+    '''
+    dates = _to_datetime64(dates)
+    dates = dates[~np.isnat(dates)]
+    step = np.timedelta64(timestep).astype('timedelta64[ns]')
     if start is None:
         start = np.min(dates)
-    current = start.replace(hour=0, minute=0, second=0)
-    newdates = np.array([])
+    start = np.datetime64(start).astype('datetime64[D]').astype('datetime64[ns]')
     if end is None:
-        end = np.max(dates).replace(hour=0, minute=0, second=0) + timedelta(days=1)
-    while current < (end+timestep):
-        newdates = np.append(newdates, current)
-        current += timestep
-    return newdates
+        end = np.max(dates).astype('datetime64[D]') + np.timedelta64(1, 'D')
+    end = np.datetime64(end).astype('datetime64[ns]')
+    return np.arange(start, end + step, step)
+
+
+def resample_with_timestep(dates, data, timestep, start=None, end=None, stats=('mean',), percentiles=()):
+    '''
+    statistics of data in time bins of size timestep, see _new_dates_with_timestep.
+    dates [n] = datetime objects or datetime64, in any order
+    data [n] or [n, ncol]
+    stats = statistics to compute, among count, sum, mean, std, min, max (see bin_stats)
+    percentiles = percentiles to compute, e.g. (10, 50, 90), returned as p10, p50, p90
+    returns
+        dict of statistics [nbins] or [nbins, ncol]. Empty bins are NaN
+        (0 for count and sum), NaN data are ignored.
+        newdates [nbins] = lower edges of time bins, datetime64[ns]
+    '''
+    newdates = _new_dates_with_timestep(dates, timestep, start=start, end=end)
+    step = np.timedelta64(timestep).astype('timedelta64[ns]')
+    dates = _to_datetime64(dates)
+    ok = ~np.isnat(dates) & (dates >= newdates[0]) & (dates < newdates[-1] + step)
+    ibin = np.where(ok, np.searchsorted(newdates, dates, side='right') - 1, -1)
+
+    data = np.asarray(data)
+    values = data.reshape(data.shape[0], -1)
+    nbins, ncol = newdates.size, values.shape[1]
+    # one bin per time bin and column, negative for dates outside bins
+    index = np.where(ok[:, np.newaxis], ibin[:, np.newaxis] * ncol + np.arange(ncol), -1)
+    shape = (nbins,) + data.shape[1:]
+    out = bin_stats(index, values, nbins * ncol, stats=stats)
+    out = dict((k, v.reshape(shape)) for k, v in out.items())
+    if len(percentiles) > 0:
+        pct = bin_percentiles(index, values, nbins * ncol, percentiles)
+        for q, p in zip(percentiles, pct):
+            out['p%g' % q] = p.reshape(shape)
+    return out, newdates
+
+
+def _old_time_bins(newdata, newdates):
+    # output of the time bin functions before resample_with_timestep:
+    # datetime objects, and a last bin (starting at end) always 0
+    newdata[-1] = 0.
+    return newdata, newdates.astype('datetime64[us]').astype(object)
+
 
 def aggregate_with_timestep(dates, data, timestep):
-    newdates = _new_dates_with_timestep(dates, timestep)
-    newdata = np.zeros([newdates.size])
-    for i in np.r_[0:newdates.size-1]:
-        idx = (dates >= newdates[i]) & (dates < newdates[i+1])
-        newdata[i] = np.sum(data[idx])
-    return newdata, newdates
+    '''
+    sum of data in time bins, see resample_with_timestep
+    returns newdata [nbins], newdates [nbins] as datetime objects.
+    The last bin starts at midnight after the last date and is always 0.
+    '''
+    out, newdates = resample_with_timestep(dates, data, timestep, stats=('sum',))
+    return _old_time_bins(out['sum'], newdates)
+
 
 def average_with_timestep(dates, data, timestep, start=None, end=None):
-    newdates = _new_dates_with_timestep(dates, timestep, start=start, end=end)
-    newdata = np.zeros([newdates.size])
-    for i in np.r_[0:newdates.size-1]:
-        idx = (dates >= newdates[i]) & (dates < newdates[i+1])
-        newdata[i] = np.mean(data[idx])
-    return newdata, newdates
+    '''
+    mean of data in time bins, see resample_with_timestep
+    returns newdata [nbins], newdates [nbins] as datetime objects.
+    Empty bins are NaN, except the last bin, starting at end, which is always 0.
+    '''
+    out, newdates = resample_with_timestep(dates, data, timestep, start=start, end=end, stats=('mean',))
+    return _old_time_bins(out['mean'], newdates)
+
+
+def _sort_rows(x):
+    # sorts the rows of x [nrow, n] that are not increasing.
+    # returns x, the mask of rows with finite values, the mask of non-monotonic
+    # or non-finite rows, and the sorting indexes [nrow, n] (None if all rows are sorted).
+    # Rows with non-finite values are replaced by 0..n-1.
+    finite = np.all(np.isfinite(x), axis=1)
+    bad = ~finite | np.any(np.diff(x, axis=1) < 0, axis=1)
+    if not np.any(bad):
+        return x, finite, bad, None
+    x = x.copy()
+    x[~finite] = np.arange(x.shape[1])
+    idx = np.broadcast_to(np.arange(x.shape[1]), x.shape).copy()
+    idx[bad] = np.argsort(x[bad], axis=1, kind='stable')
+    x[bad] = np.take_along_axis(x[bad], idx[bad], axis=1)
+    return x, finite, bad, idx
+
+
+def _segment_counts(xnew, x, kind='linear'):
+    # number of points of xnew [m] (increasing) in each segment of the rows of x [nrow, n]
+    # (increasing), flattened [nrow * nseg]. Segments are
+    #   linear: below x[0], between successive levels, above x[-1] (n + 1 segments)
+    #   nearest: below x[0], around each level, above x[-1] (n + 2 segments)
+    # points equal to x[0] or x[-1] are inside.
+    nrow, m = x.shape[0], xnew.size
+    if kind == 'nearest':
+        mid = 0.5 * (x[:, 1:] + x[:, :-1])
+        breaks = [np.searchsorted(xnew, x[:, :1], side='left'), np.searchsorted(xnew, mid, side='right'),
+                  np.searchsorted(xnew, x[:, -1:], side='right')]
+    else:
+        breaks = [np.searchsorted(xnew, x[:, :-1], side='left'), np.searchsorted(xnew, x[:, -1:], side='right')]
+    breaks = np.concatenate([np.zeros((nrow, 1), dtype='int64')] + breaks + [np.zeros((nrow, 1), dtype='int64') + m], axis=1)
+    return np.diff(breaks, axis=1).ravel()
 
-def regrid_profiles(pvec, pprof, vprof):
+
+def _interp_rows(xnew, x, v, kind='linear', fill=None, out=None, chunk=1000):
+    '''
+    interpolates many profiles v [nprof, n] with coordinates x [nprof, n]
+    on the same coordinates xnew [m], without looping on profiles.
+    x must be increasing in each profile. Each profile is cut into segments
+    (between levels for linear, around levels for nearest) which are
+    located in xnew with a single searchsorted, then expanded on xnew.
+    kind = 'linear' or 'nearest'
+    fill = value outside the coordinates of a profile, if None the values at
+           profile edges are used like np.interp (linear only)
+    out = optional array [nprof, m] to write the result into
+    chunk = number of profiles interpolated at once
+    returns out [nprof, m], and the mask [nprof] of profiles with non-monotonic
+    or non-finite coordinates. Non-monotonic profiles are sorted first,
+    profiles with non-finite coordinates are NaN.
+    '''
+    xnew = np.asarray(xnew, dtype='float64')
+    x = np.asarray(x, dtype='float64')
+    v = np.asarray(v)
+    nprof, n = x.shape
+    m = xnew.size
+    if out is None:
+        out = np.empty((nprof, m))
+    order = None
+    if np.any(np.diff(xnew) < 0):
+        order = np.argsort(xnew, kind='stable')
+        xnew = xnew[order]
+    outside = np.nan if fill is None else fill
+    bad = np.zeros(nprof, dtype=bool)
+    for i in range(0, nprof, chunk):
+        xc, vc = x[i:i+chunk], np.asarray(v[i:i+chunk], dtype='float64')
+        c = xc.shape[0]
+        xc, finite, bad[i:i+chunk], idx = _sort_rows(xc)
+        if idx is not None:
+            vc = np.take_along_axis(vc, idx, axis=1)
+
+        # segments [nprof, nseg] of values a * xnew + b
+        counts = _segment_counts(xnew, xc, kind)
+        zero = np.zeros((c, 1))
+        if kind == 'nearest':
+            a = np.zeros((c, n + 2))
+            b = np.concatenate([zero + outside, vc, zero + outside], axis=1)
+        else:
+            dx = np.diff(xc, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                slope = np.where(dx > 0, np.diff(vc, axis=1) / dx, 0.)
+            a = np.concatenate([zero, slope, zero], axis=1)
+            b = vc[:, :-1] - slope * xc[:, :-1]
+            if fill is None:
+                b = np.concatenate([vc[:, :1], b, vc[:, -1:]], axis=1)
+            else:
+                b = np.concatenate([zero + fill, b, zero + fill], axis=1)
+        o = out[i:i+chunk] if order is None else np.empty((c, m))
+        np.multiply(np.repeat(a.ravel(), counts).reshape(c, m), xnew, out=o)
+        o += np.repeat(b.ravel(), counts).reshape(c, m)
+        o[~finite] = np.nan
+        if order is not None:
+            out[i:i+chunk, order] = o
+    return out, bad
+
+
+def regrid_profiles(pvec, pprof, vprof, return_mask=False, chunk=1000):
     '''
     regrid_profiles(pvec, pprof, vprof)
         regrids profiles of variable vprof on the pressure vector pvec
         pprof, vprof [nprof, n1] - profiles of pressure and variable.  Pressure must be decreasing.
         pvec [n2]
-        output : vprof2 [nprof, n2]
+        return_mask - if True, also returns the mask [nprof] of profiles
+                      with pressure values not all decreasing.
+                      Nothing is printed about these profiles, ask for the mask to find them.
+        chunk - number of profiles interpolated at once
+        output : vprof2 [nprof, n2] (, mask [nprof])
+    Values outside the pressure range of a profile are the values at its edges, like np.interp.
+    All profiles are interpolated at once, see _interp_rows.
     '''
 
     assert pvec.ndim == 1, 'pvec must be a vector'
     assert (pprof.ndim==2) & (vprof.ndim==2), 'Wrong dimensions in pprof or vprof'
-    assert np.abs(np.max(pvec)-np.max(pprof)) < 800, 'Check your pressures (possible linear/log confusion)'
+    assert np.abs(np.max(pvec)-np.nanmax(pprof)) < 800, 'Check your pressures (possible linear/log confusion)'
     
-    nprof = vprof.shape[0]    
-    vprof2 = np.empty([nprof, pvec.size])
-    for i in np.arange(nprof):
-        if not np.all(np.diff(pprof[i,:]) < 0):
-            print('Warning : Pressure values are not all decreasing')
-        vprof2[i,:] = np.interp(pvec, pprof[i,::-1], vprof[i,::-1])
-        
+    # decreasing pressures are increasing -pressures
+    vprof2, mask = _interp_rows(-pvec, -pprof, vprof, chunk=chunk)
+    # equal successive pressures are not decreasing either
+    mask |= np.any(np.diff(pprof, axis=1) == 0, axis=1)
+
+    if return_mask:
+        return vprof2, mask
     return vprof2
 
 
-def regrid_array_z(zvec, zarr, varr, kind='linear'):
-    n1, n2 = varr.shape
-    varr2 = np.empty([zvec.size, n2])
-    for i in np.arange(n2):
-        if not np.all(np.diff(zarr[:,i]) >= 0):
-            print('Warning: altitude values should be increasing.')
-            print(zarr[:,i])
-            print(np.diff(zarr[:,i]))
-        f = interp1d(zarr[:,i], varr[:,i], kind=kind, bounds_error=False)
-        varr2[:,i] = f(zvec)
-            
+def regrid_weights_z(zvec, zarr, kind='linear'):
+    '''
+    first stage of regrid_array_z: interpolation weights of the altitude
+    columns zarr [n1, n2] on the altitude vector zvec [nz2].
+    kind = 'linear' or 'nearest'
+    returns a dict with
+        i0, i1 [nz2, n2] = flat indexes, in [n1, n2] arrays, of the levels around zvec
+        w [nz2, n2] = weight of i1
+        outside [nz2, n2] = zvec outside the altitudes of a column, gives NaN
+        bad [n2] = columns with altitudes not increasing (sorted before
+                   interpolation) or not finite (NaN)
+    The weights can be applied to any number of variables on zarr with apply_weights_z.
+    '''
+    zvec = np.asarray(zvec, dtype='float64')
+    order = None
+    if np.any(np.diff(zvec) < 0):
+        order = np.argsort(zvec, kind='stable')
+        zvec = zvec[order]
+    x, finite, bad, idx = _sort_rows(np.asarray(zarr, dtype='float64').T)
+    ncol, n = x.shape
+    m = zvec.size
+
+    # segment of each zvec point in each column
+    nseg = n + 2 if kind == 'nearest' else n + 1
+    seg = np.repeat(np.tile(np.arange(nseg), ncol), _segment_counts(zvec, x, kind)).reshape(ncol, m)
+    if kind == 'nearest':
+        i0 = np.clip(seg - 1, 0, n - 1)
+        i1 = i0
+        w = np.zeros((ncol, m))
+        outside = (seg == 0) | (seg == n + 1)
+    else:
+        i0 = np.clip(seg - 1, 0, n - 2)
+        i1 = i0 + 1
+        x0, x1 = np.take_along_axis(x, i0, axis=1), np.take_along_axis(x, i1, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            w = np.where(x1 > x0, (zvec - x0) / (x1 - x0), 0.)
+        outside = (seg == 0) | (seg == n)
+    outside |= ~finite[:, np.newaxis]
+    if idx is not None:
+        i0, i1 = np.take_along_axis(idx, i0, axis=1), np.take_along_axis(idx, i1, axis=1)
+
+    # flat indexes of level i in column j of [n1, n2] arrays
+    col = np.arange(ncol)[:, np.newaxis]
+    weights = dict(i0=(i0 * ncol + col).T, i1=(i1 * ncol + col).T, w=w.T, outside=outside.T)
+    if order is not None:
+        inverse = np.argsort(order)
+        weights = dict((k, v[inverse]) for k, v in weights.items())
+    weights['bad'] = bad
+    return weights
+
+
+def apply_weights_z(weights, varr, out=None):
+    '''
+    second stage of regrid_array_z: interpolates varr [n1, n2] with weights
+    from regrid_weights_z.
+    out = optional array [nz2, n2] to write the result into
+    returns varr2 [nz2, n2]
+    '''
+    v = np.ravel(varr)
+    v0 = v.take(weights['i0'])
+    if out is None:
+        out = np.empty(v0.shape)
+    np.subtract(v.take(weights['i1']), v0, out=out)
+    out *= weights['w']
+    out += v0
+    out[weights['outside']] = np.nan
+    return out
+
+
+def regrid_array_z(zvec, zarr, varr, kind='linear', weights=None, return_mask=False):
+    '''
+    regrid_array_z(zvec, zarr, varr)
+        regrids columns of variable varr on the altitude vector zvec
+        zarr, varr [n1, n2] - altitudes and variable, altitudes must be increasing
+        zvec [nz2]
+        kind - linear, nearest, or another scipy interp1d kind
+        weights - for linear and nearest, weights from regrid_weights_z(zvec, zarr, kind),
+                  to regrid many variables on the same altitudes
+        return_mask - if True, also returns the mask [n2] of columns with altitudes
+                      not all increasing (weights['bad']). Nothing is printed about them.
+        output : varr2 [nz2, n2] (, mask [n2]), NaN outside the altitudes of each column
+    '''
+    if kind in ('linear', 'nearest'):
+        if weights is None:
+            weights = regrid_weights_z(zvec, zarr, kind=kind)
+        bad = weights['bad']
+        varr2 = apply_weights_z(weights, varr)
+    else:
+        bad = np.any(np.diff(zarr, axis=0) < 0, axis=0)
+        varr2 = _interp1d_columns((zvec, zarr.T, varr.T, kind)).T
+    if return_mask:
+        return varr2, bad
     return varr2
                 
     
-def regrid_array(pvec, parr, varr, kind='linear'):
+def _interp1d_columns(task):
+    # interpolation of columns [ncol, nz] with scipy, for kinds not handled by _interp_rows
+    xnew, x, v, kind = task
+    out = np.empty((x.shape[0], xnew.size))
+    for i in range(x.shape[0]):
+        f = interp1d(x[i], v[i], kind=kind, bounds_error=False)
+        out[i] = f(xnew)
+    return out
+
+
+def regrid_array(pvec, parr, varr, kind='linear', out=None, chunk=2000, nworkers=1, return_mask=False):
     '''
     regrid_array(pvec, parr, varr)
         regrids an array of variable varr on a pressure vector pvec
         parr, varr [nz, nx, ny] - profiles of pressure and variable. Pressure must be decreasing.
         pvec [nz2]
-        output : varr2 [nz2, nx, ny]
+        kind - linear (values at the edges outside the pressure range, like np.interp),
+               nearest, cubic, zero, slinear, quadratic (NaN outside, like interp1d)
+        out - optional array [nz2, nx, ny] to write the result into, e.g. a
+              np.memmap or one time step out[it] of a [nt, nz2, nx, ny] array
+        chunk - number of columns interpolated at once
+        nworkers - number of processes for the cubic, zero, slinear and quadratic kinds.
+                   1 means no pool.
+        return_mask - if True, also returns the mask [nx, ny] of columns with pressure
+                      values not all decreasing. Nothing is printed about them.
+        output : varr2 [nz2, nx, ny] (, mask [nx, ny])
+    linear and nearest interpolate all columns of a chunk at once (see _interp_rows),
+    other kinds use one scipy interp1d per column.
     '''
     
     assert pvec.ndim == 1, 'pvec must be a vector'
     assert (parr.ndim==3) & (varr.ndim==3), 'parr and varr must have 3 dimensions'
     assert np.abs(np.max(pvec)-np.max(parr)) < 800, 'Check your pressures (possible linear/log confusion)'
+    assert kind in ('linear', 'nearest', 'cubic', 'zero', 'slinear', 'quadratic'), 'Unknown interpolation method'
     
     if parr.shape[0] == (varr.shape[0]-1):
         print('Warning: varr and parr not same vertical length. Trying to fix it...')
@@ -131,20 +782,52 @@ def regrid_array(pvec, parr, varr, kind='linear'):
     assert parr.shape[0] == varr.shape[0], 'Pressure and variable must have same vertical length'
     
     n1, n2, n3 = varr.shape
-    varr2 = np.empty([pvec.size, n2, n3])
-    for i in np.arange(n2):
-        for j in np.arange(n3):
-            if not np.all(np.diff(parr[:,i,j]) < 0):
-                print('Warning : Pressure values are not all decreasing')
-            if kind is 'linear':
-                varr2[:,i,j] = np.interp(pvec, parr[::-1,i,j], varr[::-1,i,j])
-            elif kind in ('nearest', 'cubic', 'zero', 'slinear', 'quadratic'):
-                f = interp1d(parr[::-1,i,j], varr[::-1,i,j], kind=kind, bounds_error=False)
-                varr2[:,i,j] = f(pvec)
-            else:
-                print('Unknown interpolation method')
-                
-    return varr2
+    if out is None:
+        out = np.empty([pvec.size, n2, n3])
+    assert out.shape == (pvec.size, n2, n3), 'out must have shape [nz2, nx, ny]'
+    # columns [ncol, nz]
+    pcol = np.asarray(parr).reshape(n1, -1).T
+    vcol = np.asarray(varr).reshape(n1, -1).T
+    ncol = pcol.shape[0]
+    chunks = [slice(i, i + chunk) for i in range(0, ncol, chunk)]
+
+    def _write(sl, o):
+        # out may not be contiguous, e.g. a slice of a larger array
+        i, j = np.unravel_index(np.arange(ncol)[sl], (n2, n3))
+        out[:, i, j] = o.T
+
+    bad = np.zeros(ncol, dtype=bool)
+    if kind in ('linear', 'nearest'):
+        fill = None if kind == 'linear' else np.nan
+        for sl in chunks:
+            # decreasing pressures are increasing -pressures
+            o, badrows = _interp_rows(-pvec, -pcol[sl], vcol[sl], kind=kind, fill=fill, chunk=chunk)
+            _write(sl, o)
+            bad[sl] = badrows | np.any(np.diff(pcol[sl], axis=1) == 0, axis=1)
+    else:
+        bad = np.any(np.diff(pcol, axis=1) >= 0, axis=1)
+        tasks = [(pvec, pcol[sl, ::-1], vcol[sl, ::-1], kind) for sl in chunks]
+        if nworkers == 1 or len(tasks) < 2:
+            results = map(_interp1d_columns, tasks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(processes=nworkers)
+            results = pool.imap(_interp1d_columns, tasks)
+        try:
+            for sl, o in zip(chunks, results):
+                _write(sl, o)
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    if return_mask:
+        return out, bad.reshape(n2, n3)
+    return out
 
 def _pvec_log(n=1000):
     npres = n
@@ -154,22 +837,32 @@ def _pvec_log(n=1000):
     pveclog = np.r_[pmaxlog:pminlog:-psteplog]
     return pveclog
 
-def regrid_profiles_on_logp(pprof, vprof):
+def regrid_profiles_on_logp(pprof, vprof, return_mask=False):
     '''
     Creates a linear log-step pressure vector and call regrid_profiles on it.
-        output: pvec, vprof2
+    return_mask: see regrid_profiles
+        output: pvec, vprof2 (, mask)
     '''
     pvec = _pvec_log(n=100)
+    if return_mask:
+        vprof2, mask = regrid_profiles(pvec, pprof, vprof, return_mask=True)
+        return pvec, vprof2, mask
     vprof2 = regrid_profiles(pvec, pprof, vprof)
     return pvec, vprof2
     
-def regrid_array_on_logp(parr, varr, n=1000, kind='linear'):
+def regrid_array_on_logp(parr, varr, n=1000, kind='linear', out=None, chunk=2000, nworkers=1,
+                         return_mask=False):
     '''
     Creates a linear log-step pressure vector and call regrid_array on it.
-        output: pvec, varr2
+    out, chunk, nworkers, return_mask: see regrid_array
+        output: pvec, varr2 (, mask)
     '''
     pvec = _pvec_log(n=n)
-    varr2 = regrid_array(pvec, parr, varr, kind=kind)
+    if return_mask:
+        varr2, mask = regrid_array(pvec, parr, varr, kind=kind, out=out, chunk=chunk, nworkers=nworkers,
+                                   return_mask=True)
+        return pvec, varr2, mask
+    varr2 = regrid_array(pvec, parr, varr, kind=kind, out=out, chunk=chunk, nworkers=nworkers)
     return pvec, varr2
     
 wrftestfile = '/users/noel/Projects/blue_penguin/analysis2006/wrfout_d01_2006-06-27_00:00:00'
@@ -2,9 +2,10 @@
 #encoding:utf-8
 
 import netCDF4
-import numpy as np
+import wrf
 
 # find matrix indexes that match coordinates the closest in a WRF domain
+# several points can be given at once to wrf.locator(lon, lat).nearest()
 
 def main(wrffile='/mnt/cfmipfs/lov/homedata/noel/Projects/RedPanda/run.20060627.79571/WPS/geo_em.d01.nc', xlon=-60, xlat=-71):
 
@@ -19,19 +20,10 @@ def main(wrffile='/mnt/cfmipfs/lov/homedata/noel/Projects/RedPanda/run.20060627.
     lat = nc.variables['XLAT_M'][:]
     lat = lat.squeeze()
     
-    dist = np.power(lon-xlon, 2) + np.power(lat-xlat, 2)
-    mindist = 1e10
-    
-    ni, nj = lon.shape
-    imin, jmin = -1, -1
-    
-    for i in np.r_[0:ni]:
-        for j in np.r_[0:nj]:
-            if dist[i,j] < mindist:
-                imin = i
-                jmin = j
-                mindist = dist[i,j]
-                
+    # nearest grid point from the cached domain locator, see wrf.Locator
+    i, j = wrf.locator(lon, lat).nearest(float(xlon), float(xlat))
+    imin, jmin = int(i[0]), int(j[0])
+
     print('Found')
     print('  lon = ', lon[imin,jmin])
     print('  lat = ', lat[imin,jmin])
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+# tests of Cal1 on a small synthetic L1 file
+
+import pytest
+import numpy as np
+from pyhdf.SD import SD, SDC, HDF4Error
+from calipso.level1 import Cal1
+
+nprof = 900
+nz = 583
+nz_met = 33
+
+
+def _fake_l1(filename):
+    np.random.seed(10)
+    sd = SD(filename, SDC.WRITE | SDC.CREATE)
+
+    def put(name, values, sdtype=SDC.FLOAT32):
+        v = sd.create(name, sdtype, values.shape)
+        v[:] = values
+        v.endaccess()
+
+    put('Profile_Time', (6.5e8 + np.arange(nprof) * 0.0745).reshape(nprof, 1), SDC.FLOAT64)
+    put('Latitude', np.linspace(-80, 80, nprof).astype('f4').reshape(nprof, 1))
+    put('Longitude', np.linspace(10, 40, nprof).astype('f4').reshape(nprof, 1))
+    atb = np.random.uniform(1e-6, 5e-5, (nprof, nz)).astype('f4')
+    atb[np.random.random(atb.shape) < 0.05] = -9999.
+    put('Total_Attenuated_Backscatter_532', atb)
+    put('Parallel_RMS_Baseline_532', np.random.uniform(50, 250, (nprof, 1)).astype('f4'))
+    put('Pressure', np.random.uniform(1, 100, (nprof, nz_met)).astype('f4'))
+    put('Molecular_Number_Density', np.random.uniform(1e22, 1e25, (nprof, nz_met)).astype('f4'))
+    put('Temperature', np.random.uniform(-80, 20, (nprof, nz_met)).astype('f4'))
+    sd.end()
+
+
+@pytest.fixture(scope='module')
+def l1_file(tmpdir_factory):
+    filename = str(tmpdir_factory.mktemp('l1').join('CAL_LID_L1-ValStage1-V3-30.2013-04-07T14-00-00ZN.hdf'))
+    _fake_l1(filename)
+    return filename
+
+
+def test_cache_missing(l1_file):
+    c = Cal1(l1_file, cache_size=1e8)
+    fill = c._read_var('Total_Attenuated_Backscatter_532', 30)
+    nan = c._read_var('Total_Attenuated_Backscatter_532', 30, missing=-9999.)
+    # cached under different keys, whatever the order of reading
+    assert c.cache_info()['arrays'] == 2
+    assert np.array_equal(c._read_var('Total_Attenuated_Backscatter_532', 30), fill)
+    assert np.array_equal(c._read_var('Total_Attenuated_Backscatter_532', 30, missing=-9999.), nan, equal_nan=True)
+    ref = Cal1(l1_file)
+    assert np.array_equal(nan, ref._read_var('Total_Attenuated_Backscatter_532', 30, missing=-9999.), equal_nan=True)
+    c.close()
+
+
+def test_iter_chunks(l1_file, navg=30):
+    c = Cal1(l1_file)
+    # 7 blocks per chunk, a short last chunk, and a calibration window across chunk edges
+    for alt_range in (None, (5, 20)):
+        chunks = list(c.iter_chunks(chunk_profiles=7 * navg + 5, navg=navg, navgh=3, alt_range=alt_range,
+                                    variables=('coords', 'scattering_ratio', 'mol_on_lidar_alt_calibrated')))
+        assert [chunk['idx'] for chunk in chunks] == [(0, 210), (210, 420), (420, 630), (630, 840), (840, 900)]
+        lat = np.concatenate([chunk['lat'] for chunk in chunks])
+        assert np.array_equal(lat, c.coords(navg=navg)[1])
+        mol = c.mol_on_lidar_alt_calibrated(navg=navg, navgh=3, alt_range=alt_range)
+        assert np.sum(np.isfinite(mol)) > mol.size // 2
+        assert np.allclose(np.concatenate([chunk['mol_on_lidar_alt_calibrated'] for chunk in chunks]), mol,
+                           equal_nan=True)
+        sr = c.atb(navg=navg, alt_range=alt_range) / mol
+        assert np.allclose(np.concatenate([chunk['scattering_ratio'] for chunk in chunks]), sr, equal_nan=True)
+
+
+def test_alt_range(l1_file, navg=30):
+    from calipso.calipso_hdf import _remap_y
+    c = Cal1(l1_file)
+    # altitudes of this file, different from the module default
+    c.lidar_alt = c.lidar_alt + 1.
+    zrange = (8., 20.)
+    alt = c.lidar_alt_range(zrange)
+    inside = (c.lidar_alt >= 8.) & (c.lidar_alt <= 20.)
+    assert np.array_equal(alt, c.lidar_alt[inside])
+    # hyperslab read of the same bins
+    assert np.array_equal(c.atb(navg=navg, alt_range=zrange), c.atb(navg=navg)[:, inside], equal_nan=True)
+    assert np.array_equal(c._read_sds('Total_Attenuated_Backscatter_532', idx=(30, 90), zslice=c._alt_slice(zrange)),
+                          c._read_sds('Total_Attenuated_Backscatter_532')[30:90, inside])
+    p = c.pressure_on_lidar_alt(navg=navg, alt_range=zrange)
+    assert np.allclose(p, _remap_y(c.pressure(navg=navg), c.met_alt, alt), equal_nan=True)
+    met = c.met_on_lidar_alt(navg=navg, alt_range=zrange, variables=('pressure', 'temperature'))
+    assert np.array_equal(met['pressure'], p, equal_nan=True)
+    with pytest.raises(ValueError):
+        c.atb(navg=navg, alt_range=(100., 120.))
+
+
+def test_open(l1_file, tmpdir):
+    c = Cal1(l1_file)
+    # the file is only opened when first read
+    assert c._hdf is None
+    assert c.sds_shape('Total_Attenuated_Backscatter_532') == (nprof, nz)
+    assert c.nprof() == nprof
+    assert c._hdf is not None
+    c.close()
+    with Cal1(l1_file) as c:
+        assert c._hdf is None
+        c.coords(navg=30)
+        assert c._hdf is not None
+    assert c._hdf is None
+
+    notahdf = tmpdir.join('CAL_LID_L1-ValStage1-V3-30.2013-04-07T15-00-00ZN.hdf')
+    notahdf.write('not an hdf file')
+    for filename in (l1_file.replace('14-00-00', '16-00-00'), str(tmpdir), str(notahdf)):
+        with pytest.raises(HDF4Error):
+            Cal1(filename)
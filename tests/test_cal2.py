@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+# tests of Cal2 on a small synthetic L2 layer file
+
+import pytest
+import numpy as np
+from pyhdf.SD import SD, SDC
+from calipso.level2 import Cal2
+
+nprof = 200
+nlaymax = 10
+
+
+def _fake_l2(filename):
+    # no Feature_Optical_Depth_532 and other optional layer variables
+    np.random.seed(11)
+    sd = SD(filename, SDC.WRITE | SDC.CREATE)
+
+    def put(name, values, sdtype=SDC.FLOAT32):
+        v = sd.create(name, sdtype, values.shape)
+        v[:] = values
+        v.endaccess()
+
+    lat = np.linspace(-80, 80, nprof)
+    put('Latitude', np.c_[lat - 0.02, lat, lat + 0.02].astype('f4'))
+    put('Longitude', np.c_[lat * 0 + 10, lat * 0 + 10, lat * 0 + 10].astype('f4'))
+    time = 5e8 + 1.5 * np.arange(nprof)
+    put('Profile_Time', np.c_[time - 0.7, time, time + 0.7], SDC.FLOAT64)
+    nl = np.random.randint(0, 5, nprof)
+    put('Number_Layers_Found', nl.astype('i1').reshape(nprof, 1), SDC.INT8)
+    top = np.sort(np.random.uniform(0, 18, (nprof, nlaymax)), axis=1)[:, ::-1]
+    base = top - np.random.uniform(0.1, 2, (nprof, nlaymax))
+    empty = np.arange(nlaymax) >= nl[:, np.newaxis]
+    top[empty], base[empty] = -9999., -9999.
+    put('Layer_Top_Altitude', top.astype('f4'))
+    put('Layer_Base_Altitude', base.astype('f4'))
+    # type in bits 0-2, phase in bits 5-6
+    flags = np.random.randint(0, 8, (nprof, nlaymax)) + (np.random.randint(0, 4, (nprof, nlaymax)) << 5)
+    put('Feature_Classification_Flags', flags.astype('u2'), SDC.UINT16)
+    sd.end()
+    return nl, top, flags
+
+
+@pytest.fixture(scope='module')
+def l2(tmpdir_factory):
+    filename = str(tmpdir_factory.mktemp('l2').join('CAL_LID_L2_05kmCLay-Prov-V3-01.2010-12-31T01-37-30ZN.hdf'))
+    nl, top, flags = _fake_l2(filename)
+    return Cal2(filename), nl, top, flags
+
+
+def test_feature_flags(l2):
+    c, nl, top, flags = l2
+    f = c.feature_flags()
+    assert c.feature_flags() is f
+    assert np.array_equal(f['type'], flags & 7) and np.array_equal(f['phase'], (flags >> 5) & 3)
+    assert not f['type'].flags.writeable
+    f2 = c.feature_flags(idx=(20, 50))
+    assert np.array_equal(f2['type'], f['type'][20:50])
+    assert c.feature_flags(idx=(20, 50)) is f2
+    # accessors return writable copies
+    lt = c.layer_type()
+    assert np.array_equal(lt, flags & 7) and lt.dtype == np.uint16
+    lt[lt == 2] = 0
+    assert np.array_equal(c.layer_type(), flags & 7)
+    assert np.array_equal(c.phase(idx=(20, 50)), ((flags >> 5) & 3)[20:50])
+
+
+def test_layer_table(l2):
+    c, nl, top, flags = l2
+    table = c.layer_table()
+    valid = np.arange(nlaymax) < nl[:, np.newaxis]
+    assert len(table['profile']) == nl.sum()
+    assert np.array_equal(table['top'], top[valid].astype('f4'))
+    assert np.array_equal(table['type'], (flags & 7)[valid])
+    assert np.array_equal(table['lat'], c.coords()[1][table['profile']])
+    # optional variables missing from the file are skipped
+    assert 'od' not in table and 'ptop' not in table
+
+    part = c.layer_table(idx=(20, 50))
+    inpart = (table['profile'] >= 20) & (table['profile'] < 50)
+    assert np.array_equal(part['profile'], table['profile'][inpart])
+    assert np.array_equal(part['top'], table['top'][inpart])
+
+    clouds = c.layer_table(where=lambda t: (t['type'] == 2) & (t['top'] > 8))
+    sel = (table['type'] == 2) & (table['top'] > 8)
+    assert sel.sum() > 0
+    assert np.array_equal(clouds['profile'], table['profile'][sel])
+    assert np.array_equal(clouds['rank'], table['rank'][sel])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import time
+import numpy as np
+import calipso_batch
+
+
+class _Orbit(object):
+    # stands for Cal1, the orbit number is the file name
+
+    def __init__(self, filename, scale=1):
+        if filename == 'missing':
+            raise IOError('no such file')
+        self.number = int(filename)
+        self.scale = scale
+
+    def close(self):
+        pass
+
+
+def _extract(c):
+    if c.number == 3:
+        raise ValueError('bad orbit')
+    if c.number == 0:
+        # slow first orbit, the others finish before it in a pool
+        time.sleep(0.5)
+    return dict(orbit=np.array([c.number] * 2), value=np.array([c.number * c.scale] * 2))
+
+
+files = ['0', '1', '2', '3', 'missing', '5', '6']
+
+
+def test_iter_orbits():
+    serial = list(calipso_batch.iter_orbits(files, _extract, reader=_Orbit))
+    assert [r[0] for r in serial] == files
+    errors = dict((f, error) for f, result, error in serial if error is not None)
+    assert sorted(errors) == ['3', 'missing']
+    assert errors['3'] == 'ValueError: bad orbit'
+    assert errors['missing'].startswith('Cannot open file')
+
+    pooled = list(calipso_batch.iter_orbits(files, _extract, nworkers=2, reader=_Orbit))
+    assert [r[0] for r in pooled] == files
+    for (f, result, error), (f2, result2, error2) in zip(serial, pooled):
+        assert error == error2
+        if result is not None:
+            assert np.array_equal(result['value'], result2['value'])
+
+    unordered = list(calipso_batch.iter_orbits(files, _extract, nworkers=2, ordered=False, reader=_Orbit))
+    assert sorted(r[0] for r in unordered) == sorted(files)
+    assert unordered[0][0] != '0'
+
+
+def test_process_orbits():
+    for nworkers in (1, 2):
+        data, failed = calipso_batch.process_orbits(files, _extract, nworkers=nworkers, reader=_Orbit,
+                                                    verbose=False, scale=10)
+        assert [f for f, error in failed] == ['3', 'missing']
+        assert np.array_equal(data['orbit'], [0, 0, 1, 1, 2, 2, 5, 5, 6, 6])
+        assert np.array_equal(data['value'], 10 * data['orbit'])
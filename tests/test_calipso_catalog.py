@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import os
+import pytest
+import numpy as np
+from pyhdf.SD import SD, SDC
+import calipso_catalog
+
+
+def _fake_l1(filename, t0, lat):
+    sd = SD(filename, SDC.WRITE | SDC.CREATE)
+    n = len(lat)
+    for name, values in (('Profile_Time', t0 + np.arange(n) * 0.0745),
+                         ('Latitude', lat), ('Longitude', np.linspace(10, 20, n))):
+        v = sd.create(name, SDC.FLOAT64, (n, 1))
+        v[:] = np.reshape(values, (n, 1))
+        v.endaccess()
+    sd.end()
+
+
+@pytest.fixture(scope='module')
+def archive(tmpdir_factory):
+    root = tmpdir_factory.mktemp('archive')
+    daydir = root.mkdir('2008').mkdir('2008_07_01')
+    # 2008-07-01 00:00 in seconds since 1993-01-01
+    t0 = 489024000.
+    _fake_l1(str(daydir.join('CAL_LID_L1-ValStage1-V3-01.2008-07-01T00-00-00ZN.hdf')), t0, np.linspace(-80, -50, 100))
+    _fake_l1(str(daydir.join('CAL_LID_L1-ValStage1-V3-30.2008-07-01T00-00-00ZN.hdf')), t0, np.linspace(-80, -50, 100))
+    _fake_l1(str(daydir.join('CAL_LID_L1-ValStage1-V3-01.2008-07-01T01-00-00ZD.hdf')), t0 + 3600, np.linspace(0, 30, 100))
+    return str(root)
+
+
+def test_catalog(archive, tmpdir):
+    with calipso_catalog.Catalog(str(tmpdir.join('cat.sqlite'))) as cat:
+        assert cat.scan([archive], verbose=False) == 3
+        assert cat.scan([archive], verbose=False) == 0
+        files = cat.query(start='2008-07-01', end='2008-07-02')
+        assert len(files) == 2 and 'V3-30' in os.path.basename(files[0])
+        assert len(cat.query(newest=False)) == 3
+        files = cat.query(night=True, latrange=(-90, -60))
+        assert len(files) == 1 and 'V3-30' in os.path.basename(files[0])
+        assert cat.query(night=False, latrange=(-90, -60)) == []
+
+
+def test_track_ranges(archive, tmpdir):
+    with calipso_catalog.Catalog(str(tmpdir.join('cat.sqlite'))) as cat:
+        cat.scan([archive], verbose=False)
+        ranges = cat.track_ranges(latrange=(-70, -60), lonrange=(10, 20))
+        assert len(ranges) == 1
+        filename, i0, i1 = ranges[0]
+        assert 'V3-30' in os.path.basename(filename)
+        lat = np.linspace(-80, -50, 100)
+        inside = np.flatnonzero((lat >= -70) & (lat <= -60))
+        assert i0 <= inside[0] and i1 > inside[-1]
+        assert cat.track_ranges(latrange=(-70, -60), lonrange=(100, 120)) == []
+
+
+def test_scan_dirs(tmpdir):
+    # root names only differing by _, a single-character wildcard in LIKE patterns
+    roots = []
+    for name in ('l1-v3', 'l1_v3'):
+        daydir = tmpdir.mkdir(name).mkdir('2008').mkdir('2008_07_01')
+        _fake_l1(str(daydir.join('CAL_LID_L1-ValStage1-V3-01.2008-07-01T00-00-00ZN.hdf')), 489024000.,
+                 np.linspace(-80, -50, 10))
+        roots.append(str(tmpdir.join(name)))
+    day2 = tmpdir.join('l1_v3').join('2008').mkdir('2008_07_02')
+    _fake_l1(str(day2.join('CAL_LID_L1-ValStage1-V3-01.2008-07-02T00-00-00ZN.hdf')), 489110400.,
+             np.linspace(-80, -50, 10))
+
+    with calipso_catalog.Catalog(str(tmpdir.join('cat.sqlite'))) as cat:
+        assert cat.scan(roots, verbose=False) == 3
+        assert len(cat.query(newest=False)) == 3
+        # removed day folders are purged, missing roots are left alone
+        day2.remove()
+        cat.scan(roots + [str(tmpdir.join('unmounted'))], verbose=False)
+        files = cat.query(newest=False)
+        assert len(files) == 2 and not any('2008_07_02' in f for f in files)
+        assert cat.db.execute('select count(*) from dirs').fetchone()[0] == 2
+        tmpdir.join('l1_v3').remove()
+        cat.scan(roots[:1], verbose=False)
+        assert len(cat.query(newest=False)) == 2
+
+        rows = cat.query(newest=False, columns='path, start')
+        assert len(rows) == 2 and len(rows[0]) == 2
+        with pytest.raises(ValueError):
+            cat.query(columns='path from granules; drop table granules; --')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import numpy as np
+import pytest
+from calipso.calipso_hdf import _block_average, _array_average, _array_std, _vector_average, _ReadCache
+from calipso.calipso_hdf import _window_mean, _remap_y, _remap_operator, _decode_fcf
+
+
+def _loop_average(a0, navg, valid):
+    # reference implementation, one block at a time
+    n = np.size(a0, 0) // navg
+    a = np.zeros([n, np.size(a0, 1)])
+    for i in range(n):
+        aslice = a0[i * navg:i * navg + navg - 1, :]
+        aslice = aslice[valid[i * navg:i * navg + navg - 1] != 0, :]
+        if aslice.shape[0] == 0:
+            a[i, :] = -9999.
+            continue
+        npts = np.sum(aslice > -999., axis=0)
+        a[i, :] = np.sum(np.where(aslice > -999., aslice, 0), axis=0) / npts
+        a[i, npts == 0] = -9999.
+    return a
+
+
+def _random_atb(nprof=1000, nz=20):
+    np.random.seed(42)
+    a = np.random.normal(1e-3, 1e-3, [nprof, nz]).astype('float32')
+    a[np.random.random(a.shape) < 0.1] = -9999.
+    valid = np.random.random(nprof) > 0.2
+    # a block without any valid profile
+    valid[30:45] = False
+    return a, valid
+
+
+def test_array_average():
+    a, valid = _random_atb()
+    for navg in 2, 15, 30:
+        avg = _array_average(a, navg, valid=valid)
+        assert avg.shape == (1000 // navg, 20)
+        assert np.allclose(avg, _loop_average(a, navg, valid), rtol=1e-5)
+    assert np.all(_array_average(a, 15, valid=valid)[2, :] == -9999.)
+
+
+def test_nan_and_missing():
+    v = np.array([1., np.nan, 3., 4., -9999., -9999., 7., 8.])
+    # the last profile of each block is left out
+    assert np.allclose(_vector_average(v, 4), [2., 7.])
+    assert np.allclose(_vector_average(v[:6], 2), [1., 3., -9999.])
+    avg = _vector_average(v, 4, missing=7.)
+    assert avg[0] == 2. and np.isnan(avg[1])
+
+
+def test_weighted():
+    a = np.arange(20.).reshape(10, 2)
+    avg = _array_average(a, 5, weighted=True)
+    # weights [1, 2, 3, 2] on the first 4 profiles of each block
+    assert np.allclose(avg[0, :], [(0 + 2 * 2 + 3 * 4 + 2 * 6) / 8., (1 + 2 * 3 + 3 * 5 + 2 * 7) / 8.])
+
+
+def test_float32():
+    a, valid = _random_atb()
+    avg32 = _array_average(a, 15, valid=valid, dtype='float32')
+    assert avg32.dtype == np.float32
+    assert np.allclose(avg32, _array_average(a, 15, valid=valid), rtol=1e-6)
+    # remapping keeps float32
+    z = _remap_y(a, np.linspace(40, -2, 20), np.r_[30:0:-0.5])
+    assert z.dtype == np.float32
+
+
+def test_std():
+    a, valid = _random_atb()
+    a = np.abs(a)
+    std = _array_std(a, 10)
+    assert np.allclose(std[0, :], np.std(a[:9, :], axis=0), rtol=1e-5)
+    assert np.allclose(_block_average(a, 10, std=True), std)
+
+
+def test_read_cache():
+    cache = _ReadCache(max_bytes=3 * 800)
+    for i in range(3):
+        cache.put(('var%d' % i, 1, None), np.zeros(100))
+    assert cache.get(('var0', 1, None)) is not None
+    # var1 is now the least recently used array
+    cache.put(('var3', 1, None), np.zeros(100))
+    assert cache.get(('var1', 1, None)) is None
+    assert cache.get(('var3', 1, None)) is not None
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert cache.nbytes == 3 * 800
+    # too big to be cached
+    cache.put(('big', 1, None), np.zeros(1000))
+    assert cache.get(('big', 1, None)) is None
+    with pytest.raises(ValueError):
+        cache.get(('var3', 1, None))[0] = 1.
+
+
+def test_window_mean():
+    v = np.arange(10.)
+    ok = v != 4
+    m = _window_mean(v, ok, 2)
+    for i in range(10):
+        # historical window, never includes the last point
+        w = np.r_[max(0, i - 2):min(9, i + 2)]
+        assert m[i] == np.mean(v[w][ok[w]])
+    m = _window_mean(v, ok, 2, centered=True)
+    assert m[9] == np.mean([7., 8., 9.])
+    assert np.isnan(_window_mean(v, np.zeros(10, bool), 2)).all()
+
+
+def test_remap_y():
+    np.random.seed(0)
+    y0 = np.r_[40:-2:-1.5]
+    y = np.r_[45:-3:-0.3]
+    z0 = np.random.random([50, y0.size])
+    z = _remap_y(z0, y0, y)
+    for i in range(50):
+        assert np.allclose(z[i, :], np.interp(y, y0[::-1], z0[i, ::-1]))
+    # several variables in one go
+    z1, z2 = _remap_y([z0[:20], z0[20:]], y0, y)
+    assert np.allclose(z1, z[:20]) and np.allclose(z2, z[20:])
+    assert _remap_operator(y0, y) is _remap_operator(y0.copy(), y.copy())
+
+
+def test_decode_fcf():
+    f = np.arange(65536, dtype='uint16').reshape(256, 256)
+    flags = _decode_fcf(f)
+    assert flags['type'].dtype == np.uint8
+    assert np.array_equal(flags['type'], f & 7)
+    assert np.array_equal(flags['type_qa'], (f & 24) >> 3)
+    assert np.array_equal(flags['phase'], (f & 96) >> 5)
+    assert np.array_equal(flags['phase_qa'], (f & 384) >> 7)
+    assert np.array_equal(flags['subtype'], (f & 3584) >> 9)
+    assert np.array_equal(flags['subtype_qa'], (f >> 12) & 1)
+    assert np.array_equal(flags['horizontal_averaging'], f >> 13)
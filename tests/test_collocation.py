@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import pytest
+import numpy as np
+import localpaths
+from caltrack.collocation import collocate, geoprof_files
+
+
+def test_collocate():
+    np.random.seed(1)
+    time2 = np.arange(0., 1000., 1.49)
+    time1 = np.random.uniform(-10, 1010, 500)
+    match = collocate(time1, time2[::-1], max_dt=0.5)
+    for i1, i2, dt in zip(match['i1'], match['i2'], match['dt']):
+        # same as the nearest time, looked for profile by profile
+        assert np.abs(dt) == np.min(np.abs(time2 - time1[i1]))
+        assert time2[::-1][i2] - time1[i1] == dt
+    nearest = np.min(np.abs(time1[:, np.newaxis] - time2), axis=1)
+    assert match['i1'].size == np.sum(nearest <= 0.5)
+    lat = np.zeros(time2.size)
+    match = collocate(time1, time2, max_dt=0.5, lon1=np.zeros(500), lat1=np.zeros(500), lon2=lat + 1, lat2=lat)
+    assert np.allclose(match['distance'], 111.19, atol=0.01)
+
+
+def test_geoprof_files(tmpdir, monkeypatch):
+    daydir = tmpdir.mkdir('2008').mkdir('2008_01_01')
+    daydir.join('CALTRACK-5km_CS-2B-GEOPROF_V1-00_2008-01-01T01-30-23ZN.hdf').write('')
+    monkeypatch.setattr(localpaths, 'caltrack_geoprof_dir', (str(tmpdir),), raising=False)
+    assert len(geoprof_files(2008, 1, 1)) == 1
+    monkeypatch.delattr(localpaths, 'caltrack_geoprof_dir')
+    with pytest.raises(IOError):
+        geoprof_files(2008, 1, 1)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import numpy as np
+import lite
+
+
+def test_datetimes(tmp_path):
+    records = np.zeros(3, dtype=lite.header)
+    records['gmtday'] = [253, 253, 254]
+    records['gmthour'] = [16, 23, 0]
+    records['gmtmin'] = [45, 59, 1]
+    records['gmtsec'] = [58, 59, 2]
+    # hundredths of seconds, int8 on disk
+    records['gmthund'] = [8, 99, 50]
+    filename = str(tmp_path / 'LITE_L1_19940910_164558_164706')
+    records.tofile(filename)
+
+    l = lite.LITE(filename)
+    assert l.nprof == 3
+    expected = np.array(['1994-09-10T16:45:58.08', '1994-09-10T23:59:59.99', '1994-09-11T00:01:02.50'],
+                        dtype='datetime64[ns]')
+    assert np.all(l.datetimes == expected)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import numpy as np
+import regrid
+
+
+def test_grid_stats():
+    np.random.seed(3)
+    lon, lat = np.random.uniform(-180, 180, 5000), np.random.uniform(-90, 90, 5000)
+    var = np.random.normal(size=5000)
+    var[::50] = np.nan
+    out, newlon, newlat = regrid.grid_stats(lon, lat, var, 10., 10., lonrange=(-180, 180), latrange=(-90, 90))
+    assert out['mean'].shape == (36, 18)
+    for i, j in ((0, 0), (35, 17), (12, 5)):
+        sel = (lon >= newlon[i]) & (lon < newlon[i] + 10) & (lat >= newlat[j]) & (lat < newlat[j] + 10)
+        v = var[sel & np.isfinite(var)]
+        assert out['count'][i, j] == v.size
+        assert np.allclose([out['sum'][i, j], out['mean'][i, j], out['std'][i, j], out['min'][i, j], out['max'][i, j]],
+                           [v.sum(), v.mean(), v.std(), v.min(), v.max()])
+    assert out['count'].sum() == np.sum(np.isfinite(var))
+
+
+def test_remean_gridded():
+    lon, lat = np.arange(0., 10., 0.5), np.arange(40., 45., 0.5)
+    var = np.ones((lon.size, lat.size))
+    var[0, 0] = np.nan
+    var[-1, -1] = 3.
+    newvar, newlon, newlat = regrid.remean(lon, lat, var, 2., 2.)
+    assert newvar.shape == (newlon.size, newlat.size)
+    assert newvar[0, 0] == 1.
+    # the last row and column are filled too
+    assert newvar[-1, -1] == (3. + 7.) / 8
+    newvar, newlon, newlat = regrid.remap(lon, lat, var, 2., 2.)
+    assert np.nansum(var) == newvar.sum()
+
+
+def test_accumulator(tmp_path):
+    np.random.seed(4)
+    lon, lat = np.random.uniform(-180, 180, 3000), np.random.uniform(-90, 90, 3000)
+    z = np.random.uniform(0, 20, (3000, 5))
+    var = np.random.normal(size=(3000, 5))
+    zedges = np.r_[0:21:5.]
+    acc1 = regrid.GridAccumulator(30., 30., zedges=zedges)
+    acc2 = regrid.GridAccumulator(30., 30., zedges=zedges)
+    acc1.add(lon[:1000], lat[:1000], var[:1000], z=z[:1000])
+    acc2.add(lon[1000:], lat[1000:], var[1000:], z=z[1000:])
+    acc2.save(str(tmp_path / 'acc2.npz'))
+    acc1.merge(regrid.GridAccumulator.load(str(tmp_path / 'acc2.npz')))
+    assert acc1.count.shape == (12, 6, 4)
+    assert acc1.count.sum() == var.size
+
+    sel = (lon >= -150) & (lon < -120) & (lat >= 0) & (lat < 30)
+    v = var[sel][(z[sel] >= 5) & (z[sel] < 10)]
+    assert acc1.count[1, 3, 1] == v.size
+    assert np.allclose([acc1.mean()[1, 3, 1], acc1.std()[1, 3, 1]], [v.mean(), v.std()])
+
+
+def test_resample():
+    from datetime import timedelta
+    np.random.seed(5)
+    start = np.datetime64('2008-01-01T00:00', 'ns')
+    dates = start + (np.random.uniform(0, 10 * 86400, 2000) * 1e9).astype('timedelta64[ns]')
+    data = np.random.normal(size=(2000, 2))
+    out, newdates = regrid.resample_with_timestep(dates, data, timedelta(days=1), stats=('count', 'mean', 'max'),
+                                                  percentiles=(10, 50))
+    # 10 days, then the empty day after midnight of the last date
+    assert newdates.size == 11
+    assert out['mean'].shape == (11, 2)
+    assert np.all(np.isnan(out['mean'][-1])) and np.all(out['count'][-1] == 0)
+    sel = (dates >= newdates[3]) & (dates < newdates[4])
+    for name, f in (('mean', np.mean), ('max', np.max), ('p10', lambda x, axis: np.percentile(x, 10, axis=axis)),
+                    ('p50', np.median)):
+        assert np.allclose(out[name][3], f(data[sel], axis=0))
+    mean, newdates2 = regrid.average_with_timestep(dates.astype('datetime64[us]').astype(object), data[:, 0],
+                                                   timedelta(days=1))
+    # datetime objects and a last bin at 0, as before resample_with_timestep
+    assert list(newdates2) == list(newdates.astype('datetime64[us]').astype(object))
+    assert newdates2[0] - newdates2[1] == -timedelta(days=1)
+    assert np.allclose(mean[:10], out['mean'][:10, 0]) and mean[-1] == 0.
+    total, newdates3 = regrid.aggregate_with_timestep(dates.astype('datetime64[us]').astype(object), data[:, 0],
+                                                      timedelta(days=1))
+    assert list(newdates3) == list(newdates2) and np.allclose(total, out['count'][:, 0] * mean)
+
+
+def test_regrid_profiles(capsys):
+    np.random.seed(6)
+    pprof = np.sort(np.random.uniform(10, 1000, (300, 30)), axis=1)[:, ::-1]
+    vprof = np.random.normal(size=(300, 30))
+    pprof[7] = pprof[7, np.random.permutation(30)]
+    pvec = np.r_[1050:1:-5.]
+    vprof2, mask = regrid.regrid_profiles(pvec, pprof, vprof, return_mask=True)
+    assert np.all(mask == (np.arange(300) == 7))
+    for i in range(0, 300, 7):
+        order = np.argsort(pprof[i])
+        assert np.allclose(vprof2[i], np.interp(pvec, pprof[i, order], vprof[i, order]))
+    # the mask replaces printed warnings
+    assert np.array_equal(regrid.regrid_profiles(pvec, pprof, vprof), vprof2)
+    pveclog, vprof3, mask3 = regrid.regrid_profiles_on_logp(np.log10(pprof), vprof, return_mask=True)
+    assert np.array_equal(mask3, mask) and vprof3.shape == (300, pveclog.size)
+    assert capsys.readouterr().out == ''
+
+
+def test_regrid_array(capsys):
+    from scipy.interpolate import interp1d
+    np.random.seed(7)
+    parr = np.sort(np.random.uniform(10, 1000, (20, 6, 7)), axis=0)[::-1]
+    varr = np.random.normal(size=(20, 6, 7))
+    pvec = np.r_[1000:5:-10.]
+    out = np.zeros((2, pvec.size, 6, 7))
+    regrid.regrid_array(pvec, parr, varr, out=out[1], chunk=10)
+    near = regrid.regrid_array(pvec, parr, varr, kind='nearest')
+    for i, j in ((0, 0), (5, 6), (3, 2)):
+        assert np.allclose(out[1, :, i, j], np.interp(pvec, parr[::-1, i, j], varr[::-1, i, j]))
+        f = interp1d(parr[::-1, i, j], varr[::-1, i, j], kind='nearest', bounds_error=False)
+        assert np.allclose(near[:, i, j], f(pvec), equal_nan=True)
+
+    # columns with pressures not all decreasing
+    parr[:, 2, 4] = parr[::-1, 2, 4]
+    for kind in ('linear', 'cubic'):
+        varr2, mask = regrid.regrid_array(pvec, parr, varr, kind=kind, chunk=10, return_mask=True)
+        assert np.array_equal(mask, np.arange(42).reshape(6, 7) == 18)
+    pveclog, varr2, mask = regrid.regrid_array_on_logp(np.log10(parr), varr, n=50, return_mask=True)
+    assert varr2.shape == (pveclog.size, 6, 7) and mask[2, 4] and mask.sum() == 1
+    assert capsys.readouterr().out == ''
+
+
+def test_regrid_weights_z(capsys):
+    from scipy.interpolate import interp1d
+    np.random.seed(8)
+    zarr = np.sort(np.random.uniform(0, 20, (25, 50)), axis=0)
+    zarr[:, 3] = zarr[::-1, 3]
+    zvec = np.r_[0:20:0.25]
+    for kind in ('linear', 'nearest'):
+        weights = regrid.regrid_weights_z(zvec, zarr, kind=kind)
+        assert np.flatnonzero(weights['bad']) == [3]
+        for var in (np.random.normal(size=zarr.shape), zarr ** 2):
+            varr2 = regrid.regrid_array_z(zvec, zarr, var, kind=kind, weights=weights)
+            for i in range(50):
+                f = interp1d(zarr[:, i], var[:, i], kind=kind, bounds_error=False)
+                assert np.allclose(varr2[:, i], f(zvec), equal_nan=True)
+        varr2, mask = regrid.regrid_array_z(zvec, zarr, var, kind=kind, return_mask=True)
+        assert np.array_equal(mask, weights['bad'])
+    assert capsys.readouterr().out == ''
+
+
+def test_polar_grids():
+    np.random.seed(9)
+    lon, lat = np.random.uniform(-180, 180, 4000), np.random.uniform(-90, -55, 4000)
+    for grid in (regrid.EqualAreaGrid(100., boundinglat=-60), regrid.PolarStereoGrid(100., boundinglat=-60)):
+        x, y = grid.project(lon, lat)
+        lon2, lat2 = grid.inverse(x, y)
+        assert np.allclose(lat2, lat) and np.allclose(np.cos(np.radians(lon2 - lon)), 1.)
+        # no discontinuity at the dateline
+        x, y = grid.project([179.999, -179.999], [-75, -75])
+        assert np.hypot(x[1] - x[0], y[1] - y[0]) < 0.1
+
+        var = np.random.normal(size=(3, 4000))
+        out = grid.stats(lon, lat, var)
+        assert grid.index_map(lon, lat) is grid.index_map(lon.copy(), lat.copy())
+        assert out['mean'].shape == (3,) + grid.shape
+        assert out['count'][1].sum() == np.sum(lat <= -60)
+        index = grid.cell_index(lon, lat)
+        iy, ix = np.unravel_index(index[0], grid.shape)
+        assert np.allclose(out['mean'][2, iy, ix], var[2][index == index[0]].mean())
+
+    assert isinstance(regrid.PolarStereoGrid(), regrid.EqualAreaGrid)
+
+    # least recently used index maps are dropped first
+    grid = regrid.EqualAreaGrid(100., boundinglat=-60, max_maps=2)
+    first = grid.index_map(lon[:10], lat[:10])
+    grid.index_map(lon[10:20], lat[10:20])
+    assert grid.index_map(lon[:10], lat[:10]) is first
+    grid.index_map(lon[20:30], lat[20:30])
+    assert grid.index_map(lon[:10], lat[:10]) is first
+    assert len(grid._maps) == 2
+
+    # equal area: the cap south of 60S covers 2 pi R^2 (1 - sin 60) km2
+    grid = regrid.EqualAreaGrid(10., boundinglat=-60)
+    lon, lat = grid.centers()
+    area = np.sum(lat <= -60) * 100.
+    assert abs(area / (2 * np.pi * regrid.earth_radius ** 2 * (1 - np.sin(np.radians(60)))) - 1) < 1e-3
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import numpy as np
+from datetime import datetime, timedelta
+from timeutils import tai93_to_datetime64, caliop_utc_to_datetime64, doy_to_datetime64
+from timeutils import offsets_to_datetime64, wrf_times_to_datetime64
+
+
+def test_tai93():
+    seconds = np.array([0., 5.7e8 + 0.25, np.nan])
+    dates = tai93_to_datetime64(seconds)
+    assert dates.dtype == np.dtype('datetime64[ns]')
+    assert dates[1] == np.datetime64(datetime(1993, 1, 1) + timedelta(seconds=5.7e8 + 0.25))
+    assert np.isnat(dates[2])
+
+
+def test_caliop_utc():
+    # 2012-01-01 12:00:00 and 2010-12-31 18:00:00
+    dates = caliop_utc_to_datetime64([120101.5, 101231.75])
+    assert dates[0] == np.datetime64('2012-01-01T12:00:00')
+    assert dates[1] == np.datetime64('2010-12-31T18:00:00')
+
+
+def test_doy():
+    dates = doy_to_datetime64(1994, [1, 256], [0, 23], [0, 59], [0, 30], [0, 990000])
+    assert dates[0] == np.datetime64('1994-01-01')
+    assert dates[1] == np.datetime64(datetime(1994, 9, 13, 23, 59, 30, 990000))
+
+
+def test_offsets_and_wrf():
+    seconds = np.ma.masked_array([0., 10.5, 20.], mask=[False, False, True])
+    dates = offsets_to_datetime64(datetime(2006, 6, 27, 3), seconds)
+    assert dates[1] == np.datetime64('2006-06-27T03:00:10.5')
+    assert np.isnat(dates[2])
+    times = np.array([list(b'2006-06-27_03:00:00'), list(b'2006-06-27_06:00:00')], dtype='u1').view('S1')
+    dates = wrf_times_to_datetime64(times)
+    assert np.all(dates == np.array(['2006-06-27T03', '2006-06-27T06'], dtype='datetime64[ns]'))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import pytest
+import numpy as np
+from pyhdf.HDF import HDF, HC
+import pyhdf.VS
+from calipso.vdata import read_vdata, list_vdata
+
+
+@pytest.fixture(scope='module')
+def hdf_with_metadata(tmpdir_factory):
+    filename = str(tmpdir_factory.mktemp('vdata').join('metadata.hdf'))
+    f = HDF(filename, HC.WRITE | HC.CREATE)
+    vs = f.vstart()
+    vd = vs.create('metadata', [('Product_ID', HC.CHAR8, 20),
+                                ('Number_of_Profiles', HC.INT32, 1),
+                                ('Lidar_Data_Altitudes', HC.FLOAT32, 583)])
+    vd.write([['L1_Standard'.ljust(20, '\x00'), 56190, list(np.linspace(40., -0.5, 583))]])
+    vd.detach()
+    vs.end()
+    f.close()
+    return filename
+
+
+def test_list_vdata(hdf_with_metadata):
+    assert 'metadata' in list_vdata(hdf_with_metadata)
+
+
+def test_read_metadata(hdf_with_metadata):
+    meta = read_vdata(hdf_with_metadata, 'metadata')
+    assert meta['Product_ID'] == 'L1_Standard'
+    assert meta['Number_of_Profiles'] == 56190
+    assert meta['Lidar_Data_Altitudes'].shape == (583,)
+    assert np.allclose(meta['Lidar_Data_Altitudes'], np.linspace(40., -0.5, 583))
+
+
+def test_missing_vdata(hdf_with_metadata):
+    with pytest.raises(KeyError):
+        read_vdata(hdf_with_metadata, 'not_there')
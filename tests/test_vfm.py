@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import os
+import numpy as np
+from pyhdf.SD import SD, SDC
+from calipso.vfm import VFM, _vfm_index, vfm_altitude
+from calipso.calipso_hdf import _decode_fcf
+
+
+def test_vfm_index():
+    # one record, regions cut the usual way
+    r = np.arange(5515)
+    grid = r[_vfm_index]
+    assert grid.shape == (15, 545)
+    for p in range(15):
+        ref = np.r_[r[0:165].reshape(3, 55)[p // 5], r[165:1165].reshape(5, 200)[p // 3],
+                    r[1165:].reshape(15, 290)[p]]
+        assert np.array_equal(grid[p], ref)
+    assert np.all(np.diff(vfm_altitude) < 0)
+    assert np.isclose(vfm_altitude[0], 30.01) and np.isclose(vfm_altitude[-1], -0.485)
+
+
+def test_grid(tmpdir):
+    nrec = 7
+    np.random.seed(12)
+    flags = np.random.randint(0, 2 ** 16, (nrec, 5515)).astype('u2')
+    time = 5.3e8 + 5.6 * np.arange(nrec)
+    filename = str(tmpdir.join('CAL_LID_L2_VFM-ValStage1-V3-01.2010-03-04T01-32-02ZN.hdf'))
+    sd = SD(filename, SDC.WRITE | SDC.CREATE)
+    for name, values, sdtype in (('Feature_Classification_Flags', flags, SDC.UINT16),
+                                 ('Profile_Time', time.reshape(nrec, 1), SDC.FLOAT64)):
+        v = sd.create(name, sdtype, values.shape)
+        v[:] = values
+        v.endaccess()
+    sd.end()
+
+    vfm = VFM(filename)
+    assert np.array_equal(vfm.datetimes(), np.datetime64('1993-01-01', 'ns') + (time * 1e9).astype('timedelta64[ns]'))
+    grid = vfm.grid()
+    assert grid['type'].shape == (nrec * 15, 545)
+    for rec, p in ((0, 0), (3, 7), (6, 14)):
+        decoded = _decode_fcf(flags[rec][_vfm_index[p]])
+        for field in ('type', 'type_qa', 'phase', 'phase_qa'):
+            assert np.array_equal(grid[field][rec * 15 + p], decoded[field])
+
+    # chunks cut in the middle of the file, memory-mapped output
+    mapped = vfm.grid(fields=('type', 'phase'), out=str(tmpdir), chunk_records=3)
+    for field in ('type', 'phase'):
+        assert isinstance(mapped[field], np.memmap)
+        assert np.array_equal(mapped[field], grid[field])
+        saved = np.load(os.path.join(str(tmpdir), 'VFM_%s_%s.npy' % (vfm.id, field)))
+        assert np.array_equal(saved, grid[field])
+    # preallocated output, e.g. part of a whole day
+    day = np.zeros((2 * nrec * 15, 545), dtype='uint8')
+    vfm.grid(fields=('type',), out=dict(type=day[nrec * 15:]), chunk_records=1)
+    assert np.array_equal(day[nrec * 15:], grid['type']) and not day[:nrec * 15].any()
+    vfm.close()
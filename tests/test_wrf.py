@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+import netCDF4
+import numpy as np
+import wrf
+
+
+def _grid(lon0, lat0, n, step):
+    # slightly rotated grid, like a projected WRF domain
+    i, j = np.mgrid[0:n, 0:n].astype('float64')
+    lon = lon0 + step * (j + 0.1 * i)
+    lat = lat0 + step * (i - 0.1 * j)
+    return lon, lat
+
+
+def _wrfout(filename, lon, lat, nz=4):
+    ny, nx = lon.shape
+    nc = netCDF4.Dataset(filename, 'w')
+    nc.createDimension('Time', 2)
+    nc.createDimension('DateStrLen', 19)
+    nc.createDimension('bottom_top', nz)
+    nc.createDimension('bottom_top_stag', nz + 1)
+    nc.createDimension('south_north', ny)
+    nc.createDimension('west_east', nx)
+    times = nc.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+    times[:] = np.array(['2006-06-27_03:00:00', '2006-06-27_06:00:00'], dtype='S19').view('S1').reshape(2, 19)
+    for name, value in (('XLONG', lon), ('XLAT', lat)):
+        nc.createVariable(name, 'f4', ('Time', 'south_north', 'west_east'))[:] = [value, value]
+    # W is a linear function of lon and lat, 10 times larger at the second time
+    w = (lon + 2 * lat)[np.newaxis, :, :] + np.arange(nz + 1)[:, np.newaxis, np.newaxis]
+    nc.createVariable('W', 'f4', ('Time', 'bottom_top_stag', 'south_north', 'west_east'))[:] = [w, 10 * w]
+    nc.close()
+    return wrf.wrf(filename)
+
+
+def test_locator(tmp_path):
+    lon, lat = _grid(-70., -75., 60, 0.25)
+    np.random.seed(2)
+    lonorb, latorb = np.random.uniform(-68, -62, 2000), np.random.uniform(-73, -68, 2000)
+    i, j = wrf.locator(lon, lat).nearest(lonorb, latorb)
+    assert wrf.locator(lon, lat) is wrf.locator(lon.copy(), lat.copy())
+    for k in range(0, 2000, 97):
+        dist = wrf._xyz(lon, lat) @ wrf._xyz(lonorb[k], latorb[k])
+        assert (i[k], j[k]) == np.unravel_index(np.argmax(dist), lon.shape)
+
+    w = _wrfout(str(tmp_path / 'wrfout_d01'), lon, lat)
+    prof = w.w(on_orbit=(lonorb, latorb), interp='bilinear')
+    assert prof.shape == (2000, 5)
+    assert np.allclose(prof[:, 0], lonorb + 2 * latorb, atol=0.05)
+    # half way between the two model times
+    time = np.datetime64('2006-06-27T04:30') + np.zeros(2000, dtype='timedelta64[s]')
+    prof = w.w(on_orbit=(lonorb, latorb), interp='bilinear', time=time)
+    assert np.allclose(prof[:, 1], 5.5 * (lonorb + 2 * latorb + 1), atol=0.5)
+
+    # nested domain, finer grid in the middle
+    lon2, lat2 = _grid(-66., -72., 40, 0.05)
+    w2 = _wrfout(str(tmp_path / 'wrfout_d02'), lon2, lat2)
+    prof, idomain = wrf.nested_on_orbit([w, w2], 'w', (lonorb, latorb), interp='bilinear')
+    assert np.all(idomain == wrf.locator(lon2, lat2).contains(lonorb, latorb))
+    assert 0 < np.sum(idomain) < 2000
+    assert np.allclose(prof[:, 0], lonorb + 2 * latorb, atol=0.05)
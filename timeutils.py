@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+'''
+Vectorized conversions of the time formats found in data files
+to numpy datetime64[ns] arrays.
+
+    tai93_to_datetime64         seconds since 1993-01-01 (CALIOP, MLS Profile_Time)
+    caliop_utc_to_datetime64    CALIOP decimal dates, yymmdd.fraction_of_day
+    doy_to_datetime64           year, day of year, hour... fields (LITE)
+    offsets_to_datetime64       seconds after a start date (PCCORA radiosondes)
+    wrf_times_to_datetime64     WRF Times char arrays, YYYY-MM-DD_HH:MM:SS
+
+All functions work on whole arrays at once, and give NaT for missing values.
+Use .astype('datetime64[us]').astype(object) on the result to get datetime.datetime objects.
+
+V. Noel - LMD/CNRS
+'''
+
+import numpy as np
+
+_ns_per_second = 1000000000
+_ns_per_day = 86400 * _ns_per_second
+
+tai93_epoch = np.datetime64('1993-01-01T00:00:00', 'ns')
+
+
+def _seconds_to_timedelta64(seconds):
+    '''
+    float seconds -> timedelta64[ns], NaT where seconds is not finite or masked
+    '''
+    seconds = np.ma.filled(np.ma.asarray(seconds, dtype='float64'), np.nan)
+    ok = np.isfinite(seconds)
+    ns = np.round(np.where(ok, seconds, 0.) * _ns_per_second).astype('int64')
+    delta = ns.astype('timedelta64[ns]')
+    delta[~ok] = np.timedelta64('NaT')
+    return delta
+
+
+def tai93_to_datetime64(seconds):
+    '''
+    converts seconds since 1993-01-01 (e.g. CALIOP Profile_Time) to datetime64[ns].
+    like netCDF4.num2date, leap seconds are not taken into account.
+    '''
+    return tai93_epoch + _seconds_to_timedelta64(seconds)
+
+
+def caliop_utc_to_datetime64(utc):
+    '''
+    converts CALIOP decimal UTC dates (e.g. Profile_UTC_Time, yymmdd.ffffffff
+    where ffffffff is the fraction of the day) to datetime64[ns].
+    '''
+    utc = np.ma.filled(np.ma.asarray(utc, dtype='float64'), np.nan)
+    ok = np.isfinite(utc)
+    utc = np.where(ok, utc, 0.)
+    ymd = np.floor(utc).astype('int64')
+    year = 2000 + ymd // 10000
+    month = (ymd // 100) % 100
+    day = ymd % 100
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    dates = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    # decimal dates are not more precise than ~1 microsecond
+    seconds = np.round((utc - ymd) * 86400., 6)
+    dates = dates.astype('datetime64[ns]') + _seconds_to_timedelta64(seconds)
+    dates[~ok] = np.datetime64('NaT')
+    return dates
+
+
+def doy_to_datetime64(year, doy, hour=0, minute=0, second=0, microsecond=0):
+    '''
+    converts year, day of year (1 = January 1st), hour, minute, second
+    and microsecond fields to datetime64[ns]. All arguments can be arrays
+    or scalars (e.g. a single year for all profiles).
+    '''
+    year = np.asarray(year, dtype='int64')
+    jan1 = (year - 1970).astype('datetime64[Y]').astype('datetime64[ns]')
+    ns = ((np.asarray(doy, dtype='int64') - 1) * _ns_per_day
+          + np.asarray(hour, dtype='int64') * 3600 * _ns_per_second
+          + np.asarray(minute, dtype='int64') * 60 * _ns_per_second
+          + np.asarray(second, dtype='int64') * _ns_per_second
+          + np.asarray(microsecond, dtype='int64') * 1000)
+    return jan1 + ns.astype('timedelta64[ns]')
+
+
+def offsets_to_datetime64(start, seconds):
+    '''
+    converts offsets in seconds after a start date (datetime or datetime64)
+    to datetime64[ns]. Masked offsets give NaT.
+    '''
+    return np.datetime64(start, 'ns') + _seconds_to_timedelta64(seconds)
+
+
+def wrf_times_to_datetime64(times):
+    '''
+    converts WRF Times, char arrays [ntime, 19] or strings like
+    2006-06-27_03:00:00, to datetime64[ns].
+    '''
+    times = np.asarray(times)
+    if times.dtype.kind == 'S' and times.dtype.itemsize == 1 and times.ndim == 2:
+        # one character per item, join them in one string per time
+        times = np.ascontiguousarray(times).view('S%d' % times.shape[1])[:, 0]
+    times = np.char.replace(times.astype('U'), '_', 'T')
+    return times.astype('datetime64[ns]')
@@ -6,8 +6,11 @@ module wrf
 V. Noel 2010
 '''
 
+import hashlib
 import netCDF4
 import numpy as np
+from scipy.spatial import cKDTree
+from timeutils import wrf_times_to_datetime64
 
 # private functions
 
@@ -16,22 +19,111 @@ def _tk (p, tpot):
     tk = (tpot + 300)/((1000/(p/100))**f)
     return tk
 
-def _remap (var, lon, lat, lonorb, latorb):
-    '''Extrait des profils verticaux WRF sur une liste de coordonnees lon/lat.'''
+def _xyz(lon, lat):
+    # points on the unit sphere, distances between them increase like great circle distances
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class Locator(object):
+    """
+    Finds points in a WRF domain, from its XLONG/XLAT grids [ny, nx].
+    A KD-tree of the grid points is built once, then queries for any
+    number of points are answered at once.
+        loc = locator(lon, lat)
+        i, j = loc.nearest(lonorb, latorb)
+        i, j, w = loc.bilinear(lonorb, latorb)
+    """
+
+    def __init__(self, lon, lat):
+        self.shape = lon.shape
+        self.xyz = _xyz(lon, lat)
+        self.tree = cKDTree(self.xyz.reshape(-1, 3))
+        # derivatives of grid positions along i and j, for bilinear weights
+        self.di = np.gradient(self.xyz, axis=0)
+        self.dj = np.gradient(self.xyz, axis=1)
+
+    def nearest(self, lon, lat):
+        """
+        returns the indexes i, j of the closest grid points
+        """
+        dist, k = self.tree.query(_xyz(np.ravel(lon), np.ravel(lat)))
+        return np.unravel_index(k, self.shape)
+
+    def fractional(self, lon, lat):
+        """
+        returns the fractional grid indexes fi, fj of points,
+        from a linear approximation of the grid around the closest grid point
+        """
+        p = _xyz(np.ravel(lon), np.ravel(lat))
+        i, j = self.nearest(lon, lat)
+        a, b = self.di[i, j], self.dj[i, j]
+        d = p - self.xyz[i, j]
+        # least squares solution of a * di + b * dj = d
+        aa, ab, bb = np.sum(a * a, -1), np.sum(a * b, -1), np.sum(b * b, -1)
+        ad, bd = np.sum(a * d, -1), np.sum(b * d, -1)
+        det = aa * bb - ab * ab
+        return i + (bb * ad - ab * bd) / det, j + (aa * bd - ab * ad) / det
+
+    def contains(self, lon, lat):
+        """
+        True for points inside the domain
+        """
+        fi, fj = self.fractional(lon, lat)
+        ny, nx = self.shape
+        return (fi >= 0) & (fi <= ny - 1) & (fj >= 0) & (fj <= nx - 1)
+
+    def bilinear(self, lon, lat):
+        """
+        returns indexes i, j [npts, 4] of the grid points surrounding points,
+        and their bilinear weights w [npts, 4].
+        Points outside the domain get the values of the domain edge.
+        """
+        fi, fj = self.fractional(lon, lat)
+        ny, nx = self.shape
+        i0 = np.clip(np.floor(fi).astype(int), 0, ny - 2)
+        j0 = np.clip(np.floor(fj).astype(int), 0, nx - 2)
+        wi = np.clip(fi - i0, 0., 1.)
+        wj = np.clip(fj - j0, 0., 1.)
+        i = np.stack([i0, i0 + 1, i0, i0 + 1], axis=-1)
+        j = np.stack([j0, j0, j0 + 1, j0 + 1], axis=-1)
+        w = np.stack([(1 - wi) * (1 - wj), wi * (1 - wj), (1 - wi) * wj, wi * wj], axis=-1)
+        return i, j, w
 
-    n = lonorb.size                   # nombre de coordonnees
-    var2 = np.zeros([var.shape[0], n])
 
-    for i in np.arange(n):
-        # pour chaque profil, on calcule une grille de distance avec les coords WRF
-        d = np.sqrt((lon-lonorb[i])**2 + (lat-latorb[i])**2)
-        #im = argmin(d)
-        #imin, jmin = unravel_index(im, lon.shape)
-        # the code below is much faster
-        imin, jmin = divmod(d.argmin(), d.shape[1])
-        var2[:,i] = var[:,imin,jmin]
+# locators, by domain grid
+_locators = dict()
 
-    return var2.T
+
+def locator(lon, lat):
+    """
+    returns the Locator of a WRF domain, built once per domain grid
+    """
+    lon, lat = np.asarray(lon, dtype='float64'), np.asarray(lat, dtype='float64')
+    key = (lon.shape, hashlib.md5(lon.tobytes() + lat.tobytes()).hexdigest())
+    if key not in _locators:
+        _locators[key] = Locator(lon, lat)
+    return _locators[key]
+
+
+def _extract(var, i, j, w=None):
+    """
+    extracts vertical profiles [npts, nz] from var [nz, ny, nx] at grid points i, j,
+    or the weighted sum of profiles at grid points i, j [npts, 4] with weights w.
+    """
+    if w is None:
+        return var[:, i, j].T
+    prof = np.zeros((i.shape[0], var.shape[0]))
+    for k in range(i.shape[1]):
+        prof += var[:, i[:, k], j[:, k]].T * w[:, k, np.newaxis]
+    return prof
+
+
+def _remap (var, lon, lat, lonorb, latorb):
+    '''Extrait des profils verticaux WRF sur une liste de coordonnees lon/lat.'''
+
+    i, j = locator(lon, lat).nearest(lonorb, latorb)
+    return _extract(var, i, j)
 
 class wrf(object):
     
@@ -58,58 +150,124 @@ class wrf(object):
         return self.nc.variables['Times'].shape[0]
 
     def times(self):
-        t = self.nc.variables['Times']
-        ts = []
-        ts = [ttxt.tostring() for ttxt in t[:,:]]
-        return ts
+        '''
+        returns model times as a datetime64[ns] array
+        '''
+        t = self.nc.variables['Times'][:]
+        return wrf_times_to_datetime64(t)
 
     def time(self, it=0):
         t = self.nc.variables['Times'][it,:]
         t = t.tostring()
         return t
         
+    def locator(self, it=0):
+        '''
+        returns the Locator of the domain (see Locator), built once per domain
+        '''
+        lon, lat = self.coords(it=it)
+        return locator(lon, lat)
+
+    def time_brackets(self, time):
+        '''
+        returns the indexes it0, it1 of model times surrounding times,
+        and the weight of it1 for linear interpolation in time.
+        times outside the model times get the closest model time.
+        '''
+        t = self.times().astype('int64').astype('float64')
+        time = np.asarray(time, dtype='datetime64[ns]').astype('int64').astype('float64')
+        it1 = np.clip(np.searchsorted(t, time), 1, max(t.size - 1, 1))
+        it0 = it1 - 1
+        if t.size == 1:
+            return np.zeros_like(it0), np.zeros_like(it0), np.zeros_like(time)
+        w = np.clip((time - t[it0]) / (t[it1] - t[it0]), 0., 1.)
+        return it0, it1, w
+
+    def _on_orbit(self, field, it, on_orbit, interp='nearest', time=None):
+        '''
+        extracts profiles [npts, nz] of field(it), a function returning
+        a 3D field [nz, ny, nx], on the coordinates on_orbit=(lon, lat).
+        interp = 'nearest' or 'bilinear'
+        time = if given, times of the points (datetime64), the field is
+               interpolated linearly between the model times around them.
+        '''
+        loc = self.locator()
+        if interp == 'bilinear':
+            i, j, w = loc.bilinear(on_orbit[0], on_orbit[1])
+        else:
+            (i, j), w = loc.nearest(on_orbit[0], on_orbit[1]), None
+        if time is None:
+            return _extract(field(it), i, j, w)
+
+        it0, it1, wt = self.time_brackets(time)
+        prof = None
+        for itime in np.unique(np.r_[it0, it1]):
+            # each model time is read once, for all the points that need it
+            weight = np.where(it0 == itime, 1. - wt, 0.) + np.where(it1 == itime, wt, 0.)
+            sel = np.flatnonzero(weight > 0)
+            if sel.size == 0:
+                continue
+            var = field(itime)
+            if prof is None:
+                prof = np.zeros((np.size(i, 0), var.shape[0]))
+            if w is None:
+                prof[sel] += _extract(var, i[sel], j[sel]) * weight[sel, np.newaxis]
+            else:
+                prof[sel] += _extract(var, i[sel], j[sel], w[sel]) * weight[sel, np.newaxis]
+        return prof
+
     def p_top(self, it=0):
         p = self.nc.variables['P_TOP'][it]
         return p
     
-    def pressure(self, it=0, pascals=False, on_orbit=None):
+    def pressure(self, it=0, pascals=False, on_orbit=None, interp='nearest', time=None):
         '''
         Lit le champ de pression du fichier WRF. 
         Parametres:  
         it: indice temporel du champ a extraire [default: 0]
         pascals: la pression sera renvoyee en pascals si True, en hPa si False.
         on_orbit: Liste facultative de lon et lat sur lesquels extraire les profils (lon_orbit, lat_orbit)
+        interp: 'nearest' (point de grille le plus proche) ou 'bilinear'
+        time: dates (datetime64) des profils on_orbit, interpolation entre les
+              deux pas de temps WRF qui les encadrent (it est alors ignore)
         Renvoie:
         champ de pression 3D [X, Y, Z] ([PROFIL, Z] si on_orbit)
         '''
-        p = self.nc.variables['P'][it,...] + self.nc.variables['PB'][it,...]
-        if not pascals:
-            p /= 100.
+        def field(it):
+            p = self.nc.variables['P'][it,...] + self.nc.variables['PB'][it,...]
+            if not pascals:
+                p /= 100.
+            return p
         if on_orbit:
-            wrflon, wrflat = self.coords(it=it)
-            p = _remap(p, wrflon, wrflat, on_orbit[0], on_orbit[1])
+            p = self._on_orbit(field, it, on_orbit, interp=interp, time=time)
+        else:
+            p = field(it)
         p = np.squeeze(p)
         return p
 
-    def temperature(self, it=0, kelvins=False, on_orbit=None):
+    def temperature(self, it=0, kelvins=False, on_orbit=None, interp='nearest', time=None):
         '''
         Lit le champ de temperature du fichier WRF. 
         Parametres:  
         it: indice temporel du champ a extraire [default: 0]
         kelvins: la temperature sera renvoyee en K si True, en Celsius si False.
         on_orbit: Liste facultative de lon et lat sur lesquels extraire les profils (lon_orbit, lat_orbit)
+        interp, time: cf pressure()
         Renvoie:
         champ de temperature 3D [X, Y, Z] ([PROFIL, Z] si on_orbit)
         '''
         
-        p = self.nc.variables['P'][it,...] + self.nc.variables['PB'][it,...]
-        tpot = self.nc.variables['T'][it,...]
-        t = _tk (p, tpot)
-        if not kelvins:
-            t -= 273.
+        def field(it):
+            p = self.nc.variables['P'][it,...] + self.nc.variables['PB'][it,...]
+            tpot = self.nc.variables['T'][it,...]
+            t = _tk (p, tpot)
+            if not kelvins:
+                t -= 273.
+            return t
         if on_orbit:
-            wrflon, wrflat = self.coords(it=it)
-            t = _remap(t, wrflon, wrflat, on_orbit[0], on_orbit[1])
+            t = self._on_orbit(field, it, on_orbit, interp=interp, time=time)
+        else:
+            t = field(it)
             
         t = np.squeeze(t)
         return t
@@ -127,21 +285,57 @@ class wrf(object):
         return v
     
 
-    def w(self, it=0, on_orbit=None):
+    def w(self, it=0, on_orbit=None, interp='nearest', time=None):
         '''
         Lit le champ de vitesse de vent vertical du fichier WRF. 
         Parametres:  
         it: indice temporel du champ a extraire [default: 0]
         on_orbit: Liste facultative de lon et lat sur lesquels extraire les profils (lon_orbit, lat_orbit)
+        interp, time: cf pressure()
         Renvoie:
         champ de vitesse de vent verticale 3D [X, Y, Z] ([PROFIL, Z] si on_orbit)
         '''
-        w = self.nc.variables['W'][it,...]
+        field = lambda it: self.nc.variables['W'][it,...]
         if on_orbit:
-            wrflon, wrflat = self.coords(it=it)
-            w = _remap(w, wrflon, wrflat, on_orbit[0], on_orbit[1])
+            w = self._on_orbit(field, it, on_orbit, interp=interp, time=time)
+        else:
+            w = field(it)
         return w
 
+
+def nested_on_orbit(domains, varname, on_orbit, **kwargs):
+    '''
+    Extrait des profils de plusieurs domaines WRF imbriques: chaque point
+    est pris dans le domaine le plus fin qui le contient.
+    Parametres:
+    domains: liste d'objets wrf, du plus grossier au plus fin (d01, d02...)
+    varname: 'pressure', 'temperature' ou 'w'
+    on_orbit: (lon_orbit, lat_orbit)
+    les autres arguments (it, interp, time...) sont passes a la methode varname.
+    Renvoie:
+    profils [PROFIL, Z], et l'indice du domaine utilise pour chaque profil
+    (les domaines doivent avoir le meme nombre de niveaux verticaux)
+    '''
+    lon, lat = np.ravel(on_orbit[0]), np.ravel(on_orbit[1])
+    idomain = np.zeros(lon.size, dtype=int)
+    for k, domain in enumerate(domains[1:]):
+        inside = domain.locator().contains(lon, lat)
+        idomain[inside] = k + 1
+    prof = None
+    for k, domain in enumerate(domains):
+        sel = np.flatnonzero(idomain == k)
+        if sel.size == 0:
+            continue
+        kw = dict(kwargs)
+        if kw.get('time') is not None:
+            kw['time'] = np.asarray(kw['time'])[sel]
+        p = getattr(domain, varname)(on_orbit=(lon[sel], lat[sel]), **kw)
+        p = np.atleast_2d(p)
+        if prof is None:
+            prof = np.zeros((lon.size, p.shape[1]))
+        prof[sel] = p
+    return prof, idomain
+
 def map_peninsula (lon, lat, xvar, centerlon=-60, w=2000,h=2000, cb=False, cl=None, cbtitle=None, ec='None', ax=None, fp=None):
     from mpl_toolkits import basemap
     from matplotlib.pyplot import colorbar